@@ -0,0 +1,22 @@
+"""
+Benchmarks for kube-rsync operations against a fake kubernetes cluster, these require pytest-benchmark and rsync:
+
+    python -m pytest benchmarks/bench_kube.py --benchmark-json=bench_output.json
+"""
+
+import shutil
+
+import pytest
+
+from dfsync.bench import run_kube_scenario
+
+pytest.importorskip("pytest_benchmark")
+if shutil.which("rsync") is None:
+    pytest.skip("rsync is not installed", allow_module_level=True)
+
+
+@pytest.mark.parametrize("pods", [1, 10, 100, 500])
+def test_kube_operations(benchmark, pods):
+    summaries = benchmark.pedantic(run_kube_scenario, args=(pods,), rounds=1, iterations=1)
+    for summary in summaries:
+        benchmark.extra_info[summary["operation"]] = summary
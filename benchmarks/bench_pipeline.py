@@ -0,0 +1,22 @@
+"""
+Benchmarks for the file change to destination sync pipeline, these require pytest-benchmark and rsync:
+
+    python -m pytest benchmarks/bench_pipeline.py --benchmark-json=bench_output.json
+"""
+
+import shutil
+
+import pytest
+
+from dfsync.bench import SCENARIOS, run_scenario, summarize
+
+pytest.importorskip("pytest_benchmark")
+if shutil.which("rsync") is None:
+    pytest.skip("rsync is not installed", allow_module_level=True)
+
+
+@pytest.mark.parametrize("scenario", SCENARIOS)
+def test_pipeline(benchmark, scenario):
+    result = benchmark.pedantic(run_scenario, args=(scenario,), kwargs=dict(iterations=10), rounds=1, iterations=1)
+    benchmark.extra_info.update(summarize(result))
+    assert result.missed == 0
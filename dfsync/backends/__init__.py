@@ -1,2 +1,20 @@
 from .rsync import rsync_backend
 from .kube import kube_backend
+from .fanout import fanout_backend
+from .protocol import (
+    ChangeRecord,
+    SyncBackend,
+    BatchSyncBackend,
+    VerifiableBackend,
+    is_synced,
+    load_backends,
+    supports_batches,
+    supports_verify,
+    sync_changes,
+)
+
+BUILTIN_BACKENDS = {
+    # File sync backends
+    "file-rsync": rsync_backend,
+    "kube-rsync": kube_backend,
+}
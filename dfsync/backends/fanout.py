@@ -0,0 +1,245 @@
+import functools
+import logging
+import os.path
+import threading
+import time
+from concurrent.futures import FIRST_EXCEPTION, Future, ThreadPoolExecutor, wait
+
+from dfsync.lib import ControlledThreadedOperation
+from dfsync.metrics import registry
+from .protocol import ChangeRecord, DELETED, MODIFIED, is_synced, supports_verify, sync_changes
+from .rsync import SyncPreempted
+
+
+def echo(msg=""):
+    print(msg)
+
+
+class Acknowledgement:
+    """
+    Resolves the future of a change set queued to several destinations: True once every destination synced it,
+    False as soon as one of them gave up on it (e.g. collapsed its queue into a full sync)
+    """
+
+    def __init__(self, count: int):
+        self.future = Future()
+        self._remaining = count
+        self._lock = threading.Lock()
+
+    def __call__(self, synced: bool = True):
+        with self._lock:
+            if self.future.done():
+                return
+            self._remaining -= 1
+            if not synced:
+                self.future.set_result(False)
+            elif self._remaining <= 0:
+                self.future.set_result(True)
+
+
+def _give_up(pending: list):
+    for _, _, ack in pending:
+        if ack is not None:
+            ack(False)
+
+
+class DestinationWorker(ControlledThreadedOperation):
+    """
+    Syncs the changes queued for one destination of a fan-out, in the background. Failed syncs stay queued
+    and are retried with an exponential backoff, without holding up the other destinations. Past `max_pending`
+    queued changes (e.g. the destination is offline), the queue collapses into a single full sync.
+    """
+
+    def __init__(self, name: str, backend, options: dict, max_pending: int = 1000, max_retry_delay: float = 60.0):
+        super().__init__()
+        self.name = name
+        self.backend = backend
+        self.options = options
+        self.max_pending = max_pending
+        self.max_retry_delay = max_retry_delay
+        self.src_file_paths = []
+        self.failures = 0
+
+        # Serializes the syncs to this destination, i.e. queued changes and full syncs
+        self.sync_lock = threading.Lock()
+        self._condition = threading.Condition()
+        self._pending = []
+        self._pending_count = 0
+        self._full_sync_paths = None
+        self._retry_at = 0.0
+        registry.gauge("fanout_pending", destination=name).set_function(lambda: self.pending_count)
+
+    @property
+    def pending_count(self):
+        with self._condition:
+            return self._pending_count + (1 if self._full_sync_paths is not None else 0)
+
+    def add(self, watched_dir: str, changes: list, ack: Acknowledgement = None):
+        with self._condition:
+            if self._full_sync_paths is not None:
+                # Already covered by the pending full sync
+                _give_up([(watched_dir, changes, ack)])
+                return
+            self._pending.append((watched_dir, changes, ack))
+            self._pending_count += len(changes)
+            if self._pending_count > self.max_pending:
+                self._set_full_sync(self.src_file_paths)
+            self._condition.notify_all()
+
+    def request_full_sync(self, src_file_paths: list):
+        with self._condition:
+            self._set_full_sync(src_file_paths)
+            self._condition.notify_all()
+
+    def discard_full_sync(self):
+        with self._condition:
+            self._full_sync_paths = None
+
+    def _set_full_sync(self, src_file_paths):
+        self._full_sync_paths = src_file_paths
+        _give_up(self._pending)
+        self._pending = []
+        self._pending_count = 0
+
+    def _is_ready(self):
+        has_pending = self._pending or self._full_sync_paths is not None
+        return has_pending and time.monotonic() >= self._retry_at
+
+    def run(self):
+        while self._running:
+            with self._condition:
+                if not self._condition.wait_for(self._is_ready, timeout=0.5):
+                    continue
+                full_sync_paths, pending = self._full_sync_paths, self._pending
+                self._full_sync_paths, self._pending, self._pending_count = None, [], 0
+
+            try:
+                with self.sync_lock:
+                    if full_sync_paths is not None:
+                        self.backend.sync_project(full_sync_paths, **self.options)
+                        full_sync_paths = None
+                    while pending:
+                        watched_dir, changes, ack = pending[0]
+                        result = sync_changes(self.backend, changes, watched_dir=watched_dir, **self.options)
+                        # Only the change sets left in pending are retried on failure
+                        pending.pop(0)
+                        if ack is not None:
+                            ack(is_synced(result))
+                self.failures = 0
+            except Exception as e:
+                self._retry_later(e, full_sync_paths, pending)
+
+    def _retry_later(self, error, full_sync_paths, pending):
+        self.failures += 1
+        delay = min(self.max_retry_delay, 2.0 ** (self.failures - 1))
+        registry.counter("fanout_retries", destination=self.name).inc()
+        logging.info(f"Sync to {self.name} failed", exc_info=error)
+        echo(f"Sync to {self.name} failed ({error}), retrying in {delay:.0f}s")
+
+        with self._condition:
+            self._retry_at = time.monotonic() + delay
+            if full_sync_paths is not None or self._full_sync_paths is not None:
+                _give_up(pending)
+                self._set_full_sync(self._full_sync_paths or full_sync_paths)
+            else:
+                self._pending[0:0] = pending
+                self._pending_count += sum(len(changes) for _, changes, _ in pending)
+
+
+class FanoutBackend:
+    """
+    Syncs the same sources to several destinations. Watching, filtering and change detection happen once,
+    each change set is then queued to every destination and synced concurrently by their own worker.
+    Full syncs run on all the destinations at once, the ones that fail are retried in the background.
+    `sync` and `sync_batch` only queue the changes and return a future, resolved once every destination
+    acknowledged them, the changes are recorded as synced then.
+
+    `destinations` is a list of (name, backend instance, backend options) tuples
+    """
+
+    def __init__(self, destinations: list, **kwargs):
+        self.workers = [DestinationWorker(name, backend, options) for name, backend, options in destinations]
+        self.max_batch_size = min(getattr(backend, "max_batch_size", 3) for _, backend, _ in destinations)
+
+    def sync(self, src_file_path, event=None, watched_dir: str = None, **kwargs):
+        src_abs_path = os.path.join(watched_dir, src_file_path) if watched_dir else src_file_path
+        kind = MODIFIED if os.path.exists(src_abs_path) else DELETED
+        return self.sync_batch([ChangeRecord(kind, src_file_path, None, None, None)], watched_dir=watched_dir)
+
+    def sync_batch(self, changes, watched_dir: str = None, **kwargs) -> Future:
+        changes = list(changes)
+        ack = Acknowledgement(len(self.workers))
+        for worker in self.workers:
+            worker.add(watched_dir, changes, ack)
+        return ack.future
+
+    def sync_project(self, src_file_paths, preempt=None, **kwargs):
+        synced = True
+        futures = self._run_concurrently(self.workers, self._sync_project, src_file_paths, preempt)
+        for worker, future in futures.items():
+            error = future.exception()
+            if error is not None:
+                echo(f"Full Sync to {worker.name} failed ({error}), retrying in the background")
+                worker.request_full_sync(src_file_paths)
+            synced = synced and error is None and is_synced(future.result())
+        return synced
+
+    def _sync_project(self, worker: DestinationWorker, src_file_paths, preempt):
+        with worker.sync_lock:
+            result = worker.backend.sync_project(src_file_paths, preempt=preempt, **worker.options)
+        worker.discard_full_sync()
+        return result
+
+    def verify_project(self, src_file_paths, preempt=None, checksum=False, output_lock=None, **kwargs):
+        workers = [w for w in self.workers if supports_verify(w.backend)]
+        verify = functools.partial(self._verify_project, checksum=checksum, output_lock=output_lock)
+        divergent = 0
+        for worker, future in self._run_concurrently(workers, verify, src_file_paths, preempt).items():
+            if future.exception() is not None:
+                echo(f"Verify of {worker.name} failed ({future.exception()})")
+            else:
+                divergent += future.result()
+        return divergent
+
+    def _run_concurrently(self, workers: list, operation, src_file_paths, preempt=None) -> dict:
+        """
+        Runs the operation for each of the workers at once and returns a dict of worker: future,
+        raises SyncPreempted once the preempt callback returns True
+        """
+        # The preempt callback is only ever called from this thread, the destinations just follow its decision
+        preempted = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(1, len(workers)), thread_name_prefix="dfsync-fanout") as executor:
+            futures = {
+                worker: executor.submit(operation, worker, src_file_paths, preempted.is_set) for worker in workers
+            }
+            pending = futures.values()
+            while pending:
+                _, pending = wait(pending, timeout=0.1, return_when=FIRST_EXCEPTION)
+                if preempt is not None and not preempted.is_set() and preempt():
+                    preempted.set()
+
+        if preempted.is_set():
+            raise SyncPreempted()
+        return futures
+
+    def _verify_project(self, worker: DestinationWorker, src_file_paths, preempt, checksum=False, output_lock=None):
+        with worker.sync_lock:
+            return worker.backend.verify_project(
+                src_file_paths, preempt=preempt, checksum=checksum, output_lock=output_lock, **worker.options
+            )
+
+    def on_monitor_start(self, src_file_paths: list = None, **kwargs):
+        for worker in self.workers:
+            worker.src_file_paths = src_file_paths
+            worker.backend.on_monitor_start(src_file_paths=src_file_paths, **worker.options)
+            worker.start()
+
+    def on_monitor_exit(self, **kwargs):
+        for worker in self.workers:
+            worker.stop()
+            if worker.pending_count > 0:
+                echo(f"{worker.pending_count} change(s) were not synced to {worker.name}")
+            worker.backend.on_monitor_exit(**worker.options)
+
+
+fanout_backend = FanoutBackend
@@ -1,22 +1,37 @@
 import copy
+import functools
 import sys
 import os
 import os.path
 import json
+import logging
+import threading
+import time
 import urllib3
 
+from concurrent.futures import ThreadPoolExecutor
 from urllib.parse import urlparse
-from kubernetes import client, config, watch
+from kubernetes import client, watch
 from kubernetes.stream import stream
 from kubernetes.client.exceptions import ApiException
-from tenacity import retry, retry_if_exception_type, wait_exponential, stop_after_attempt
+from tenacity import retry, retry_if_exception, wait_exponential, stop_after_attempt
 
-from dfsync.filters import GIT_FILTER
-from dfsync.kube_credentials import KubeContextConfig
+from dfsync.filters import GIT_FILTER, load_ignore_rules
+from dfsync.lib import ControlledThreadedOperation
+from dfsync.metrics import registry
+from dfsync.kube_credentials import CONNECTION_POOL_MAXSIZE, KubeContextConfig, list_kube_contexts
+from .kube_throttle import DEFAULT_QPS, RateMeter, SingleFlight, TokenBucket
 from .rsync import rsync_backend
+from .tar_stream import EMPTY_DIR_MARKER, get_empty_dir_check_command, stream_tree
 
+# Concurrent api calls of a single operation, the pooled api client has room for these plus the rollout watches
+MAX_CONCURRENT_CALLS = CONNECTION_POOL_MAXSIZE // 2
+# Pod watches are renewed from the last seen resourceVersion after this long
+POD_WATCH_TIMEOUT = 300
+DFSYNC_ANNOTATION = "dfsync.localgrid.io"
 DEFAULT_COMMAND = []
 DEFAULT_PULL_POLICY = "Always"
+PROBE_FIELDS = ("readiness_probe", "startup_probe", "liveness_probe")
 DISABLED_PROBES = {
     "readiness_probe": {
         "_exec": {"command": ["true"]},
@@ -164,6 +179,9 @@ class Generic:
         return ["true"]
 
 
+DISTROS = {distro.__name__: distro for distro in [Alpine, ELinuxOS, Ubuntu, Generic]}
+
+
 def clean_probe(probe: dict) -> client.V1Probe:
     if probe is None:
         return None
@@ -175,18 +193,64 @@ def clean_probe(probe: dict) -> client.V1Probe:
     return client.V1Probe(**cleaned)
 
 
+def _is_conflict(e: Exception):
+    return isinstance(e, ApiException) and e.status == 409
+
+
+def _is_retriable(e: Exception):
+    # Conflicts, throttling and server errors, other client errors (404, 403, 422, ...) fail right away
+    return isinstance(e, ApiException) and (e.status in (409, 429) or (e.status or 0) >= 500)
+
+
+_server_error_backoff = wait_exponential(multiplier=1, min=4, max=10)
+
+
+def _retry_wait(retry_state):
+    # Conflicts are retried at once, on the latest version of the object
+    if _is_conflict(retry_state.outcome.exception()):
+        return 0
+    return _server_error_backoff(retry_state)
+
+
+@functools.lru_cache(maxsize=None)
+def _serializer():
+    return client.ApiClient()
+
+
+class _JsonResponse:
+    """
+    Minimal response, for deserializing already parsed json with the kubernetes ApiClient
+    """
+
+    def __init__(self, data):
+        self.data = json.dumps(data)
+
+
+def resources_patch(original, edited):
+    """
+    Strategic-merge patch from the original to the edited container resources, removed keys are set to None
+    """
+    patch = {}
+    for key in ["limits", "requests"]:
+        before = (getattr(original, key, None) if original else None) or {}
+        after = (getattr(edited, key, None) if edited else None) or {}
+        patch[key] = {**{k: None for k in before if k not in after}, **after}
+    return patch
+
+
 def please_wait(msg="Please wait"):
     print("⌛  {}...".format(msg))
 
 
-def get_selected_kubernetes(kube_host=None) -> KubeContextConfig:
+def get_selected_kubernetes(kube_host=None, config_file: str = None) -> KubeContextConfig:
+    # Hosts are matched on the parsed kube config, only the selected context gets loaded
     try:
-        config.load_kube_config()
+        contexts, active_context_name = list_kube_contexts(config_file)
     except Exception as e:
         error_message = str(e)
         print(f"Failed to load default kube config: {error_message}")
+        contexts, active_context_name = [], None
 
-    contexts, active_context = config.list_kube_config_contexts()
     if not contexts:
         raise ValueError("Cannot find any kubernetes contexts in kube-config file")
 
@@ -196,14 +260,14 @@ def get_selected_kubernetes(kube_host=None) -> KubeContextConfig:
     multiple_matches = False
 
     for c in contexts:
-        k8sctx = KubeContextConfig(c["name"])
+        k8sctx = KubeContextConfig(c["name"], server=c["server"], config_file=config_file)
         k8sctx_configs.append(k8sctx)
 
-        if k8sctx.context_name == active_context["name"]:
+        if k8sctx.context_name == active_context_name:
             active_k8ctx = k8sctx
             k8sctx.is_active = True
 
-        if kube_host is not None and kube_host.lower() == k8sctx.host.lower():
+        if kube_host is not None and kube_host.lower() == (k8sctx.host or "").lower():
             if selected_k8ctx is None:
                 selected_k8ctx = k8sctx
                 k8sctx.is_selected = True
@@ -236,31 +300,106 @@ def get_selected_kubernetes(kube_host=None) -> KubeContextConfig:
     return selected_k8ctx
 
 
+class InstrumentedApi:
+    """
+    Wraps a kubernetes api object, the latency of every api call is recorded in the metrics registry.
+    Calls wait for the rate limiter, and concurrent identical raw (`_preload_content=False`) list calls share
+    a single request, each caller then deserializes its own objects from the shared response body.
+    """
+
+    def __init__(self, api, limiter: TokenBucket = None, meter: RateMeter = None, single_flight: SingleFlight = None):
+        self._api = api
+        self.limiter = limiter or TokenBucket(rate=0)
+        self.meter = meter or RateMeter()
+        self.single_flight = single_flight or SingleFlight()
+
+    def __getattr__(self, name):
+        attr = getattr(self._api, name)
+        if not callable(attr) or name.startswith("connect_"):
+            # kubernetes.stream.stream() needs the actual bound method of the exec calls
+            return attr
+
+        @functools.wraps(attr)
+        def timed_call(*args, **kwargs):
+            if name.startswith("list_") and kwargs.get("_preload_content") is False and not kwargs.get("watch"):
+                key = (name, repr(args), repr(sorted(kwargs.items())))
+                return self.single_flight.do(key, self._call, name, attr, args, kwargs, read_body=True)
+            return self._call(name, attr, args, kwargs)
+
+        return timed_call
+
+    def _call(self, name, attr, args, kwargs, read_body=False):
+        self.limiter.acquire()
+        self.meter.mark()
+        with registry.timer("kube_api", method=name):
+            response = attr(*args, **kwargs)
+            if read_body:
+                # Read once by the caller making the request, the callers sharing the response get the cached body
+                response.data
+            return response
+
+
 class KubeReDeployer:
-    def __init__(self, kube_host=None, pod_timeout=30, container_command=None, full_sync=True, **kwargs):
-        k8sctx = get_selected_kubernetes(kube_host)
+    # Each pod gets the created/modified files of a batch in a single rsync run
+    max_batch_size = 64
+
+    def __init__(
+        self,
+        kube_host=None,
+        pod_timeout=30,
+        container_command=None,
+        full_sync=True,
+        adaptive_transfer=True,
+        sync_jobs=1,
+        k8sctx: KubeContextConfig = None,
+        state=None,
+        namespace: str = None,
+        label_selector: str = None,
+        field_selector: str = None,
+        kube_qps: float = None,
+        **kwargs,
+    ):
+        k8sctx = k8sctx or get_selected_kubernetes(kube_host)
 
         self.context_name = k8sctx.context_name
-        self.api = k8sctx.core_v1_api()
-        self.apps_api = k8sctx.apps_v1_api()
+        # A single limiter for all the api calls of the session, execs included
+        self.limiter = TokenBucket(rate=DEFAULT_QPS if kube_qps is None else kube_qps)
+        self.meter = RateMeter()
+        single_flight = SingleFlight()
+        self.api = InstrumentedApi(k8sctx.core_v1_api(), self.limiter, self.meter, single_flight)
+        self.apps_api = InstrumentedApi(k8sctx.apps_v1_api(), self.limiter, self.meter, single_flight)
+        registry.gauge("kube_api_qps", context=self.context_name).set_function(lambda: self.meter.rate)
+        registry.gauge("kube_api_throttled_seconds", context=self.context_name).set_function(
+            lambda: self.limiter.throttled_seconds
+        )
+        registry.gauge("kube_api_coalesced_calls", context=self.context_name).set_function(
+            lambda: single_flight.coalesced
+        )
 
         print(f"Using cluster: {k8sctx.prettified_str}")
-        self.rsync_backend_instance = rsync_backend()
+        self.rsync_backend_instance = rsync_backend(adaptive_transfer=adaptive_transfer, sync_jobs=sync_jobs)
         self._image_distro = None
+        self._image_distros = {}
+        self._rsync_ready_containers = set()
+        self._exec_apis = threading.local()
+        self.state = state
+        self.namespace = namespace
+        self.label_selector = label_selector
+        self.field_selector = field_selector
+        self._image_index = {}
         self.pod_timeout = pod_timeout
         self.container_command = container_command
         self._full_sync = full_sync
         self._pod_blacklist = set()
+        self._pod_watchers = []
+        self._resync_executor = None
+        self._resync_target = None
 
-    def supervisor_install(self, pod, spec, status):
-        if self._is_supervised(pod, spec, status):
-            return
-
+    def supervisor_install(self, namespace, specs):
         command = self._image_distro.get_supervise_command(self.container_command)
-        deployments = self._edit_deployment(
-            pod,
-            spec,
-            status,
+        generations = self._edit_deployments(
+            namespace,
+            specs,
             command=command,
             image_pull_policy="Never",
             startup_probe=None,
@@ -268,88 +407,128 @@ class KubeReDeployer:
             liveness_probe=None,
         )
 
-        print("Supervisor installing on {}".format(" ".join(deployments)))
-
-    def supervisor_uninstall(self, pod, spec, status):
-        if not self._is_supervised(pod, spec, status):
-            return
+        print("Supervisor installing on {}".format(" ".join(generations)))
+        return generations
 
-        deployments = self._reset_deployment_command(pod, spec, status)
-        print("Supervisor uninstalling from {}".format(" ".join(deployments)))
+    def supervisor_uninstall(self, namespace, specs):
+        generations = self._edit_deployments(namespace, specs)
+        print("Supervisor uninstalling from {}".format(" ".join(generations)))
+        return generations
 
     def _set_dfsync_annotation(self, deployment, data: dict):
-        anno_key = "dfsync.localgrid.io"
         annotations = {**self._get_dfsync_annotation(deployment), **data}
-        deployment.metadata.annotations[anno_key] = json.dumps(annotations)
+        deployment.metadata.annotations = {**(deployment.metadata.annotations or {})}
+        deployment.metadata.annotations[DFSYNC_ANNOTATION] = json.dumps(annotations)
         return annotations
 
     def _get_dfsync_annotation(self, deployment):
-        anno_key = "dfsync.localgrid.io"
-        annotations_str = deployment.metadata.annotations.get(anno_key, "{}")
+        annotations_str = (deployment.metadata.annotations or {}).get(DFSYNC_ANNOTATION, "{}")
         return json.loads(annotations_str)
 
     def _reset_deployment_command(self, pod, spec, status):
         return self._edit_deployment(pod, spec, status)
 
-    @retry(
-        stop=stop_after_attempt(5),
-        wait=wait_exponential(multiplier=1, min=4, max=10),
-        retry=retry_if_exception_type(ApiException),
-        reraise=True,
-    )
     def _edit_deployment(self, pod, spec, status, **kwargs):
-        namespace = pod.metadata.namespace
-        deployments = {}
-        is_undo = len(kwargs) == 0
-        for deployment, container_spec in self.list_deployments(namespace, spec.image):
-            if spec.name != container_spec.name:
-                continue
+        return list(self._edit_deployments(pod.metadata.namespace, [spec], **kwargs))
+
+    def _edit_deployments(self, namespace, specs, **kwargs):
+        """
+        Edits the containers, of the deployments in the namespace, that run the given container specs. The deployments
+        are listed once and replaced concurrently, an empty kwargs restores the containers as they were before dfsync.
+        Returns a dict of deployment name: generation of the edited deployment
+        """
+        targets = {}
+        listed = {}
+        for deployment, container_spec in self.list_deployments(namespace, ""):
+            if any(s.name == container_spec.name and container_spec.image.startswith(s.image) for s in specs):
+                targets.setdefault(deployment.metadata.name, set()).add(container_spec.name)
+                listed[deployment.metadata.name] = deployment
+        if not len(targets):
+            return {}
+
+        with ThreadPoolExecutor(
+            max_workers=min(len(targets), MAX_CONCURRENT_CALLS), thread_name_prefix="dfsync-edit"
+        ) as executor:
+            edited = executor.map(
+                lambda item: self._patch_deployment(namespace, item[0], item[1], kwargs, listed), targets.items()
+            )
+            return {deployment.metadata.name: deployment.metadata.generation for deployment in edited}
+
+    @retry(stop=stop_after_attempt(5), wait=_retry_wait, retry=retry_if_exception(_is_retriable), reraise=True)
+    def _patch_deployment(self, namespace, name, container_names, edits: dict, listed: dict):
+        """
+        Strategic-merge patch of the edited container fields. The resourceVersion makes the patch fail with a conflict
+        when the deployment changed since it was read, the edits are then applied again, without waiting.
+        Throttled and server errors are retried with a backoff, other errors fail right away
+        """
+        # The listed deployment is only good for the first attempt, retries edit the latest version
+        deployment = listed.pop(name, None) or self.apps_api.read_namespaced_deployment(name, namespace)
+        containers = [
+            self._edit_container(deployment, container_spec, edits)
+            for container_spec in deployment.spec.template.spec.containers
+            if container_spec.name in container_names
+        ]
 
-            if is_undo:
-                kwargs = self._get_dfsync_annotation(deployment) or {"command": None}
+        metadata = {"resourceVersion": deployment.metadata.resource_version}
+        annotation = (deployment.metadata.annotations or {}).get(DFSYNC_ANNOTATION)
+        if annotation is not None:
+            metadata["annotations"] = {DFSYNC_ANNOTATION: annotation}
+        body = {"metadata": metadata, "spec": {"template": {"spec": {"containers": containers}}}}
+        return self.apps_api.patch_namespaced_deployment(name, namespace, body, _request_timeout=30)
+
+    def _edit_container(self, deployment, container_spec, edits: dict):
+        """
+        Applies the edits to the container spec, returns the strategic-merge patch of the edited fields
+        """
+        original_resources = copy.deepcopy(container_spec.resources)
+        is_undo = len(edits) == 0
+        if is_undo:
+            edits = self._get_dfsync_annotation(deployment) or {"command": None}
+        elif self._is_dfsync_command(container_spec.command):
+            # Already edited by dfsync, the annotation keeps the values from before the first edit
+            original = marshall_dfsync_annotation(container_spec, edits.keys())
+            self._set_dfsync_annotation(deployment, {**original, **self._get_dfsync_annotation(deployment)})
+        else:
+            self._set_dfsync_annotation(deployment, marshall_dfsync_annotation(container_spec, edits.keys()))
+
+        edited_fields = set(edits.keys())
+        for k, v in edits.items():
+            if is_undo and k == "command" and self._is_dfsync_command(v):
+                print("Clearing dfsync metadata annotations")
+                container_spec.image_pull_policy = DEFAULT_PULL_POLICY
+                container_spec.command = DEFAULT_COMMAND
+                container_spec.resources.limits = {}
+                container_spec.resources.requests = {}
+                edited_fields.update(["image_pull_policy", "resources"])
+            elif k in ["command"]:
+                # Yeah, None seems to be a special value that does not work as well as the empty list
+                container_spec.command = v or []
+            elif k == "resources":
+                existing_limits = container_spec.resources.limits or {}
+                new_limits = v.get("limits") or {}
+                container_spec.resources.limits = {**existing_limits, **new_limits}
+
+                existing_requests = container_spec.resources.requests or {}
+                new_requests = v.get("requests") or {}
+                container_spec.resources.requests = {**existing_requests, **new_requests}
+            elif k in PROBE_FIELDS:
+                setattr(container_spec, k, clean_probe(v or DISABLED_PROBES.get(k)))
             else:
-                self._set_dfsync_annotation(deployment, marshall_dfsync_annotation(container_spec, kwargs.keys()))
-
-            for k, v in kwargs.items():
-                if is_undo and k == "command" and self._is_dfsync_command(v):
-                    print("Clearing dfsync metadata annotations")
-                    container_spec.image_pull_policy = DEFAULT_PULL_POLICY
-                    container_spec.command = DEFAULT_COMMAND
-                    container_spec.resources.limits = {}
-                    container_spec.resources.requests = {}
-                elif k in ["command"]:
-                    # Yeah, None seems to be a special value that does not work as well as the empty list
-                    container_spec.command = v or []
-                elif k == "resources":
-                    existing_limits = container_spec.resources.limits or {}
-                    new_limits = v.get("limits") or {}
-                    container_spec.resources.limits = {**existing_limits, **new_limits}
-
-                    existing_requests = container_spec.resources.requests or {}
-                    new_requests = v.get("requests") or {}
-                    container_spec.resources.requests = {**existing_requests, **new_requests}
-                elif k in ["readiness_probe", "startup_probe", "liveness_probe"]:
-                    setattr(container_spec, k, clean_probe(v or DISABLED_PROBES.get(k)))
-                else:
-                    setattr(container_spec, k, v)
-
-            deployments[deployment.metadata.uid] = deployment
-
-        for _, deployment in deployments.items():
-            patch = client.V1Deployment(
-                api_version="apps/v1",
-                kind="Deployment",
-                metadata=deployment.metadata,
-                spec=deployment.spec,
-            )
-            self.apps_api.replace_namespaced_deployment(
-                name=deployment.metadata.name,
-                namespace=namespace,
-                body=patch,
-                async_req=False,
-                _request_timeout=30,
-            )
-        return [d.metadata.name for _, d in deployments.items()]
+                setattr(container_spec, k, v)
+
+        patch = {"name": container_spec.name}
+        for field in sorted(edited_fields):
+            key = client.V1Container.attribute_map[field]
+            if field == "resources":
+                patch[key] = resources_patch(original_resources, container_spec.resources)
+            elif field in PROBE_FIELDS and getattr(container_spec, field) is not None:
+                # Probes are replaced as a whole, merged maps would end up with two handlers (e.g. httpGet and exec)
+                probe = _serializer().sanitize_for_serialization(getattr(container_spec, field))
+                patch[key] = {**probe, "$patch": "replace"}
+            else:
+                # None removes the field
+                patch[key] = _serializer().sanitize_for_serialization(getattr(container_spec, field))
+        return patch
 
     def _is_dfsync_command(self, command, markers: list = None):
         if command is None:
@@ -443,17 +622,48 @@ class KubeReDeployer:
                     continue
                 yield deployment, container_spec
 
+    def list_pods(self, image_base):
+        """
+        Lists the pods, with the namespace and selectors pushed down to the API. The response is filtered
+        on the raw json, only the pods running a matching image are deserialized
+        """
+        selectors = {"label_selector": self.label_selector, "field_selector": self.field_selector}
+        selectors = {k: v for k, v in selectors.items() if v}
+        if self.namespace:
+            response = self.api.list_namespaced_pod(self.namespace, _preload_content=False, **selectors)
+        else:
+            response = self.api.list_pod_for_all_namespaces(watch=False, _preload_content=False, **selectors)
+
+        pod_list = json.loads(response.data)
+        pod_list["items"] = [pod for pod in pod_list.get("items") or [] if self._is_matching_pod(image_base, pod)]
+        return _serializer().deserialize(_JsonResponse(pod_list), "V1PodList")
+
+    def _is_matching_pod(self, image_base, pod: dict):
+        images = [c.get("image") for c in (pod.get("spec") or {}).get("containers") or []]
+        for status in (pod.get("status") or {}).get("containerStatuses") or []:
+            images.extend([status.get("image"), status.get("imageID")])
+        return any(self._is_matching_image(image_base, image) for image in images if image)
+
+    def _is_matching_image(self, image_base, image: str):
+        # Pods of the same deployment share their images, each distinct image string is only parsed once
+        key = (image_base, image)
+        is_matching = self._image_index.get(key)
+        if is_matching is None:
+            parsed = urlparse(image)
+            is_matching = image.startswith(image_base) or f"{parsed.netloc}{parsed.path}".startswith(image_base)
+            self._image_index[key] = is_matching
+        return is_matching
+
     def generate_matching_containers(self, image_base):
-        result = self.api.list_pod_for_all_namespaces(watch=False)
+        result = self.list_pods(image_base)
 
         for pod in result.items:
             for spec, status in self.list_containers(pod):
                 pod_images = [spec.image]
                 if status:
-                    parsed = urlparse(status.image_id)
-                    pod_images = [*pod_images, status.image, f"{parsed.netloc}{parsed.path}"]
+                    pod_images = [*pod_images, status.image, status.image_id]
 
-                if not any(i.startswith(image_base) for i in pod_images):
+                if not any(i and self._is_matching_image(image_base, i) for i in pod_images):
                     continue
                 yield pod, spec, status
 
@@ -472,7 +682,77 @@ class KubeReDeployer:
 
     def sync(self, src_file_path, destination_dir: str = None, **kwargs):
         image_base, destination_dir = self.split_destination(destination_dir)
+        is_full_sync = isinstance(src_file_path, (tuple, list)) or src_file_path == "./"
+        can_bulk_copy = is_full_sync and self._full_sync is not False
+
+        skipped = []
+        for pod, status, container_dir, is_empty in self.generate_syncable_containers(
+            image_base, destination_dir, src_file_path, can_bulk_copy=can_bulk_copy, skipped=skipped
+        ):
+            if self._full_sync is not False:
+                rsh_command, rsh_env = self.get_exec_command(pod.metadata.namespace, pod.metadata.name, status.name)
+                stats_key = f"kube://{pod.metadata.namespace}/{pod.metadata.name}:{container_dir}"
+                if is_empty:
+                    # Fresh pod, a single tar stream beats rsync's per file negotiation
+                    src_file_paths = src_file_path if isinstance(src_file_path, (tuple, list)) else [src_file_path]
+                    self.bulk_copy(pod, status, container_dir, src_file_paths)
+                    continue
+                self.sync_files(
+                    rsh_command, src_file_path, container_dir, rsh_env=rsh_env, stats_key=stats_key, **kwargs
+                )
+            else:
+                self._full_sync = None
+                skipped.append(pod)
+                print("Full Sync skipped")
+        return len(skipped) == 0
 
+    def sync_batch(self, changes, destination_dir: str = None, **kwargs):
+        image_base, destination_dir = self.split_destination(destination_dir)
+        changes = list(changes)
+        description = changes[0].path if len(changes) == 1 else "{} changes".format(len(changes))
+
+        skipped = []
+        for pod, status, container_dir, _ in self.generate_syncable_containers(
+            image_base, destination_dir, description, skipped=skipped
+        ):
+            rsh_command, rsh_env = self.get_exec_command(pod.metadata.namespace, pod.metadata.name, status.name)
+            self.rsync_backend_instance.sync_batch(
+                changes,
+                **kwargs,
+                destination_dir=":{}".format(container_dir),
+                rsh=rsh_command,
+                rsh_env=rsh_env,
+                blocking_io=True,
+                stats_key=f"kube://{pod.metadata.namespace}/{pod.metadata.name}:{container_dir}",
+            )
+        return len(skipped) == 0
+
+    def verify_project(self, src_file_paths, destination_dir: str = None, **kwargs):
+        image_base, destination_dir = self.split_destination(destination_dir)
+
+        divergent = 0
+        for pod, status, container_dir, _ in self.generate_syncable_containers(image_base, destination_dir, "Verify"):
+            rsh_command, rsh_env = self.get_exec_command(pod.metadata.namespace, pod.metadata.name, status.name)
+            divergent += self.rsync_backend_instance.verify_project(
+                src_file_paths,
+                **kwargs,
+                destination_dir=":{}".format(container_dir),
+                rsh=rsh_command,
+                rsh_env=rsh_env,
+                blocking_io=True,
+                stats_key=f"kube://{pod.metadata.namespace}/{pod.metadata.name}:{container_dir}",
+            )
+        return divergent
+
+    def generate_syncable_containers(
+        self, image_base, destination_dir, description, can_bulk_copy=False, skipped: list = None
+    ):
+        """
+        Yields the (pod, status, container dir, is empty) of the ready containers. Containers are checked for
+        rsync, unless bulk copies are allowed and their destination dir is empty (is empty is False otherwise).
+        The pods of the containers left out (not ready, or without rsync) are appended to `skipped`
+        """
+        skipped = skipped if skipped is not None else []
         for pod, spec, status in self.generate_matching_containers(image_base):
             if pod.metadata.name in self._pod_blacklist:
                 continue
@@ -484,21 +764,137 @@ class KubeReDeployer:
                     reason = "Terminated - ".format(status.state.terminated.reason)
 
                 print(
-                    "{} will not sync in {}, container isn't ready: {}".format(src_file_path, pod.metadata.name, reason)
+                    "{} will not sync in {}, container isn't ready: {}".format(description, pod.metadata.name, reason)
                 )
+                skipped.append(pod)
+                continue
+
+            container_dir = self.get_container_destination_dir(pod, status, destination_dir)
+            if can_bulk_copy and self.is_empty_destination(pod, spec, status, container_dir):
+                yield pod, status, container_dir, True
                 continue
 
             if not self.dry_run_exec(pod, spec, status):
-                print("{} failed to rsync into {}".format(src_file_path, pod.metadata.name))
+                # Pods are replaced by every rollout, the metric is per namespace, the pod name is logged
+                registry.counter("pod_sync_failures", namespace=pod.metadata.namespace).inc()
+                logging.info(f"rsync is not available in {pod.metadata.namespace}/{pod.metadata.name}")
+                print("{} failed to rsync into {}".format(description, pod.metadata.name))
+                skipped.append(pod)
                 continue
 
-            if self._full_sync is not False:
-                container_dir = self.get_container_destination_dir(pod, status, destination_dir)
+            yield pod, status, container_dir, False
+
+    def bulk_copy(self, pod, status, container_dir, src_file_paths):
+        print("Bulk copying into the empty {} of {}".format(container_dir, pod.metadata.name))
+        rsh_command, rsh_env = self.get_exec_command(pod.metadata.namespace, pod.metadata.name, status.name)
+        stream_tree(
+            src_file_paths,
+            container_dir,
+            rsh=rsh_command,
+            rsh_env=rsh_env,
+            ignore_rules=load_ignore_rules(src_file_paths),
+            stats_key=f"kube://{pod.metadata.namespace}/{pod.metadata.name}:{container_dir}",
+        )
+
+    def resync_container(self, pod, spec, status, src_file_paths, destination_dir):
+        """
+        Brings a new or restarted container up to date: a bulk copy when its destination dir is empty,
+        otherwise an rsync verify, which only transfers the files that differ. The files baked in the image
+        can have the same size as the edited ones, the verify compares checksums
+        """
+        container_dir = self.get_container_destination_dir(pod, status, destination_dir)
+        with registry.timer("pod_resync"):
+            if self.is_empty_destination(pod, spec, status, container_dir):
+                self.bulk_copy(pod, status, container_dir, src_file_paths)
+            elif self.dry_run_exec(pod, spec, status):
                 rsh_command, rsh_env = self.get_exec_command(pod.metadata.namespace, pod.metadata.name, status.name)
-                self.sync_files(rsh_command, src_file_path, container_dir, rsh_env=rsh_env, **kwargs)
+                self.rsync_backend_instance.verify_project(
+                    src_file_paths,
+                    destination_dir=":{}".format(container_dir),
+                    rsh=rsh_command,
+                    rsh_env=rsh_env,
+                    blocking_io=True,
+                    checksum=True,
+                    stats_key=f"kube://{pod.metadata.namespace}/{pod.metadata.name}:{container_dir}",
+                )
             else:
-                self._full_sync = None
-                print("Full Sync skipped")
+                registry.counter("pod_sync_failures", namespace=pod.metadata.namespace).inc()
+                logging.info(f"rsync is not available in {pod.metadata.namespace}/{pod.metadata.name}")
+                print("Failed to resync {}, rsync is not available".format(pod.metadata.name))
+                return
+        registry.counter("pod_resyncs").inc()
+
+    def start_pod_watch(self, image_base, src_file_paths, destination_dir):
+        """
+        Watches the matching pods, new pods and restarted containers are resynced in the background
+        without holding up the syncs to the other pods. Only the namespaces of the matching pods are watched
+        (or the configured namespace), with one long-lived watch each
+        """
+        matching = list(self.generate_matching_containers(image_base))
+        known = {
+            (pod.metadata.namespace, pod.metadata.name, spec.name): status.container_id
+            for pod, spec, status in matching
+            if spec is not None and status is not None and status.ready
+        }
+        namespaces = {self.namespace} if self.namespace else {pod.metadata.namespace for pod, _, _ in matching}
+        if not namespaces:
+            return
+
+        self._resync_executor = ThreadPoolExecutor(
+            max_workers=MAX_CONCURRENT_CALLS // 2, thread_name_prefix="dfsync-resync"
+        )
+        self._resync_target = (src_file_paths, destination_dir)
+        self._pod_watchers = [PodWatcher(self, image_base, namespace, known) for namespace in sorted(namespaces)]
+        for pod_watcher in self._pod_watchers:
+            pod_watcher.start()
+
+    def schedule_resync(self, pod, spec, status):
+        if self._resync_executor is not None:
+            self._resync_executor.submit(self._resync_in_background, pod, spec, status)
+
+    def _resync_in_background(self, pod, spec, status):
+        try:
+            self.resync_container(pod, spec, status, *self._resync_target)
+        except Exception as e:
+            registry.counter("pod_sync_failures", namespace=pod.metadata.namespace).inc()
+            logging.debug(f"Failed to resync {pod.metadata.namespace}/{pod.metadata.name}", exc_info=e)
+            print("Failed to resync {}: {}".format(pod.metadata.name, e))
+
+    def stop_pod_watch(self):
+        for pod_watcher in self._pod_watchers:
+            pod_watcher.stop()
+        self._pod_watchers = []
+        if self._resync_executor is not None:
+            self._resync_executor.shutdown(wait=True)
+            self._resync_executor = None
+
+    def watch_pods(self, namespace, resource_version=None, timeout_seconds=POD_WATCH_TIMEOUT, on_response=None):
+        """
+        Returns a (watch, event stream) tuple of the pods of a namespace, `on_response` gets the streamed
+        http response, closing it interrupts the stream
+        """
+        selectors = {"label_selector": self.label_selector, "field_selector": self.field_selector}
+        selectors = {k: v for k, v in selectors.items() if v}
+        list_pods = self.api.list_namespaced_pod
+
+        @functools.wraps(list_pods)
+        def watched_call(*args, **kwargs):
+            response = list_pods(*args, **kwargs)
+            if on_response is not None:
+                on_response(response)
+            return response
+
+        w = watch.Watch()
+        stream = w.stream(
+            watched_call, namespace, resource_version=resource_version, timeout_seconds=timeout_seconds, **selectors
+        )
+        return w, stream
+
+    def is_empty_destination(self, pod, spec, status, container_dir):
+        try:
+            return EMPTY_DIR_MARKER in self._exec(pod, spec, status, get_empty_dir_check_command(container_dir))
+        except:
+            return False
 
     def sync_files(self, rsh_command, src_file, destination_dir: str = None, **kwargs):
         rsh_destination = ":{}".format(destination_dir)
@@ -519,17 +915,30 @@ class KubeReDeployer:
         if not status:
             raise ValueError(f"Pod {spec.name} does not have a container")
 
-        return stream(
-            self.api.connect_get_namespaced_pod_exec,
-            pod.metadata.name,
-            pod.metadata.namespace,
-            container=status.name,
-            command=command,
-            stdin=False,
-            stdout=True,
-            stderr=True,
-            tty=False,
-        )
+        self.limiter.acquire()
+        self.meter.mark()
+        with registry.timer("remote_exec"):
+            return stream(
+                self._exec_api().connect_get_namespaced_pod_exec,
+                pod.metadata.name,
+                pod.metadata.namespace,
+                container=status.name,
+                command=command,
+                stdin=False,
+                stdout=True,
+                stderr=True,
+                tty=False,
+            )
+
+    def _exec_api(self):
+        # kubernetes.stream.stream() swaps the request method of the api client for the duration of the exec,
+        # concurrent execs each use their own shallow copy of the client, the connection pool stays shared
+        api = getattr(self._exec_apis, "api", None)
+        if api is None:
+            api = copy.copy(self.api._api)
+            api.api_client = copy.copy(api.api_client)
+            self._exec_apis.api = api
+        return api
 
     def _uncrash(self, pod, spec, status):
         if status and status.ready:
@@ -549,28 +958,45 @@ class KubeReDeployer:
         )
 
         please_wait()
-        w = watch.Watch()
-        for event in w.stream(self.api.list_pod_for_all_namespaces, timeout_seconds=30):
-            event_pod = event["object"]
-            if pod.metadata.name != event_pod.metadata.name:
-                continue
-            for event_status in event_pod.status.container_statuses or []:
-                if event_status.container_id == status.container_id:
-                    if event["type"] == "DELETED":
-                        print("Deployment recovered".format(pod.metadata.name))
-                        w.stop()
-                        return True
+        if self._wait_for_replacement(pod, spec, timeout=30):
+            print("Deployment of pod {} recovered".format(pod.metadata.name))
+            return True
 
         print("Pod {} recovery failed".format(pod.metadata.name))
         deployments = self._reset_deployment_command(pod, spec, status)
         return False
 
-    def _stabilize(self, pod, spec, status):
+    def _wait_for_replacement(self, pod, spec, timeout=30):
+        """
+        Watches the pods of the deployment of the given pod, until a replacement pod running the uncrash command is ready
+        """
+        w = watch.Watch()
+        for event in w.stream(
+            self.api.list_namespaced_pod,
+            pod.metadata.namespace,
+            label_selector=get_deployment_label_selector(pod),
+            timeout_seconds=timeout,
+        ):
+            new_pod = event["object"]
+            if event["type"] == "DELETED" or new_pod.metadata.deletion_timestamp is not None:
+                continue
+            if new_pod.metadata.name == pod.metadata.name:
+                continue
+
+            for new_spec, new_status in self.list_containers(new_pod):
+                if new_spec is None or new_spec.name != spec.name or not self._is_uncrashed(new_pod, new_spec, None):
+                    continue
+                if new_status and new_status.ready:
+                    w.stop()
+                    return True
+        return False
+
+    def _can_exec(self, pod, spec, status):
         try:
-            resp = self._exec(pod, spec, status, Generic.check_can_exec())
-            return
+            self._exec(pod, spec, status, Generic.check_can_exec())
+            return True
         except:
-            self._uncrash(pod, spec, status)
+            return False
 
     def _sniff_image_distro(self, pod, spec, status):
         for distro in [Alpine, ELinuxOS, Ubuntu]:
@@ -587,6 +1013,9 @@ class KubeReDeployer:
         return Generic
 
     def dry_run_exec(self, pod, spec, status):
+        # Checked once per container, a restarted container gets a new id and is checked again
+        if status.container_id and status.container_id in self._rsync_ready_containers:
+            return True
         try:
             resp = self._exec(pod, spec, status, self._image_distro.check_rsync())
             if _is_command_not_found(resp):
@@ -595,68 +1024,140 @@ class KubeReDeployer:
                 if _is_command_not_found(resp):
                     return False
 
-            return len(resp) > 0
+            if len(resp) == 0:
+                return False
+            self._rsync_ready_containers.add(status.container_id)
+            return True
         except:
             return False
 
     def stabilize_deployments(self, image_base):
-        # Uncrash crashed deployments
-        for pod, spec, status in self.generate_matching_containers(image_base):
-            self._stabilize(pod, spec, status)
+        # Uncrash crashed deployments, the pods are checked and recovered concurrently
+        containers = list(self.generate_matching_containers(image_base))
+        if not len(containers):
+            return
+
+        with ThreadPoolExecutor(
+            max_workers=min(len(containers), MAX_CONCURRENT_CALLS), thread_name_prefix="dfsync-stabilize"
+        ) as executor:
+            can_exec = list(executor.map(lambda c: self._can_exec(*c), containers))
+
+            # A single recovery per deployment, its crashing pods are all replaced by the same rollout
+            crashing = {}
+            for (pod, spec, status), is_healthy in zip(containers, can_exec):
+                if not is_healthy:
+                    crashing.setdefault(
+                        (pod.metadata.namespace, get_deployment_label_selector(pod)), (pod, spec, status)
+                    )
+            return list(executor.map(lambda c: self._uncrash(*c), crashing.values()))
 
     def inspect_deployment_images(self, image_base):
-        distros = set()
+        # The replicas of a deployment run the same image, one pod per distinct image is probed
+        representatives = {}
         for pod, spec, status in self.generate_matching_containers(image_base):
-            distro = self._sniff_image_distro(pod, spec, status)
-            distros.add(distro)
+            image_id = status.image_id if status and status.image_id else spec.image
+            representatives.setdefault(image_id, (pod, spec, status))
+
+        distros = {}
+        for image_id in representatives:
+            distro = self._image_distros.get(image_id)
+            if distro is None and self.state is not None:
+                distro = DISTROS.get(self.state.get_image_distro(image_id))
+            if distro is not None:
+                distros[image_id] = distro
+
+        unknown = [image_id for image_id in representatives if image_id not in distros]
+        if len(unknown):
+            with ThreadPoolExecutor(
+                max_workers=min(len(unknown), MAX_CONCURRENT_CALLS), thread_name_prefix="dfsync-probe"
+            ) as executor:
+                probed = executor.map(lambda image_id: self._sniff_image_distro(*representatives[image_id]), unknown)
+                distros.update(zip(unknown, probed))
+
+        for image_id, distro in distros.items():
+            if distro is Generic:
+                # Detection failed, e.g. the pod was not ready yet, try again next time
+                continue
+            self._image_distros[image_id] = distro
+            if self.state is not None and image_id in unknown:
+                self.state.set_image_distro(image_id, distro.__name__)
 
         if not len(distros):
             self._image_distro = Generic
             return
 
-        self._image_distro = list(distros)[0]
+        self._image_distro = distros[next(iter(representatives))]
         print(f"Assuming OS in container image: {self._image_distro.name()}")
 
     def toggle_supervisor(self, image_base, action="install", skip_cleanup=True):
-        pods = {}
-
+        # Group the containers to edit per namespace, each namespace is then listed once
+        targets = {}
+        matched = False
         for pod, spec, status in self.generate_matching_containers(image_base):
-            if action == "install":
-                self.supervisor_install(pod, spec, status)
-            else:
-                self.supervisor_uninstall(pod, spec, status)
-            pods[pod.metadata.name] = pod
+            matched = True
+            if self._is_supervised(pod, spec, status) != (action == "install"):
+                targets.setdefault(pod.metadata.namespace, []).append((pod, spec))
 
-        if not len(pods):
+        if not matched:
             print(f"None of the deployment containers match the given image ({image_base})")
             return
+        if not len(targets):
+            return
 
-        please_wait()
-        w = watch.Watch()
-        cleanup_started = False
-        for event in w.stream(self.api.list_pod_for_all_namespaces, timeout_seconds=self.pod_timeout):
-            pod = event["object"]
-            if pod.metadata.name not in pods:
-                continue
-
-            if event["type"] != "ADDED" and not cleanup_started:
-                please_wait("Cleaning up")
-                cleanup_started = True
+        toggle = self.supervisor_install if action == "install" else self.supervisor_uninstall
+        with ThreadPoolExecutor(
+            max_workers=min(len(targets), MAX_CONCURRENT_CALLS), thread_name_prefix="dfsync-toggle"
+        ) as executor:
+            edited = executor.map(lambda item: (item[0], toggle(item[0], [s for _, s in item[1]])), targets.items())
+            generations = dict(edited)
 
-            if event["type"] == "DELETED" or (cleanup_started and skip_cleanup):
-                self._pod_blacklist.add(pod.metadata.name)
-                if pod.metadata.name in pods:
-                    del pods[pod.metadata.name]
+        please_wait()
+        pending = self.wait_for_rollouts(generations, skip_cleanup=skip_cleanup)
+        for namespace, containers in targets.items():
+            # The pods of the edited deployments are being replaced
+            self._pod_blacklist.update(pod.metadata.name for pod, _ in containers)
 
-            if len(pods) == 0:
-                w.stop()
-        if len(pods) > 0:
-            pod_keys = ", ".join(pods.keys())
+        if len(pending) > 0:
             print(
-                f"Time-out ({self.pod_timeout}s) waiting for pods: {pod_keys}\n"
+                f"Time-out ({self.pod_timeout}s) waiting for deployments: {', '.join(pending)}\n"
                 f"Increasing the pod reconfiguration timeout using --pod-timeout={self.pod_timeout+60} might help"
             )
 
+    def wait_for_rollouts(self, generations: dict, skip_cleanup=True):
+        """
+        Waits for the edited deployments ({namespace: {name: generation}}) to roll out, with one scoped watch
+        per namespace. Returns the names of the deployments still rolling out after the pod timeout
+        """
+        generations = {namespace: names for namespace, names in generations.items() if len(names)}
+        if not len(generations):
+            return []
+
+        with ThreadPoolExecutor(
+            max_workers=min(len(generations), MAX_CONCURRENT_CALLS), thread_name_prefix="dfsync-watch"
+        ) as executor:
+            pending = executor.map(
+                lambda item: self._watch_rollouts(item[0], item[1], skip_cleanup), generations.items()
+            )
+            return [name for names in pending for name in names]
+
+    def _watch_rollouts(self, namespace, generations: dict, skip_cleanup=True):
+        pending = dict(generations)
+        selectors = {}
+        if len(pending) == 1:
+            selectors["field_selector"] = f"metadata.name={next(iter(pending))}"
+
+        w = watch.Watch()
+        for event in w.stream(
+            self.apps_api.list_namespaced_deployment, namespace, timeout_seconds=self.pod_timeout, **selectors
+        ):
+            deployment = event["object"]
+            name = deployment.metadata.name
+            if name in pending and is_rolled_out(deployment, pending[name], skip_cleanup):
+                del pending[name]
+            if len(pending) == 0:
+                w.stop()
+        return list(pending)
+
     def on_monitor_start(
         self, src_file_paths: list = None, destination_dir: str = None, supervisor: bool = True, **kwargs
     ):
@@ -670,17 +1171,121 @@ class KubeReDeployer:
         for p in src_file_paths:
             GIT_FILTER.load_ignored_files(p)
         self.sync(src_file_paths, destination_dir, **kwargs)
+        self.start_pod_watch(image_base, src_file_paths, self.split_destination(destination_dir)[1])
 
     def sync_project(self, src_file_paths, **kwargs):
-        self.sync(src_file_paths, **kwargs)
+        return self.sync(src_file_paths, **kwargs)
 
     def on_monitor_exit(self, destination_dir: str = None, supervisor: bool = True, **kwargs):
         image_base, _ = self.split_destination(destination_dir)
+        self.stop_pod_watch()
         if supervisor:
             self.toggle_supervisor(image_base, "uninstall")
         self.status(image_base)
 
 
+class PodWatcher(ControlledThreadedOperation):
+    """
+    Follows the pod watch stream, every container that shows up ready with a new container id (a new pod,
+    or a restarted container which lost the synced files) is scheduled for a resync
+    """
+
+    def __init__(self, deployer: KubeReDeployer, image_base: str, namespace: str, known_containers: dict):
+        super().__init__()
+        self.deployer = deployer
+        self.image_base = image_base
+        self.namespace = namespace
+        self.known_containers = known_containers
+        self._watch = None
+        self._response = None
+
+    def stop(self, *args, **kwargs):
+        super().stop(*args, **kwargs)
+        if self._watch is not None:
+            self._watch.stop()
+        if self._response is not None:
+            # The long-lived watch would otherwise block until its next event or time-out
+            self._response.close()
+
+    def run(self):
+        resource_version = None
+        while self._running:
+            try:
+                resource_version = self._follow(resource_version)
+            except ApiException as e:
+                if e.status == 410:
+                    # Too old, start over from the current state
+                    resource_version = None
+                else:
+                    time.sleep(1.0)
+            except Exception as e:
+                if self._running:
+                    logging.debug(f"Pod watch of {self.namespace} failed", exc_info=e)
+                    time.sleep(1.0)
+
+    def _set_response(self, response):
+        self._response = response
+        if not self._running:
+            response.close()
+
+    def _follow(self, resource_version):
+        self._watch, stream = self.deployer.watch_pods(self.namespace, resource_version, on_response=self._set_response)
+        for event in stream:
+            if not self._running:
+                self._watch.stop()
+                break
+            pod = event["object"]
+            resource_version = pod.metadata.resource_version or resource_version
+            self.on_pod_event(event["type"], pod)
+        return resource_version
+
+    def on_pod_event(self, event_type, pod):
+        pod_key = (pod.metadata.namespace, pod.metadata.name)
+        if event_type == "DELETED" or pod.metadata.deletion_timestamp is not None:
+            for key in [k for k in self.known_containers if k[:2] == pod_key]:
+                del self.known_containers[key]
+            return
+        if pod.metadata.name in self.deployer._pod_blacklist:
+            return
+
+        for spec, status in self.deployer.list_containers(pod):
+            if spec is None or status is None or not status.ready or not status.container_id:
+                continue
+            images = [spec.image, status.image, status.image_id]
+            if not any(i and self.deployer._is_matching_image(self.image_base, i) for i in images):
+                continue
+
+            key = (*pod_key, spec.name)
+            if self.known_containers.get(key) == status.container_id:
+                continue
+            self.known_containers[key] = status.container_id
+            print("Container {} of {} started, resyncing it".format(spec.name, pod.metadata.name))
+            self.deployer.schedule_resync(pod, spec, status)
+
+
+def get_deployment_label_selector(pod):
+    """
+    Label selector of the pods of the same deployment (i.e. the pod labels, without the replica set specific hash)
+    """
+    labels = pod.metadata.labels or {}
+    return ",".join(f"{k}={v}" for k, v in sorted(labels.items()) if k != "pod-template-hash") or None
+
+
+def is_rolled_out(deployment, generation: int, skip_cleanup: bool = True):
+    """
+    Same checks as `kubectl rollout status`, skip_cleanup does not wait for the old pods to terminate
+    """
+    status = deployment.status
+    if status is None or (status.observed_generation or 0) < (generation or 0):
+        return False
+
+    replicas = deployment.spec.replicas if deployment.spec.replicas is not None else 1
+    updated = status.updated_replicas or 0
+    if updated < replicas or (status.available_replicas or 0) < updated:
+        return False
+    return skip_cleanup or (status.replicas or 0) <= updated
+
+
 def marshall_dfsync_annotation(container_spec, property_keys):
     return {k: marshall_spec_property(container_spec, k) for k in property_keys}
 
@@ -0,0 +1,109 @@
+import collections
+import threading
+import time
+
+# Sustained rate of kube API calls of a dfsync session, twice as many calls can go in a burst (e.g. on startup)
+DEFAULT_QPS = 20.0
+
+
+class TokenBucket:
+    """
+    Client side rate limiter, `acquire` blocks until a token is available. Tokens are refilled at `rate` per second,
+    up to `burst` tokens (twice the rate by default). A rate of 0 (or None) disables the limit.
+    """
+
+    def __init__(self, rate: float = DEFAULT_QPS, burst: int = None):
+        self.rate = rate or 0
+        self.burst = max(1, burst or int(2 * self.rate))
+        self.throttled_seconds = 0.0
+
+        self._lock = threading.Lock()
+        self._tokens = float(self.burst)
+        self._updated = time.monotonic()
+
+    def acquire(self):
+        if self.rate <= 0:
+            return 0.0
+
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+            # Reserve the token now, callers that have to wait are served in order
+            self._tokens -= 1
+            delay = -self._tokens / self.rate if self._tokens < 0 else 0.0
+            self.throttled_seconds += delay
+        if delay > 0:
+            time.sleep(delay)
+        return delay
+
+
+class RateMeter:
+    """
+    Calls per second over the last `window` seconds
+    """
+
+    def __init__(self, window: float = 10.0):
+        self.window = window
+        self._lock = threading.Lock()
+        self._calls = collections.deque()
+
+    def mark(self):
+        now = time.monotonic()
+        with self._lock:
+            self._calls.append(now)
+            self._expire(now)
+
+    def _expire(self, now):
+        while self._calls and self._calls[0] < now - self.window:
+            self._calls.popleft()
+
+    @property
+    def rate(self):
+        with self._lock:
+            self._expire(time.monotonic())
+            return len(self._calls) / self.window
+
+
+class _Call:
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent identical calls, the callers that arrive while a call is in flight get its result
+    (or its exception) instead of making the same call again
+    """
+
+    def __init__(self):
+        self.coalesced = 0
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, function, *args, **kwargs):
+        with self._lock:
+            call = self._calls.get(key)
+            is_leader = call is None
+            if is_leader:
+                call = self._calls[key] = _Call()
+            else:
+                self.coalesced += 1
+
+        if not is_leader:
+            call.done.wait()
+        else:
+            try:
+                call.result = function(*args, **kwargs)
+            except Exception as e:
+                call.error = e
+            finally:
+                with self._lock:
+                    del self._calls[key]
+                call.done.set()
+
+        if call.error is not None:
+            raise call.error
+        return call.result
@@ -0,0 +1,126 @@
+import logging
+from collections import namedtuple
+from importlib import metadata
+from typing import Iterable, Optional, Protocol, runtime_checkable
+
+ENTRY_POINT_GROUP = "dfsync.backends"
+
+# Change kinds, same values as the watchdog event types
+CREATED = "created"
+MODIFIED = "modified"
+DELETED = "deleted"
+MOVED = "moved"
+
+# path is relative to the watched dir, dest_path is only set for moves, size and mtime_ns are None for deletes
+ChangeRecord = namedtuple("ChangeRecord", ("kind", "path", "dest_path", "size", "mtime_ns"))
+
+
+@runtime_checkable
+class SyncBackend(Protocol):
+    """
+    Interface of the sync backends, a backend class is instantiated once with the sync options
+    (destination_dir, full_sync, sync_jobs, state, ...) and then receives the same options on every call.
+    The sync calls return False when some of the destinations were left out (e.g. pods that are not ready),
+    the changes are then not recorded as synced. Backends that sync in the background may return
+    a concurrent.futures.Future of that result instead, the changes are recorded once it resolves.
+    """
+
+    def sync(self, src_file_path: str, event=None, watched_dir: Optional[str] = None, **kwargs):
+        """Sync a single file, path relative to watched_dir"""
+
+    def sync_project(self, src_file_paths: list, **kwargs):
+        """Sync the whole source dirs, the `preempt` option may be used to interrupt it"""
+
+    def on_monitor_start(self, src_file_paths: list = None, **kwargs):
+        pass
+
+    def on_monitor_exit(self, **kwargs):
+        pass
+
+
+@runtime_checkable
+class BatchSyncBackend(SyncBackend, Protocol):
+    """
+    A backend that syncs a whole set of changes in one go. The monitor hands it up to `max_batch_size`
+    changes at once instead of calling `sync` for each of them, larger change sets still get a full sync.
+    """
+
+    max_batch_size: int
+
+    def sync_batch(self, changes: Iterable[ChangeRecord], watched_dir: Optional[str] = None, **kwargs):
+        """Sync the changes, paths relative to watched_dir"""
+
+
+@runtime_checkable
+class VerifiableBackend(SyncBackend, Protocol):
+    """
+    A backend that can compare its destination with the sources and resync only the files that drifted
+    """
+
+    def verify_project(self, src_file_paths: list, checksum: bool = False, **kwargs) -> int:
+        """
+        Returns the number of files that were out of sync, the `preempt` option may be used to interrupt it.
+        The resync of the divergent files and its output happen under the `output_lock` option, if given
+        """
+
+
+def is_synced(result) -> bool:
+    """Whether the result of a sync call means that every destination got the changes"""
+    return result is not False
+
+
+def supports_verify(backend) -> bool:
+    return callable(getattr(backend, "verify_project", None))
+
+
+def supports_batches(backend) -> bool:
+    return callable(getattr(backend, "sync_batch", None))
+
+
+def sync_changes(backend, changes: Iterable[ChangeRecord], watched_dir: Optional[str] = None, **kwargs):
+    """
+    Syncs the changes with `sync_batch` when the backend supports it, otherwise one `sync` call at a time
+    """
+    if supports_batches(backend):
+        return backend.sync_batch(changes, watched_dir=watched_dir, **kwargs)
+
+    synced = True
+    for change in changes:
+        # Backends tell deleted from changed files by checking if they still exist
+        synced = is_synced(backend.sync(change.path, watched_dir=watched_dir, **kwargs)) and synced
+        if change.kind == MOVED:
+            synced = is_synced(backend.sync(change.dest_path, watched_dir=watched_dir, **kwargs)) and synced
+    return synced
+
+
+def load_backends(builtin_backends: dict = None) -> dict:
+    """
+    Returns a dict of name: backend class, of the given built-in backends and of the backends registered
+    by installed packages under the "dfsync.backends" entry point group, e.g. in pyproject.toml:
+
+        [tool.poetry.plugins."dfsync.backends"]
+        "my-backend" = "my_package.backend:MyBackend"
+
+    Backends that fail to load are left out with a warning.
+    """
+    backends = dict(builtin_backends or {})
+    for entry_point in _entry_points(ENTRY_POINT_GROUP):
+        if entry_point.name in backends and entry_point.value == _qualified_name(backends[entry_point.name]):
+            continue
+        try:
+            backends[entry_point.name] = entry_point.load()
+        except Exception as e:
+            logging.warning(f"Failed to load the dfsync backend {entry_point.name} ({entry_point.value}): {e}")
+    return backends
+
+
+def _entry_points(group: str):
+    entry_points = metadata.entry_points()
+    if hasattr(entry_points, "select"):
+        return entry_points.select(group=group)
+    # Python < 3.10
+    return entry_points.get(group, [])
+
+
+def _qualified_name(backend) -> str:
+    return f"{backend.__module__}:{backend.__qualname__}"
@@ -1,20 +1,124 @@
-import logging, os, os.path, select, subprocess, time
+import contextlib, logging, os, os.path, re, select, subprocess, tempfile, threading, time
+from collections import namedtuple
+from concurrent.futures import FIRST_EXCEPTION, ThreadPoolExecutor, wait
 
 from dfsync.filters import list_files_to_ignore
 from dfsync.lib import ControlledThreadedOperation
+from dfsync.metrics import registry
+from .protocol import ChangeRecord, DELETED, MODIFIED, MOVED
+from .rsync_tuning import LOCAL, TransferTuner
 
 EVENT_TYPE_MAP = {
     "created": "Created",
     "deleted": "Deleted",
     "default": "Synced",
     "full-sync": "Full Sync",
+    "full-sync-shard": "Full Sync shard",
+    "full-sync-delete": "Full Sync delete pass",
 }
 
 
+# rsync --itemize-changes line of a regular file that would be transferred, e.g. ">f.st...... path/to/file"
+ITEMIZED_FILE_PATTERN = re.compile(r"^[<>c]f\S+ (.+)$")
+
+# rsync --stats line prefix: RsyncStats field
+RSYNC_STATS_FIELDS = {
+    "Number of regular files transferred": "files_transferred",
+    "Number of files transferred": "files_transferred",
+    "Total file size": "total_size",
+    "Total transferred file size": "transferred_size",
+    "Literal data": "literal_bytes",
+    "Matched data": "matched_bytes",
+    "Total bytes sent": "sent_bytes",
+    "Total bytes received": "received_bytes",
+}
+
+
+class RsyncStats(
+    namedtuple(
+        "RsyncStats",
+        (
+            "syncs",
+            "files_transferred",
+            "total_size",
+            "transferred_size",
+            "literal_bytes",
+            "matched_bytes",
+            "sent_bytes",
+            "received_bytes",
+            "elapsed",
+        ),
+    )
+):
+    @property
+    def speedup(self):
+        transferred = self.sent_bytes + self.received_bytes
+        return self.total_size / transferred if transferred else None
+
+    @property
+    def throughput(self):
+        return self.sent_bytes / self.elapsed if self.elapsed else None
+
+    @property
+    def seconds_per_file(self):
+        return self.elapsed / self.files_transferred if self.files_transferred else None
+
+    @property
+    def matched_ratio(self):
+        delta_bytes = self.literal_bytes + self.matched_bytes
+        return self.matched_bytes / delta_bytes if delta_bytes else None
+
+    def __add__(self, other):
+        return RsyncStats(*[a + b for a, b in zip(self, other)])
+
+
+EMPTY_RSYNC_STATS = RsyncStats(*[0] * len(RsyncStats._fields))
+
+
+class TransferStats:
+    """
+    Aggregates the stats of every rsync run, for the whole session and per destination
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.session = EMPTY_RSYNC_STATS
+        self.destinations = {}
+
+    def record(self, destination: str, stats: RsyncStats):
+        with self._lock:
+            self.session = self.session + stats
+            self.destinations[destination] = self.destinations.get(destination, EMPTY_RSYNC_STATS) + stats
+
+    def get(self, destination: str) -> RsyncStats:
+        with self._lock:
+            return self.destinations.get(destination, EMPTY_RSYNC_STATS)
+
+    def format_table(self):
+        with self._lock:
+            destinations = sorted(self.destinations.items())
+        rows = [["destination", "syncs", "files", "sent", "literal", "matched", "KiB/s", "ms/file"]]
+        for destination, stats in [*destinations, ("(session)", self.session)]:
+            throughput = "" if stats.throughput is None else f"{stats.throughput / 1024.0:.1f}"
+            per_file = "" if stats.seconds_per_file is None else f"{stats.seconds_per_file * 1000.0:.1f}"
+            counts = [stats.syncs, stats.files_transferred, stats.sent_bytes, stats.literal_bytes, stats.matched_bytes]
+            rows.append([destination, *[str(c) for c in counts], throughput, per_file])
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows)
+
+
+transfer_stats = TransferStats()
+
+
 class StopStreamReader(Exception):
     pass
 
 
+class SyncPreempted(Exception):
+    pass
+
+
 class RsyncStreamReader(ControlledThreadedOperation):
     def __init__(self, stream):
         super().__init__()
@@ -25,6 +129,7 @@ class RsyncStreamReader(ControlledThreadedOperation):
         self.timeout = 300.0
 
         self.rsync_stats = None
+        self.rsync_stats_values = {}
         self.rsync_error = None
         self.rsync_permission_error_count = 0
         self.stream_closed = False
@@ -37,15 +142,13 @@ class RsyncStreamReader(ControlledThreadedOperation):
             elapsed = 0
 
             while elapsed < self.timeout:
-                if spoll.poll(0):
+                if spoll.poll(100):
                     line = self.stream.readline()
                     if len(line) > 0:
                         line_timestamp = time.monotonic()
                         yield line.decode("utf8")
                     else:
                         return
-                else:
-                    time.sleep(0.1)
                 elapsed = time.monotonic() - line_timestamp
 
             if elapsed >= self.timeout:
@@ -74,6 +177,10 @@ class RsyncStreamReader(ControlledThreadedOperation):
                 if line and line.startswith("sent "):
                     # stdout
                     self.rsync_stats = line.strip()
+                elif line and line.split(":")[0] in RSYNC_STATS_FIELDS:
+                    # stdout, --stats
+                    key, value = line.split(":", 1)
+                    self.rsync_stats_values[RSYNC_STATS_FIELDS[key]] = _parse_number(value)
                 elif line and line.startswith("X11 forwarding"):
                     # stdout
                     pass
@@ -106,24 +213,56 @@ class RsyncStreamReader(ControlledThreadedOperation):
 
     def stop(self, *args, **kwargs):
         super().stop(*args, **kwargs)
+        if self._thread.ident is not None:
+            # Let the reader drain the remaining output (i.e. the stats) before closing the stream
+            self._thread.join(timeout=1.0)
         self.stream.close()
 
         while not self.stream_closed:
-            time.sleep(1.0)
+            time.sleep(0.01)
+
+    def get_stats(self, elapsed: float = 0.0) -> RsyncStats:
+        if not self.rsync_stats_values and self.rsync_stats is None:
+            return None
+
+        values = {**EMPTY_RSYNC_STATS._asdict(), "syncs": 1, "elapsed": elapsed}
+        if self.rsync_stats and not self.rsync_stats_values:
+            # No --stats output, fall back to the "sent X bytes  received Y bytes" line
+            words = self.rsync_stats.split()
+            values.update(sent_bytes=_parse_number(words[1]), received_bytes=_parse_number(words[4]))
+        values.update(self.rsync_stats_values)
+        return RsyncStats(**values)
 
 
 def echo(msg=""):
     print(f"{msg}")
 
 
+def _parse_number(value: str) -> int:
+    # e.g. "1,234 bytes", "3 (reg: 2, dir: 1)"
+    try:
+        return int(float(value.split()[0].replace(",", "")))
+    except (IndexError, ValueError):
+        return 0
+
+
+# Sync options that only apply to kubernetes destinations
+KUBE_ONLY_ARGS = ["kube_host", "container_command", "namespace", "label_selector", "field_selector", "kube_qps"]
+
+
 class FileRsync:
-    def __init__(self, full_sync=None, **kwargs):
-        valued_args = {k: kwargs.get(k) for k in ["kube_host", "container_command"] if kwargs.get(k) is not None}
+    # Created/modified files of a batch go in a single rsync run, larger change sets get a full sync
+    max_batch_size = 64
+
+    def __init__(self, full_sync=None, adaptive_transfer=True, sync_jobs=1, **kwargs):
+        self.tuner = TransferTuner() if adaptive_transfer else None
+        self.sync_jobs = sync_jobs or 1
+        valued_args = {k: kwargs.get(k) for k in KUBE_ONLY_ARGS if kwargs.get(k) is not None}
 
         if len(valued_args) != 0:
             keys = ", ".join(valued_args.keys())
             message = f"Plain file-rsync operation does not support given arguments: {keys}."
-            kube_hints = ["kube_host", "pod_timeout", "container_command"]
+            kube_hints = ["kube_host", "pod_timeout", "container_command", "namespace", "selector"]
             if any(h in keys for h in kube_hints):
                 message = (
                     f"{message}\n"
@@ -143,6 +282,27 @@ class FileRsync:
 
         return self._sync([src_file_path], event_type=event_type, rsync_cwd=rsync_cwd, **kwargs)
 
+    def sync_batch(self, changes, watched_dir: str = None, **kwargs):
+        """
+        Syncs a set of changes (see dfsync.backends.protocol.ChangeRecord), all the created/modified files
+        are transferred by a single rsync run, deletes still need one run each
+        """
+        transferred, deleted = [], []
+        for change in changes:
+            if change.kind == MOVED:
+                deleted.append(change.path)
+            path = change.dest_path if change.kind == MOVED else change.path
+            abs_path = os.path.join(watched_dir, path) if watched_dir else path
+            if change.kind != DELETED and os.path.exists(abs_path):
+                transferred.append(path)
+            elif change.kind != MOVED:
+                deleted.append(path)
+
+        for path in deleted:
+            self._sync([path], event_type="deleted", rsync_cwd=watched_dir, **kwargs)
+        if transferred:
+            self._sync(transferred, rsync_cwd=watched_dir, **kwargs)
+
     def _sync(
         self,
         src_file_paths,
@@ -152,6 +312,8 @@ class FileRsync:
         rsh_env=None,
         blocking_io=False,
         rsync_cwd=None,
+        stats_key=None,
+        preempt=None,
         **kwargs,
     ):
         event_type_str = EVENT_TYPE_MAP.get(event_type) or EVENT_TYPE_MAP.get("default")
@@ -172,10 +334,18 @@ class FileRsync:
         elif event_type == "full-sync":
             src_paths = [p or "./" for p in src_file_paths]
             rsync_cmd = self._get_rsync_cmd_on_full_sync(src_paths, destination_dir, blocking_io, rsh)
+        elif event_type == "full-sync-shard":
+            rsync_cmd = self._get_rsync_cmd_on_shard_sync(src_file_paths, destination_dir, blocking_io, rsh)
+        elif event_type == "full-sync-delete":
+            src_paths = [p or "./" for p in src_file_paths]
+            rsync_cmd = self._get_rsync_cmd_on_full_sync(src_paths, destination_dir, blocking_io, rsh)
+            # Transfer nothing, only delete the files which no longer exist in the source dirs
+            rsync_cmd[2:2] = ["--existing", "--ignore-existing"]
         else:
             rsync_cmd = [
                 "rsync",
                 "-Rvx",
+                "--stats",
                 "--temp-dir=/tmp",
                 "--delay-updates",
                 *blocking_io,
@@ -184,33 +354,54 @@ class FileRsync:
                 destination_dir,
             ]
 
+        stats_key = stats_key or destination_dir
+        transfer_mode = LOCAL
+        if self.tuner is not None:
+            transfer_mode = self.tuner.get_mode(stats_key, is_local=not rsh and ":" not in destination_dir)
+        rsync_cmd[2:2] = transfer_mode.args
+
         logging.debug("rsync command: {}".format(" ".join(rsync_cmd)))
 
         popen_args = {}
         if rsync_cwd:
             popen_args.update(dict(cwd=rsync_cwd))
         try:
-            rsync_process = subprocess.Popen(
-                rsync_cmd,
-                stdin=subprocess.DEVNULL,
-                stdout=subprocess.PIPE,
-                stderr=subprocess.PIPE,
-                env=rsh_env,
-                **popen_args,
-            )
+            started = time.monotonic()
+            with registry.timer("process_spawn"):
+                rsync_process = subprocess.Popen(
+                    rsync_cmd,
+                    stdin=subprocess.DEVNULL,
+                    stdout=subprocess.PIPE,
+                    stderr=subprocess.PIPE,
+                    env=rsh_env,
+                    **popen_args,
+                )
             stdout = RsyncStreamReader(rsync_process.stdout)
             stdout.start()
 
             stderr = RsyncStreamReader(rsync_process.stderr)
             stderr.start()
 
-            return_code = rsync_process.wait(timeout=None)
+            with registry.timer("transfer"):
+                return_code = self._wait(rsync_process, preempt)
 
-            stdout.stop()
-            stderr.stop()
+                stdout.stop()
+                stderr.stop()
+            if return_code is None:
+                echo(f"{event_type_str} interrupted")
+                raise SyncPreempted()
+            stats = stdout.get_stats(elapsed=time.monotonic() - started)
 
+            if event_type == "full-sync":
+                registry.counter("full_syncs").inc()
             if stdout.rsync_stats:
                 echo(f"  {stdout.rsync_stats}")
+            if stats is not None:
+                transfer_stats.record(stats_key, stats)
+                if self.tuner is not None:
+                    self.tuner.record(stats_key, transfer_mode, stats)
+                registry.counter("rsync_sent_bytes").inc(stats.sent_bytes)
+                registry.counter("rsync_received_bytes").inc(stats.received_bytes)
 
             if return_code != 0:
                 if stderr.rsync_error:
@@ -224,9 +415,13 @@ class FileRsync:
                         f"  {stderr.rsync_permission_error_count} {files} had permission or other issues on destination"
                     )
 
+                registry.counter("rsync_failures", exit_code=str(return_code)).inc()
                 if return_code != 23:
                     raise subprocess.CalledProcessError(returncode=return_code, cmd=rsync_cmd)
 
+        except SyncPreempted:
+            raise
+
         except:
             echo("Sync failed")
             env_str = "N/A"
@@ -237,11 +432,30 @@ class FileRsync:
             echo(f"Command: {cmd_str}")
             raise
 
-        if len(src_file_paths) == 1:
+        if event_type == "full-sync-shard":
+            echo("{} of {} paths".format(event_type_str, len(src_file_paths)))
+        elif len(src_file_paths) == 1:
             echo("{} {}".format(event_type_str, src_file_paths[0]))
         else:
             echo("{} {}".format(event_type_str, src_file_paths))
 
+    def _wait(self, rsync_process, preempt=None):
+        """
+        Waits for rsync to exit and returns its exit code, or terminates it and returns None
+        as soon as the `preempt` callback returns True
+        """
+        if preempt is None:
+            return rsync_process.wait(timeout=None)
+
+        while True:
+            try:
+                return rsync_process.wait(timeout=0.1)
+            except subprocess.TimeoutExpired:
+                if preempt():
+                    rsync_process.terminate()
+                    rsync_process.wait(timeout=None)
+                    return None
+
     def _get_rsync_cmd_on_file_delete(self, src_file_path, destination_dir: str, blocking_io: list, rsh: list):
         src_dir, file_name = os.path.split(src_file_path)
         intermediate_paths = [file_name]
@@ -262,6 +476,7 @@ class FileRsync:
         cmd = [
             "rsync",
             "-rvx",
+            "--stats",
             "--delete",
             "--filter=-,s *",
             *filters,
@@ -278,10 +493,12 @@ class FileRsync:
         return [
             "rsync",
             "-rvx",
+            "--stats",
             "--temp-dir=/tmp",
             "--delay-updates",
             "--delete",
             "--filter=- .git/",
+            "--filter=- .dfsync/",
             *filters,
             *blocking_io,
             *rsh,
@@ -289,8 +506,144 @@ class FileRsync:
             destination_dir,
         ]
 
+    def _get_rsync_cmd_on_shard_sync(self, src_file_paths: list, destination_dir: str, blocking_io: list, rsh: list):
+        # Shard paths look like "src/./relative/path", -R keeps the part after "/./" at the destination
+        filters = ["--filter=- {}".format(f) for f in list_files_to_ignore()]
+        return [
+            "rsync",
+            "-rRvx",
+            "--stats",
+            "--temp-dir=/tmp",
+            "--delay-updates",
+            "--filter=- .git/",
+            "--filter=- .dfsync/",
+            *filters,
+            *blocking_io,
+            *rsh,
+            *src_file_paths,
+            destination_dir,
+        ]
+
     def sync_project(self, src_file_paths, **kwargs):
-        return self._sync(src_file_paths, event_type="full-sync", **kwargs)
+        if self.sync_jobs <= 1:
+            return self._sync(src_file_paths, event_type="full-sync", **kwargs)
+
+        return self._sharded_sync(src_file_paths, **kwargs)
+
+    def _sharded_sync(self, src_file_paths, rsync_cwd=None, preempt=None, **kwargs):
+        shards = plan_shards(src_file_paths, self.sync_jobs, cwd=rsync_cwd)
+        echo(f"Full Sync running, {len(shards)} parallel shards")
+        registry.counter("full_syncs").inc()
+
+        # The preempt callback is only ever called from this thread, the shards just follow its decision
+        preempted = threading.Event()
+        with ThreadPoolExecutor(max_workers=max(1, len(shards))) as executor:
+            futures = [
+                executor.submit(
+                    self._sync,
+                    shard,
+                    event_type="full-sync-shard",
+                    rsync_cwd=rsync_cwd,
+                    preempt=preempted.is_set,
+                    **kwargs,
+                )
+                for shard in shards
+            ]
+            pending = futures
+            while pending:
+                _, pending = wait(pending, timeout=0.1, return_when=FIRST_EXCEPTION)
+                if any(f.done() and f.exception() is not None for f in futures):
+                    preempted.set()
+                elif preempt is not None and not preempted.is_set() and preempt():
+                    preempted.set()
+            errors = [f.exception() for f in futures if f.exception() is not None]
+            if errors:
+                # Other shards are stopped on the first error, report the error rather than the stopped shards
+                raise next((e for e in errors if not isinstance(e, SyncPreempted)), errors[0])
+
+        # Deleting only after all the shards are done keeps the destination consistent
+        return self._sync(src_file_paths, event_type="full-sync-delete", rsync_cwd=rsync_cwd, preempt=preempt, **kwargs)
+
+    def verify_project(
+        self,
+        src_file_paths,
+        destination_dir: str = None,
+        rsh=None,
+        rsh_env=None,
+        blocking_io=False,
+        preempt=None,
+        checksum=False,
+        stats_key=None,
+        output_lock=None,
+        **kwargs,
+    ):
+        """
+        Compares the destination with the source dirs and resyncs only what drifted (e.g. files lost by a restarted
+        container). A single rsync dry run lists the divergent files, by size, or by checksum (slower, thorough).
+        Only the resync and its output happen under `output_lock` (a context manager factory), if given.
+        Returns the number of files that were out of sync.
+        """
+        changed, extraneous = self._list_divergent_files(
+            src_file_paths, destination_dir, rsh, rsh_env, blocking_io, preempt, checksum
+        )
+        registry.counter("verify_divergent_files").inc(len(changed) + extraneous)
+        sync_args = dict(destination_dir=destination_dir, rsh=rsh, rsh_env=rsh_env, blocking_io=blocking_io)
+        divergent = sum(len(paths) for paths in changed.values()) + extraneous
+        destination = stats_key or destination_dir
+        with (output_lock or contextlib.nullcontext)():
+            for root, paths in changed.items():
+                changes = [ChangeRecord(MODIFIED, path, None, None, None) for path in paths]
+                self.sync_batch(changes, watched_dir=root, stats_key=stats_key, **sync_args)
+            if extraneous > 0:
+                self._sync(src_file_paths, event_type="full-sync-delete", stats_key=stats_key, **sync_args)
+
+            if divergent == 0:
+                echo(f"Verified {destination}, in sync")
+            else:
+                echo(f"Verified {destination}, {divergent} file(s) were out of sync")
+        return divergent
+
+    def _list_divergent_files(self, src_file_paths, destination_dir, rsh, rsh_env, blocking_io, preempt, checksum):
+        """
+        Returns a ({source root: [changed paths]}, number of extraneous destination files) tuple
+        """
+        src_paths = [sanitize_relative_path(p) or "./" for p in src_file_paths]
+        rsync_cmd = self._get_rsync_cmd_on_full_sync(
+            src_paths,
+            "{}/".format(destination_dir.rstrip("/")),
+            ["--blocking-io"] if blocking_io else [],
+            ["--rsh={}".format(rsh)] if rsh is not None else [],
+        )
+        rsync_cmd[1:3] = ["-rnx", "--itemize-changes", "--checksum" if checksum else "--size-only"]
+        logging.debug("rsync command: {}".format(" ".join(rsync_cmd)))
+
+        with tempfile.TemporaryFile() as output, registry.timer("verify"):
+            rsync_process = subprocess.Popen(
+                rsync_cmd, stdin=subprocess.DEVNULL, stdout=output, stderr=subprocess.DEVNULL, env=rsh_env
+            )
+            return_code = self._wait(rsync_process, preempt)
+            if return_code is None:
+                logging.info("Verify interrupted")
+                raise SyncPreempted()
+            if return_code not in (0, 23):
+                raise subprocess.CalledProcessError(returncode=return_code, cmd=rsync_cmd)
+            output.seek(0)
+            lines = output.read().decode("utf8", errors="replace").splitlines()
+
+        roots = [os.path.abspath(p) for p in src_file_paths]
+        changed, extraneous = {}, 0
+        for line in lines:
+            if line.startswith("*deleting "):
+                extraneous += 1
+                continue
+            match = ITEMIZED_FILE_PATTERN.match(line)
+            if match is None:
+                continue
+            path = match.group(1)
+            root = next((r for r in roots if os.path.isfile(os.path.join(r, path))), None)
+            if root is not None:
+                changed.setdefault(root, []).append(os.path.join(".", path))
+        return changed, extraneous
 
     def on_monitor_start(self, destination_dir: str = None, **kwargs):
         pass
@@ -299,6 +652,72 @@ class FileRsync:
         pass
 
 
+ShardEntry = namedtuple("ShardEntry", ("size", "root", "path", "is_dir"))
+
+
+def _scan_tree(root: str):
+    """
+    Returns a dict of relative dir path: list of ShardEntry children, with the total size of every child dir
+    """
+    walked = []
+    for dir_path, dir_names, file_names in os.walk(root):
+        dir_names[:] = [d for d in dir_names if d != ".git"]
+        walked.append((dir_path, dir_names, file_names))
+
+    children = {}
+    sizes = {}
+    # Bottom-up, so that the size of every sub-dir is known before its parent
+    for dir_path, dir_names, file_names in reversed(walked):
+        rel_dir = os.path.relpath(dir_path, root)
+        rel_dir = "" if rel_dir == "." else rel_dir
+        entries = []
+        for name in file_names:
+            try:
+                size = os.lstat(os.path.join(dir_path, name)).st_size
+            except OSError:
+                continue
+            entries.append(ShardEntry(size, root, os.path.join(rel_dir, name), False))
+        for name in dir_names:
+            rel_path = os.path.join(rel_dir, name)
+            # Symlinked dirs are not walked, rsync decides what to do with them
+            entries.append(ShardEntry(sizes.get(rel_path, 0), root, rel_path, rel_path in sizes))
+        children[rel_dir] = entries
+        sizes[rel_dir] = sum(e.size for e in entries)
+    return children
+
+
+def plan_shards(src_file_paths: list, jobs: int, cwd: str = None) -> list:
+    """
+    Splits the source dirs into (at most) `jobs` shards of roughly the same size.
+    Each shard is a list of "src/./relative/path" paths, meant to be used with rsync -R
+    """
+    children = {}
+    entries = []
+    for src in src_file_paths:
+        root = src or "."
+        children[root] = _scan_tree(os.path.join(cwd, root) if cwd else root)
+        entries.extend(e._replace(root=root) for e in children[root].get("", []))
+
+    # Split the largest dirs until no entry is larger than a shard
+    target_size = sum(e.size for e in entries) / max(1, jobs)
+    while entries:
+        largest = max(entries, key=lambda e: e.size)
+        expanded = children[largest.root].get(largest.path) if largest.is_dir else None
+        if largest.size <= target_size or not expanded:
+            break
+        entries.remove(largest)
+        entries.extend(e._replace(root=largest.root) for e in expanded)
+
+    # Largest first, each into the currently smallest shard
+    shards = [[] for _ in range(max(1, jobs))]
+    shard_sizes = [0] * len(shards)
+    for entry in sorted(entries, key=lambda e: e.size, reverse=True):
+        index = shard_sizes.index(min(shard_sizes))
+        shards[index].append("{}/./{}".format(entry.root.rstrip("/"), entry.path))
+        shard_sizes[index] += entry.size
+    return [shard for shard in shards if shard]
+
+
 def sanitize_relative_path(path):
     while True:
         if path.startswith("./"):
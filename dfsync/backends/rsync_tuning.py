@@ -0,0 +1,96 @@
+import statistics
+import threading
+import time
+from collections import namedtuple
+
+TransferMode = namedtuple("TransferMode", ("name", "args"))
+
+# With rsync >= 3.2, -z negotiates the best compression algorithm supported by both ends (zstd, lz4, zlib)
+DELTA = TransferMode("delta", [])
+DELTA_COMPRESSED = TransferMode("delta+compress", ["-z"])
+WHOLE_FILE = TransferMode("whole-file", ["-W"])
+WHOLE_FILE_COMPRESSED = TransferMode("whole-file+compress", ["-W", "-z"])
+LOCAL = TransferMode("local", [])
+
+TRANSFER_MODES = [DELTA, DELTA_COMPRESSED, WHOLE_FILE, WHOLE_FILE_COMPRESSED]
+
+
+def echo(msg=""):
+    print(f"{msg}")
+
+
+class _LinkState:
+    def __init__(self):
+        self.samples = {mode.name: [] for mode in TRANSFER_MODES}
+        self.selected = None
+        self.selected_at = None
+        # Shortest rsync run seen, the fixed cost of a run (connection setup, file list), not a network latency
+        self.min_run_time = None
+
+
+class TransferTuner:
+    """
+    Picks the rsync transfer mode (delta or whole-file, with or without compression) for each destination.
+
+    Every mode is tried on the first syncs that transfer at least `min_sample_bytes`. The mode with the
+    best effective throughput (file bytes transferred per second of rsync run time) is kept, until
+    `revisit_seconds` later when all the modes are measured again. Local destinations are never tuned.
+    The shortest rsync run seen for each destination is kept too, as an estimate of the fixed cost of a run.
+    """
+
+    def __init__(self, min_sample_bytes: int = 64 * 1024, samples_per_mode: int = 2, revisit_seconds: float = 900.0):
+        self.min_sample_bytes = min_sample_bytes
+        self.samples_per_mode = samples_per_mode
+        self.revisit_seconds = revisit_seconds
+
+        self._lock = threading.Lock()
+        self._links = {}
+
+    def get_mode(self, destination: str, is_local: bool = False) -> TransferMode:
+        if is_local:
+            return LOCAL
+
+        with self._lock:
+            link = self._links.setdefault(destination, _LinkState())
+            if link.selected is not None and time.monotonic() - link.selected_at < self.revisit_seconds:
+                return link.selected
+
+            if link.selected is not None:
+                # Time to revisit the choice, the link conditions may have changed
+                link.samples = {mode.name: [] for mode in TRANSFER_MODES}
+                link.selected = None
+
+            for mode in TRANSFER_MODES:
+                if len(link.samples[mode.name]) < self.samples_per_mode:
+                    return mode
+
+            throughputs = {m.name: statistics.median(link.samples[m.name]) for m in TRANSFER_MODES}
+            selected = max(TRANSFER_MODES, key=lambda m: throughputs[m.name])
+            link.selected, link.selected_at = selected, time.monotonic()
+            min_run_time = link.min_run_time
+
+        echo(
+            f"Using {selected.name} transfers for {destination}, "
+            f"{throughputs[selected.name] / 1024.0:.1f} KiB/s, {min_run_time * 1000.0:.0f} ms fastest rsync run"
+        )
+        return selected
+
+    def record(self, destination: str, mode: TransferMode, stats):
+        if mode is LOCAL or stats is None or not stats.elapsed:
+            return
+
+        with self._lock:
+            link = self._links.setdefault(destination, _LinkState())
+            link.min_run_time = stats.elapsed if link.min_run_time is None else min(link.min_run_time, stats.elapsed)
+            if stats.transferred_size < self.min_sample_bytes:
+                # Small transfers are dominated by the fixed cost of a run, they say little about the mode
+                return
+
+            samples = link.samples[mode.name]
+            samples.append(stats.transferred_size / stats.elapsed)
+            del samples[: -self.samples_per_mode]
+
+    def get_min_run_time(self, destination: str):
+        with self._lock:
+            link = self._links.get(destination)
+            return link.min_run_time if link is not None else None
@@ -0,0 +1,137 @@
+import gzip
+import logging
+import os
+import os.path
+import shlex
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import time
+
+from dfsync.metrics import registry
+from dfsync.scanner import scan_tree
+from .rsync import RsyncStats, transfer_stats
+
+# Prints a marker when the destination dir is empty (or missing) and tar is available to extract into it
+EMPTY_DIR_MARKER = "dfsync-empty-dir"
+
+# Files are read in full before their tar header is written, in memory up to this size
+SPOOL_SIZE = 8 * 1024 * 1024
+
+
+def echo(msg=""):
+    print(msg)
+
+
+def get_empty_dir_check_command(destination_dir: str):
+    script = f'command -v tar >/dev/null && [ -z "$(ls -A "$0" 2>/dev/null)" ] && echo {EMPTY_DIR_MARKER}'
+    return ["/bin/sh", "-c", script, destination_dir]
+
+
+def get_extract_command(destination_dir: str):
+    return ["/bin/sh", "-c", 'mkdir -p "$0" && exec tar -xzf - -C "$0"', destination_dir]
+
+
+class _CountingWriter:
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = 0
+
+    def write(self, data):
+        self.written += len(data)
+        return self.stream.write(data)
+
+    def flush(self):
+        self.stream.flush()
+
+
+def stream_tree(
+    src_file_paths: list,
+    destination_dir: str,
+    rsh: str = None,
+    rsh_env: dict = None,
+    ignore_rules=None,
+    stats_key: str = None,
+    compresslevel: int = 1,
+):
+    """
+    Bulk copies the source dirs into an (empty) destination dir, as a single gzipped tar stream piped into
+    `tar -x` over the rsh command (e.g. kube_exec.py), much faster than rsync's per file negotiation.
+    Same files as a full sync, i.e. without the .git dirs and the ignored files, only regular files are copied.
+    Each file is read before it is added, a file that changes size while it is being copied keeps the stream valid.
+    """
+    files = {}
+    for src_path in src_file_paths:
+        root = os.path.abspath(src_path)
+        for path, entry in scan_tree([root], ignore_rules).items():
+            if not os.path.islink(path):
+                files[os.path.relpath(path, root)] = (path, entry)
+
+    started = time.monotonic()
+    cmd = [*shlex.split(rsh or ""), *get_extract_command(destination_dir)]
+    logging.debug("tar stream command: {}".format(" ".join(cmd)))
+    # Not a pipe, the remote side never blocks on its warnings while the stream is written
+    with tempfile.TemporaryFile() as stderr:
+        process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=subprocess.DEVNULL, stderr=stderr, env=rsh_env)
+
+        total_size = 0
+        sent = _CountingWriter(process.stdin)
+        try:
+            with registry.timer("tar_stream"):
+                with gzip.GzipFile(fileobj=sent, mode="wb", compresslevel=compresslevel) as gz:
+                    with tarfile.open(fileobj=gz, mode="w|", format=tarfile.PAX_FORMAT) as tar:
+                        for arcname, (path, entry) in sorted(files.items()):
+                            total_size += _add_file(tar, path, arcname)
+            process.stdin.close()
+        except BrokenPipeError:
+            pass
+
+        return_code = process.wait()
+        stderr.seek(0)
+        error = stderr.read().decode("utf8", errors="replace").strip()
+    if return_code != 0:
+        echo("Bulk copy failed")
+        if error:
+            echo(f"  {error}")
+        raise subprocess.CalledProcessError(returncode=return_code, cmd=cmd, stderr=error)
+
+    elapsed = time.monotonic() - started
+    stats = RsyncStats(
+        syncs=1,
+        files_transferred=len(files),
+        total_size=total_size,
+        transferred_size=total_size,
+        literal_bytes=total_size,
+        matched_bytes=0,
+        sent_bytes=sent.written,
+        received_bytes=0,
+        elapsed=elapsed,
+    )
+    transfer_stats.record(stats_key or destination_dir, stats)
+    registry.counter("tar_stream_sent_bytes").inc(sent.written)
+    echo(f"Bulk copied {len(files)} files, {total_size} bytes as {sent.written} bytes in {elapsed:.1f}s")
+    return stats
+
+
+def _add_file(tar: tarfile.TarFile, path: str, arcname: str) -> int:
+    """
+    Adds a file to the tar stream, returns its size. The file is read in full first: the header holds the size
+    of what was read, even if the file shrinks or grows in the meantime. Unreadable (e.g. vanished) files are skipped
+    """
+    with tempfile.SpooledTemporaryFile(max_size=SPOOL_SIZE) as contents:
+        try:
+            with open(path, "rb") as f:
+                info = tar.gettarinfo(arcname=arcname, fileobj=f)
+                shutil.copyfileobj(f, contents)
+        except OSError as e:
+            logging.info(f"Skipped {path} in the bulk copy ({e})")
+            return 0
+
+        info.size = contents.tell()
+        # Owned by whoever extracts it, same as rsync without --owner/--group
+        info.uid = info.gid = 0
+        info.uname = info.gname = ""
+        contents.seek(0)
+        tar.addfile(info, contents)
+        return info.size
@@ -0,0 +1,328 @@
+import json
+import math
+import os
+import os.path
+import resource
+import shutil
+import subprocess
+import tempfile
+import time
+from collections import namedtuple
+from contextlib import contextmanager
+
+from watchdog.observers import Observer
+
+from dfsync.backends import rsync_backend
+from dfsync.changes import ChangeDetector
+from dfsync.monitor import FileChangedEventHandler
+
+SCENARIOS = ["single-edit", "burst", "rename", "full-sync"]
+
+BenchResult = namedtuple(
+    "BenchResult", ("scenario", "latencies", "missed", "events", "wall_time", "process_spawns", "cpu_time")
+)
+
+
+def percentile(values: list, pct: float):
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(pct / 100.0 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def summarize(result: BenchResult) -> dict:
+    return {
+        "scenario": result.scenario,
+        "p50_ms": _to_ms(percentile(result.latencies, 50)),
+        "p99_ms": _to_ms(percentile(result.latencies, 99)),
+        "events_per_sec": round(result.events / result.wall_time, 2) if result.wall_time else None,
+        "events": result.events,
+        "missed": result.missed,
+        "process_spawns": result.process_spawns,
+        "cpu_seconds": round(result.cpu_time, 3),
+    }
+
+
+def _to_ms(seconds):
+    return None if seconds is None else round(seconds * 1000.0, 1)
+
+
+@contextmanager
+def count_process_spawns():
+    counter = {"spawns": 0}
+    original_popen = subprocess.Popen
+
+    class CountingPopen(original_popen):
+        def __init__(self, *args, **kwargs):
+            counter["spawns"] += 1
+            super().__init__(*args, **kwargs)
+
+    subprocess.Popen = CountingPopen
+    try:
+        yield counter
+    finally:
+        subprocess.Popen = original_popen
+
+
+def _cpu_time():
+    own = resource.getrusage(resource.RUSAGE_SELF)
+    children = resource.getrusage(resource.RUSAGE_CHILDREN)
+    return own.ru_utime + own.ru_stime + children.ru_utime + children.ru_stime
+
+
+def _write(path, contents):
+    with open(path, "w") as f:
+        f.write(contents)
+
+
+def _read(path):
+    try:
+        with open(path, "r") as f:
+            return f.read()
+    except (FileNotFoundError, IsADirectoryError):
+        return None
+
+
+def wait_for_contents(path, contents, timeout=10.0, started=None):
+    """
+    Returns the latency (in seconds) until the given path contains the expected contents, or None on time-out
+    """
+    started = started if started is not None else time.monotonic()
+    while time.monotonic() - started < timeout:
+        if _read(path) == contents:
+            return time.monotonic() - started
+        time.sleep(0.002)
+    return None
+
+
+class LocalPipeline:
+    """
+    A watchdog observer and FileChangedEventHandler syncing a temporary source dir into a temporary
+    destination dir using the file-rsync backend, i.e. the same pipeline `dfsync src dest` uses.
+    """
+
+    def __init__(self, root_dir):
+        # Watched dirs are relative to the current dir, just like when dfsync is used from the command line
+        self.src_dir = os.path.relpath(os.path.join(root_dir, "src"))
+        self.dst_dir = os.path.join(root_dir, "dst")
+        os.makedirs(self.src_dir, exist_ok=True)
+        os.makedirs(self.dst_dir, exist_ok=True)
+
+        self.backend_options = dict(destination_dir=self.dst_dir)
+        self.backend = rsync_backend()
+        self.handler = None
+        self.observer = None
+
+    def start(self, watch: bool = True):
+        if not watch:
+            return
+
+        self.handler = FileChangedEventHandler(
+            self.backend,
+            watched_dir=self.src_dir,
+            change_detector=ChangeDetector(),
+            **self.backend_options,
+        )
+        self.observer = Observer()
+        self.observer.schedule(self.handler, self.src_dir, recursive=True)
+        self.handler.start()
+        self.observer.start()
+
+    def stop(self):
+        if self.observer is None:
+            return
+
+        self.observer.stop()
+        self.handler.stop()
+        self.observer.join()
+
+    def src(self, name):
+        return os.path.join(self.src_dir, name)
+
+    def dst(self, name):
+        return os.path.join(self.dst_dir, name)
+
+
+def _run_single_edit(pipeline, iterations, **kwargs):
+    latencies, missed = [], 0
+    for i in range(iterations):
+        contents = f"VALUE = {i}\n"
+        started = time.monotonic()
+        _write(pipeline.src("single_edit.py"), contents)
+        latency = wait_for_contents(pipeline.dst("single_edit.py"), contents, started=started)
+        if latency is None:
+            missed += 1
+        else:
+            latencies.append(latency)
+    return latencies, missed, iterations
+
+
+def _run_burst(pipeline, iterations, burst_size=50, **kwargs):
+    latencies, missed = [], 0
+    for i in range(iterations):
+        started = time.monotonic()
+        expected = {}
+        for j in range(burst_size):
+            name = f"burst_{j}.py"
+            expected[name] = f"VALUE = {i * burst_size + j}\n"
+            _write(pipeline.src(name), expected[name])
+
+        for name, contents in expected.items():
+            latency = wait_for_contents(pipeline.dst(name), contents, started=started)
+            if latency is None:
+                missed += 1
+            else:
+                latencies.append(latency)
+    return latencies, missed, iterations * burst_size
+
+
+def _run_rename(pipeline, iterations, **kwargs):
+    latencies, missed = [], 0
+    for i in range(iterations):
+        contents = f"VALUE = {i}\n"
+        _write(pipeline.src(f"before_{i}.py"), contents)
+        wait_for_contents(pipeline.dst(f"before_{i}.py"), contents)
+
+        started = time.monotonic()
+        os.rename(pipeline.src(f"before_{i}.py"), pipeline.src(f"after_{i}.py"))
+        latency = wait_for_contents(pipeline.dst(f"after_{i}.py"), contents, timeout=5.0, started=started)
+        if latency is None:
+            missed += 1
+        else:
+            latencies.append(latency)
+    return latencies, missed, iterations
+
+
+def _run_full_sync(pipeline, iterations, files=500, **kwargs):
+    latencies, missed = [], 0
+    nested_dir = pipeline.src("nested")
+    os.makedirs(nested_dir, exist_ok=True)
+    for i in range(iterations):
+        for j in range(files):
+            _write(os.path.join(nested_dir, f"module_{j}.py"), f"VALUE = {i * files + j}\n")
+
+        started = time.monotonic()
+        pipeline.backend.sync_project([pipeline.src_dir], **pipeline.backend_options)
+        latencies.append(time.monotonic() - started)
+    return latencies, missed, iterations * files
+
+
+# Scenario name: (runner, whether file changes are picked up by the watchdog observer)
+SCENARIO_RUNNERS = {
+    "single-edit": (_run_single_edit, True),
+    "burst": (_run_burst, True),
+    "rename": (_run_rename, True),
+    "full-sync": (_run_full_sync, False),
+}
+
+
+def run_scenario(scenario: str, iterations: int = 20, **kwargs) -> BenchResult:
+    if scenario not in SCENARIO_RUNNERS:
+        raise ValueError(f"Unknown benchmark scenario: {scenario}")
+    runner, watch = SCENARIO_RUNNERS[scenario]
+
+    root_dir = tempfile.mkdtemp(prefix="dfsync-bench-")
+    pipeline = LocalPipeline(root_dir)
+    try:
+        pipeline.start(watch=watch)
+        with count_process_spawns() as counter:
+            cpu_started = _cpu_time()
+            started = time.monotonic()
+            latencies, missed, events = runner(pipeline, iterations, **kwargs)
+            wall_time = time.monotonic() - started
+            cpu_time = _cpu_time() - cpu_started
+        return BenchResult(scenario, latencies, missed, events, wall_time, counter["spawns"], cpu_time)
+    finally:
+        pipeline.stop()
+        shutil.rmtree(root_dir, ignore_errors=True)
+
+
+def run_kube_scenario(pods: int, pods_per_deployment: int = 10, **cluster_options) -> list:
+    """
+    Runs KubeReDeployer operations against a fake cluster, returns one summary per operation
+    """
+    from dfsync.fake_kube import FakeCluster, FakeKubeReDeployer
+
+    root_dir = tempfile.mkdtemp(prefix="dfsync-bench-kube-")
+    src_dir = os.path.relpath(os.path.join(root_dir, "src"))
+    os.makedirs(src_dir)
+    subprocess.check_call(["git", "init", "-q", src_dir])
+    _write(os.path.join(src_dir, "app.py"), "VALUE = 0\n")
+
+    cluster_options = {"crashing_deployments": 1, **cluster_options}
+    cluster = FakeCluster(
+        pods, pods_per_deployment=pods_per_deployment, root_dir=os.path.join(root_dir, "pods"), **cluster_options
+    )
+    # Unthrottled, the scenarios measure the cost of the operations rather than the rate limit
+    deployer = FakeKubeReDeployer(cluster, pod_timeout=10, kube_qps=0)
+    destination_dir = f"{cluster.image}:app"
+    summaries = []
+
+    @contextmanager
+    def measure(operation):
+        api_calls, bytes_listed = cluster.total_api_calls, cluster.bytes_listed
+        started = time.monotonic()
+        yield
+        summaries.append(
+            {
+                "operation": operation,
+                "pods": pods,
+                "latency_ms": _to_ms(time.monotonic() - started),
+                "api_calls": cluster.total_api_calls - api_calls,
+                "bytes_listed": cluster.bytes_listed - bytes_listed,
+            }
+        )
+
+    try:
+        crashing = [c for c in deployer.generate_matching_containers(cluster.image) if not c[2].ready]
+        if crashing:
+            with measure("_uncrash"):
+                deployer._uncrash(*crashing[0])
+
+        with measure("on_monitor_start"):
+            deployer.on_monitor_start(src_file_paths=[src_dir], destination_dir=destination_dir, supervisor=True)
+
+        _write(os.path.join(src_dir, "app.py"), "VALUE = 1\n")
+        with measure("sync"):
+            deployer.sync("./app.py", destination_dir=destination_dir, watched_dir=os.path.abspath(src_dir))
+
+        with measure("toggle_supervisor"):
+            deployer.toggle_supervisor(cluster.image, "uninstall")
+    finally:
+        deployer.stop_pod_watch()
+        shutil.rmtree(root_dir, ignore_errors=True)
+    return summaries
+
+
+def format_report(summaries: list, columns: list = None) -> str:
+    columns = columns or list(summaries[0].keys())
+    rows = [columns, *[[str(s[c]) for c in columns] for s in summaries]]
+    widths = [max(len(row[i]) for row in rows) for i in range(len(columns))]
+    lines = ["  ".join(value.ljust(width) for value, width in zip(row, widths)) for row in rows]
+    return "\n".join(lines)
+
+
+def run_benchmarks(
+    scenarios: list = None, iterations: int = 20, kube_pods: list = None, json_path: str = None, echo=print, **kwargs
+):
+    summaries = []
+    if scenarios or not kube_pods:
+        for scenario in scenarios or SCENARIOS:
+            echo(f"Running {scenario} benchmark")
+            summaries.append(summarize(run_scenario(scenario, iterations=iterations, **kwargs)))
+        echo(format_report(summaries))
+
+    kube_summaries = []
+    for pods in kube_pods or []:
+        echo(f"Running kubernetes benchmark with {pods} pod(s)")
+        kube_summaries.extend(run_kube_scenario(pods))
+    if kube_summaries:
+        echo(format_report(kube_summaries))
+
+    summaries = [*summaries, *kube_summaries]
+    if json_path:
+        with open(json_path, "a") as f:
+            for summary in summaries:
+                f.write(json.dumps({"timestamp": time.time(), **summary}) + "\n")
+    return summaries
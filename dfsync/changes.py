@@ -0,0 +1,284 @@
+import hashlib
+import os
+import os.path
+import threading
+import time
+from collections import namedtuple
+
+from dfsync.scanner import scan_tree
+
+try:
+    import xxhash
+except ImportError:
+    xxhash = None
+
+DirtyBatch = namedtuple("DirtyBatch", ("events", "dirs", "whole_tree"))
+FileSignature = namedtuple("FileSignature", ("size", "mtime_ns", "digest"))
+
+
+class DirtyPathSet:
+    """
+    Bounded, de-duplicating set of pending file system events.
+
+    Only the latest event is kept for a given path. Once more than `max_paths` distinct paths are pending,
+    the tracked paths are collapsed into their parent directories, and once more than `max_dirs` directories
+    are pending, the whole tree is marked as dirty. Changes are never dropped and memory stays bounded.
+    """
+
+    def __init__(self, max_paths: int = 10000, max_dirs: int = 1000):
+        self.max_paths = max_paths
+        self.max_dirs = max_dirs
+        self.collapsed_count = 0
+        self.dirty_since = None
+
+        self._condition = threading.Condition()
+        self._events = {}
+        self._dirs = set()
+        self._whole_tree = False
+
+    def __len__(self):
+        with self._condition:
+            return len(self._events) + len(self._dirs) + (1 if self._whole_tree else 0)
+
+    def add(self, event):
+        with self._condition:
+            if self.dirty_since is None:
+                self.dirty_since = time.monotonic()
+            self._add(event)
+            self._condition.notify_all()
+
+    def _add(self, event):
+        if self._whole_tree:
+            return
+
+        path = event.src_path
+        if self._is_in_dirty_dir(path):
+            return
+
+        if path in self._events or len(self._events) < self.max_paths:
+            self._events[path] = event
+            return
+
+        # Too many distinct paths, degrade to directory-level markers
+        self.collapsed_count += len(self._events) + 1
+        for pending_event in [*self._events.values(), event]:
+            for event_path in _event_paths(pending_event):
+                self._mark_dir(os.path.dirname(event_path))
+        self._events = {}
+
+    def _is_in_dirty_dir(self, path):
+        if not self._dirs:
+            return False
+
+        parent = os.path.dirname(path)
+        while True:
+            if parent in self._dirs:
+                return True
+            next_parent = os.path.dirname(parent)
+            if next_parent == parent:
+                return False
+            parent = next_parent
+
+    def _mark_dir(self, path):
+        if self._whole_tree or self._is_in_dirty_dir(os.path.join(path, "")):
+            return
+        if len(self._dirs) >= self.max_dirs:
+            self._whole_tree = True
+            self._dirs = set()
+            return
+        self._dirs.add(path)
+
+    def wait(self, timeout: float = None) -> bool:
+        with self._condition:
+            return self._condition.wait_for(self._has_pending, timeout=timeout)
+
+    def _has_pending(self):
+        return len(self._events) > 0 or len(self._dirs) > 0 or self._whole_tree
+
+    def peek(self):
+        """
+        Returns the pending events without draining them, or None when the dirty set degraded to dir markers
+        """
+        with self._condition:
+            if self._dirs or self._whole_tree:
+                return None
+            return list(self._events.values())
+
+    def drain(self) -> DirtyBatch:
+        with self._condition:
+            batch = DirtyBatch(events=list(self._events.values()), dirs=self._dirs, whole_tree=self._whole_tree)
+            self._events = {}
+            self._dirs = set()
+            self._whole_tree = False
+            self.dirty_since = None
+            return batch
+
+
+def _event_paths(event):
+    dest_path = getattr(event, "dest_path", None)
+    return [event.src_path, dest_path] if dest_path else [event.src_path]
+
+
+class ChangeDetector:
+    """
+    Remembers the (size, mtime_ns, digest) signature of every file at the time it was last synced,
+    so that events which leave the file contents unchanged (e.g. touch, editor re-saves) can be skipped.
+    """
+
+    def __init__(
+        self, use_hash: bool = True, max_hash_size: int = 16 * 1024 * 1024, state=None, destination: str = None
+    ):
+        self.use_hash = use_hash
+        self.max_hash_size = max_hash_size
+        self.hits = 0
+        self.misses = 0
+
+        # Optional dfsync.state.StateStore, the signatures are then persisted as the manifest of the destination
+        self.state = state
+        self.destination = destination
+
+        self._lock = threading.Lock()
+        self._signatures = state.load_manifest(destination) if state is not None else {}
+
+    @property
+    def has_manifest(self):
+        return len(self._signatures) > 0
+
+    def check(self, path: str, count: bool = True):
+        """
+        Returns an (is_unchanged, signature) tuple, the signature is to be passed to `record`
+        after the file is synced successfully
+        """
+        abs_path = os.path.abspath(path)
+        with self._lock:
+            synced = self._signatures.get(abs_path)
+
+        signature, is_unchanged = self._get_signature(abs_path, synced)
+        with self._lock:
+            if is_unchanged:
+                self.hits += 1 if count else 0
+                self._signatures[abs_path] = signature
+            else:
+                self.misses += 1 if count else 0
+        return is_unchanged, signature
+
+    def _get_signature(self, abs_path, synced: FileSignature = None):
+        try:
+            stat = os.stat(abs_path)
+        except (FileNotFoundError, NotADirectoryError, PermissionError):
+            return None, False
+
+        if synced is not None and synced.size == stat.st_size and synced.mtime_ns == stat.st_mtime_ns:
+            # Quick check passed, no need to hash the file
+            return synced, True
+
+        digest = None
+        if self.use_hash and stat.st_size <= self.max_hash_size:
+            try:
+                digest = file_digest(abs_path)
+            except OSError:
+                pass
+        if synced is not None and digest is not None and synced.size == stat.st_size and synced.digest == digest:
+            # Touched, but the contents are the same
+            return synced._replace(mtime_ns=stat.st_mtime_ns), True
+        return FileSignature(size=stat.st_size, mtime_ns=stat.st_mtime_ns, digest=digest), False
+
+    def record(self, path: str, signature: FileSignature = None):
+        abs_path = os.path.abspath(path)
+        with self._lock:
+            if signature is None:
+                self._signatures.pop(abs_path, None)
+            else:
+                self._signatures[abs_path] = signature
+        if self.state is not None:
+            self.state.record_files(self.destination, {abs_path: signature})
+
+    def record_if_unmodified(self, path: str, signature: FileSignature = None):
+        """
+        Records the signature of a file synced in the background, unless the file was modified after the signature
+        was taken: the sync may have copied either version
+        """
+        if signature is not None:
+            try:
+                stat = os.stat(path)
+                if stat.st_size != signature.size or stat.st_mtime_ns != signature.mtime_ns:
+                    signature = None
+            except OSError:
+                signature = None
+        self.record(path, signature)
+
+    def record_tree(self, root_paths: list, synced_before_ns: int, ignore_rules=None):
+        """
+        Records every file under the given dirs as synced (e.g. after a full sync), the persisted manifest included.
+        Files modified after `synced_before_ns` are left out, they may have changed after rsync copied them.
+        """
+        abs_roots = [os.path.join(os.path.abspath(p), "") for p in root_paths]
+        signatures = {
+            path: FileSignature(size=entry.size, mtime_ns=entry.mtime_ns, digest=None)
+            for path, entry in scan_tree(abs_roots, ignore_rules).items()
+            if entry.mtime_ns < synced_before_ns
+        }
+
+        with self._lock:
+            for path, signature in signatures.items():
+                synced = self._signatures.get(path)
+                if synced is not None and synced.size == signature.size and synced.mtime_ns == signature.mtime_ns:
+                    signatures[path] = synced
+            # Deleted files, and the files modified during the sync, which may have been copied either way
+            removed = {
+                path: None
+                for path in self._signatures
+                if path not in signatures and any(path.startswith(r) for r in abs_roots)
+            }
+            for path in removed:
+                self._signatures.pop(path, None)
+            self._signatures.update(signatures)
+        if self.state is not None:
+            self.state.record_files(self.destination, {**signatures, **removed})
+
+    def diff_tree(self, root_path: str, scanned: dict):
+        """
+        Compares a scan of a dir (see dfsync.scanner.scan_tree) with the signatures of the synced files,
+        returns a (changed paths, deleted paths) tuple. Only the files whose size or mtime differ are hashed.
+        """
+        root = os.path.join(os.path.abspath(root_path), "")
+        with self._lock:
+            candidates = [
+                path
+                for path, entry in scanned.items()
+                if path not in self._signatures
+                or self._signatures[path].size != entry.size
+                or self._signatures[path].mtime_ns != entry.mtime_ns
+            ]
+            deleted = [
+                path
+                for path in self._signatures
+                if path.startswith(root) and path not in scanned and not os.path.exists(path)
+            ]
+
+        changed = [path for path in candidates if not self.check(path, count=False)[0]]
+        return changed, deleted
+
+    def forget(self, path: str = None):
+        with self._lock:
+            if path is None:
+                self._signatures = {}
+            else:
+                self._signatures.pop(os.path.abspath(path), None)
+        if self.state is not None and path is None:
+            self.state.clear_manifest(self.destination)
+        elif self.state is not None:
+            self.state.record_files(self.destination, {os.path.abspath(path): None})
+
+    @property
+    def hit_ratio(self):
+        total = self.hits + self.misses
+        return self.hits / total if total else 0.0
+
+
+def file_digest(path: str, chunk_size: int = 1024 * 1024) -> str:
+    file_hash = xxhash.xxh3_64() if xxhash is not None else hashlib.blake2b(digest_size=16)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            file_hash.update(chunk)
+    return file_hash.hexdigest()
@@ -2,10 +2,29 @@ import os, toml
 from collections import namedtuple
 
 Configuration = namedtuple(
-    "Configuration", ("additional_sources", "destination", "pod_timeout", "container_command", "ignore_files")
+    "Configuration",
+    (
+        "additional_sources",
+        "destination",
+        "additional_destinations",
+        "pod_timeout",
+        "container_command",
+        "ignore_files",
+        "namespace",
+        "label_selector",
+        "field_selector",
+    ),
 )
 _default_config = Configuration(
-    additional_sources=[], destination=None, pod_timeout=30, container_command=None, ignore_files=[]
+    additional_sources=[],
+    destination=None,
+    additional_destinations=[],
+    pod_timeout=30,
+    container_command=None,
+    ignore_files=[],
+    namespace=None,
+    label_selector=None,
+    field_selector=None,
 )
 
 
@@ -13,9 +32,13 @@ def default_config_deep_copy():
     return Configuration(
         additional_sources=[*_default_config.additional_sources],
         destination=_default_config.destination,
+        additional_destinations=[*_default_config.additional_destinations],
         pod_timeout=_default_config.pod_timeout,
         container_command=_default_config.container_command,
         ignore_files=_default_config.ignore_files,
+        namespace=_default_config.namespace,
+        label_selector=_default_config.label_selector,
+        field_selector=_default_config.field_selector,
     )
 
 
@@ -54,11 +77,13 @@ def _merge_config(c1, c2):
     result = c1
     pod_timeout = c2.pod_timeout if c2.pod_timeout != c1.pod_timeout else c1.pod_timeout
     sources = set([*c1.additional_sources, *c2.additional_sources])
+    destinations = list(dict.fromkeys([*c1.additional_destinations, *c2.additional_destinations]))
     result = c1._replace(
         **{
             **c2._asdict(),
             "additional_sources": list(sources),
             "destination": c2.destination or c1.destination,
+            "additional_destinations": destinations,
             "pod_timeout": pod_timeout,
         }
     )
@@ -3,17 +3,26 @@ import fnmatch
 import os.path
 import git.exc
 import subprocess
-from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileDeletedEvent
+import time
+from watchdog.events import FileCreatedEvent, FileModifiedEvent, FileDeletedEvent, FileMovedEvent
+
+from dfsync.metrics import registry
+from dfsync.scanner import IgnoreRules
 
 
 def exclude_watchdog_directory_events(event=None, **kwargs):
-    event_classes = [FileCreatedEvent, FileDeletedEvent, FileModifiedEvent]
+    event_classes = [FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent]
     for event_class in event_classes:
         if isinstance(event, event_class):
             return True
     return False
 
 
+def exclude_dfsync_state_dir(event=None, **kwargs):
+    path = event.src_path
+    return not (path.startswith(".dfsync/") or "/.dfsync/" in path)
+
+
 EMACS_PATTERNS = ["*~", "#*#", ".#*", ".goutputstream-*", "*_flymake.py"]
 PYTHON_PATTERNS = ["*.py"]
 
@@ -55,6 +64,10 @@ class UserConfigFilter(LoggingFilter):
             if "*" not in pattern:
                 self.ignored_files.add(pattern)
 
+    @property
+    def ignored_patterns(self):
+        return list(self._ignored_patterns)
+
     def is_filtered(self, src_file_path: str = None, event=None, **kwargs):
         src_file_path = src_file_path or event.src_path
         if src_file_path is None:
@@ -92,7 +105,7 @@ class PythonBlackFilter(LoggingFilter):
 
     def _black_check(self, src_file_path):
         try:
-            with open(src_file_path, "r") as f:
+            with registry.timer("black_check"), open(src_file_path, "r") as f:
                 contents = f.read()
                 black.format_file_contents(contents, fast=False, mode=black.FileMode())
             return False
@@ -112,6 +125,7 @@ class UntrackedGitFilesFilter(LoggingFilter):
         self._repos = {}
         self._is_repo_initialized = {}
         self._untracked_and_ignored_files = {}
+        self._loaded_at = {}
         self._should_filter_untracked_files = True
 
     def set_should_filter_untracked_files(self, should_filter_untracked_files: bool = True):
@@ -123,6 +137,11 @@ class UntrackedGitFilesFilter(LoggingFilter):
             flat_files.extend(fn)
         return flat_files
 
+    def get_ignored_paths(self):
+        return [
+            os.path.join(repo_dir, f) for repo_dir, files in self._untracked_and_ignored_files.items() for f in files
+        ]
+
     def _get_existing_parent(self, path):
         exists = False
         parent_path = None
@@ -156,21 +175,27 @@ class UntrackedGitFilesFilter(LoggingFilter):
 
         return repo
 
-    def load_ignored_files(self, cwd):
+    def load_ignored_files(self, cwd, max_age: float = None):
+        if max_age is not None and time.monotonic() - self._loaded_at.get(cwd, -max_age) < max_age:
+            return
+
         files = subprocess.check_output("git ls-files --exclude-standard -oi --directory".split(" "), cwd=cwd)
         files = files.decode("utf8")
 
         file_list = [f.strip() for f in files.split("\n") if len(f.strip()) > 0]
         self._untracked_and_ignored_files[cwd] = file_list
+        self._loaded_at[cwd] = time.monotonic()
 
     def is_filtered(self, src_file_path: str = None, event=None, **kwargs):
         src_file_path = src_file_path or event.src_path
         src_abs_path = os.path.abspath(src_file_path)
 
-        repo = self.get_git_repo(src_file_path)
-        if repo is None:
-            return False
-        self.load_ignored_files(repo.working_tree_dir)
+        with registry.timer("git_lookup"):
+            repo = self.get_git_repo(src_file_path)
+            if repo is None:
+                return False
+            # Bursts of events share the same listing
+            self.load_ignored_files(repo.working_tree_dir, max_age=2.0)
 
         if repo.ignored(src_abs_path):
             self._ignore(src_file_path, "file is in .gitignore")
@@ -196,6 +221,7 @@ USER_FILTERS = [EmacsBufferFilter(), PythonBlackFilter()]
 GIT_FILTER = UntrackedGitFilesFilter()
 ALL_FILTERS = [
     exclude_watchdog_directory_events,
+    exclude_dfsync_state_dir,
     *[f.is_not_filtered for f in USER_FILTERS],
     GIT_FILTER.is_not_filtered,
 ]
@@ -208,6 +234,19 @@ def list_files_to_ignore():
     return result
 
 
+def load_ignore_rules(src_file_paths: list) -> IgnoreRules:
+    """
+    Compiles the git-ignored paths of the repos of the given dirs and the file name patterns of the user filters
+    """
+    for path in src_file_paths:
+        repo = GIT_FILTER.get_git_repo(os.path.join(os.path.abspath(path), ""))
+        if repo is not None:
+            GIT_FILTER.load_ignored_files(repo.working_tree_dir, max_age=2.0)
+
+    patterns = [p for f in USER_FILTERS for p in getattr(f, "ignored_patterns", [])]
+    return IgnoreRules(paths=[p.rstrip("/") for p in GIT_FILTER.get_ignored_paths()], patterns=patterns)
+
+
 def path_is_parent(parent_path, child_path):
     parent_path = os.path.abspath(parent_path)
     child_path = os.path.abspath(child_path)
@@ -1,10 +1,14 @@
 import os
 import os.path
+import socket
 import yaml
 from urllib.parse import urlparse
+from urllib3.connection import HTTPConnection
 from kubernetes import client, config
 
 LOCAL_CREDENTIALS_FILE = os.path.expanduser("~/.kube/config")
+# Connections kept open to the kubernetes API, the concurrent calls of dfsync never need more than these
+CONNECTION_POOL_MAXSIZE = 16
 EMPTY_CREDENTIALS = """apiVersion: v1
 kind: Config
 clusters: []
@@ -15,6 +19,54 @@ current-context: ''
 """
 
 
+_parsed_kube_configs = {}
+
+
+def get_kube_config_paths(config_file: str = None) -> list:
+    paths = config_file or os.environ.get("KUBECONFIG") or LOCAL_CREDENTIALS_FILE
+    return [os.path.expanduser(p) for p in paths.split(os.pathsep) if p]
+
+
+def read_kube_config(config_file: str = None) -> dict:
+    """
+    Returns the parsed kube config, merged the way kubectl does when KUBECONFIG lists several files.
+    Each file is only parsed again after it changes.
+    """
+    merged = {"clusters": [], "contexts": [], "users": [], "current-context": None}
+    for path in get_kube_config_paths(config_file):
+        try:
+            mtime_ns = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            continue
+
+        cached = _parsed_kube_configs.get(path)
+        if cached is None or cached[0] != mtime_ns:
+            with open(path, "r") as f:
+                cached = (mtime_ns, yaml.safe_load(f) or {})
+            _parsed_kube_configs[path] = cached
+
+        parsed = cached[1]
+        for section in ["clusters", "contexts", "users"]:
+            names = {entry.get("name") for entry in merged[section]}
+            merged[section].extend(e for e in parsed.get(section) or [] if e.get("name") not in names)
+        merged["current-context"] = merged["current-context"] or parsed.get("current-context")
+    return merged
+
+
+def list_kube_contexts(config_file: str = None):
+    """
+    Returns the (contexts, active context name) of the kube config, every context is a dict with
+    the name and server of the context, i.e. no client is configured, nor are certificates loaded
+    """
+    kube_config = read_kube_config(config_file)
+    servers = {c.get("name"): (c.get("cluster") or {}).get("server") for c in kube_config["clusters"]}
+    contexts = [
+        {"name": c.get("name"), "server": servers.get((c.get("context") or {}).get("cluster"))}
+        for c in kube_config["contexts"]
+    ]
+    return contexts, kube_config["current-context"]
+
+
 def update_local_kube_config(new_kube_credentials):
     try:
         with open(LOCAL_CREDENTIALS_FILE, "r") as f:
@@ -151,7 +203,8 @@ def normalized_k8s_url(k8s_url: str) -> str:
         parsed = urlparse(k8s_url)
 
     if all([parsed.scheme, parsed.netloc]):
-        return result
+        # Same as the host of a loaded kubernetes client configuration
+        return result.rstrip("/")
     else:
         raise ValueError(f"Invalid k8s URL: `{k8s_url}`")
 
@@ -163,12 +216,21 @@ NEUTRAL = "\033[0m"
 
 
 class KubeContextConfig:
-    def __init__(self, context_name: str) -> None:
+    def __init__(
+        self,
+        context_name: str,
+        connection_pool_maxsize: int = CONNECTION_POOL_MAXSIZE,
+        server: str = None,
+        config_file: str = None,
+    ) -> None:
         self._api_client = None
         self._load_failure = None
-        self._configuration = client.Configuration()
+        self._configuration = None
+        # Same as the host of the loaded client configuration, which strips the trailing slash
+        self._server = server.rstrip("/") if server else server
+        self.config_file = config_file
         self.context_name = context_name
-        self._adjust_ssl()
+        self.connection_pool_maxsize = connection_pool_maxsize
         self.is_active = False
         self.is_selected = False
 
@@ -180,18 +242,34 @@ class KubeContextConfig:
         if self._api_client is not None:
             return
         try:
+            self._configuration = client.Configuration()
+            self._adjust_ssl()
             config.load_kube_config(
+                config_file=self.config_file,
                 context=self.context_name,
                 client_configuration=self._configuration,
             )
             self._adjust_ssl()
+            self._configuration.connection_pool_maxsize = self.connection_pool_maxsize
             self._api_client = client.ApiClient(self._configuration)
+            self._enable_tcp_keepalive()
             self._load_failure = None
         except Exception as e:
             self._load_failure = str(e)
 
+    def _enable_tcp_keepalive(self):
+        # Idle pooled connections survive NATs and load balancers, and their TLS sessions get reused
+        pool_manager = self._api_client.rest_client.pool_manager
+        pool_manager.connection_pool_kw["socket_options"] = [
+            *HTTPConnection.default_socket_options,
+            (socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1),
+        ]
+
     @property
     def host(self):
+        if self._api_client is None and self._server is not None:
+            # Known from the kube config, no need to load the context
+            return self._server
         self._load()
         return self._configuration.host
 
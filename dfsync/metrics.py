@@ -0,0 +1,292 @@
+import json
+import threading
+import time
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from dfsync.lib import ControlledThreadedOperation
+
+
+class Counter:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def snapshot(self):
+        return {"type": "counter", "value": self.value}
+
+
+class Gauge:
+    def __init__(self):
+        self._value = 0
+        self._function = None
+
+    def set(self, value):
+        self._value = value
+
+    def set_function(self, function):
+        """
+        The gauge value is read from the given function whenever it is collected
+        """
+        self._function = function
+
+    @property
+    def value(self):
+        return self._function() if self._function is not None else self._value
+
+    def snapshot(self):
+        return {"type": "gauge", "value": self.value}
+
+
+class Histogram:
+    """
+    HDR-style histogram of durations: values are recorded in microseconds into log-linear buckets,
+    every power of two is split into 2^precision_bits linear sub-buckets (~1.5% relative error by default).
+    """
+
+    def __init__(self, precision_bits: int = 6):
+        self._lock = threading.Lock()
+        self._precision_bits = precision_bits
+        self._buckets = {}
+        self.count = 0
+        self.total = 0.0
+        self.min = None
+        self.max = None
+
+    def _bucket(self, micros: int):
+        shift = max(0, micros.bit_length() - self._precision_bits)
+        return micros >> shift << shift, (1 << shift) - 1
+
+    def record(self, seconds: float):
+        bucket = self._bucket(max(0, int(seconds * 1000000)))
+        with self._lock:
+            self._buckets[bucket] = self._buckets.get(bucket, 0) + 1
+            self.count += 1
+            self.total += seconds
+            self.min = seconds if self.min is None else min(self.min, seconds)
+            self.max = seconds if self.max is None else max(self.max, seconds)
+
+    def percentile(self, pct: float):
+        with self._lock:
+            buckets = sorted(self._buckets.items())
+            count = self.count
+        if count == 0:
+            return None
+
+        rank = max(1, pct / 100.0 * count)
+        seen = 0
+        for (lower, width), bucket_count in buckets:
+            seen += bucket_count
+            if seen >= rank:
+                return min(max((lower + width / 2.0) / 1000000.0, self.min), self.max)
+        return self.max
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else None
+
+    def snapshot(self):
+        return {
+            "type": "histogram",
+            "count": self.count,
+            "sum": self.total,
+            "mean": self.mean,
+            "min": self.min,
+            "max": self.max,
+            "p50": self.percentile(50),
+            "p90": self.percentile(90),
+            "p99": self.percentile(99),
+        }
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._metrics = {}
+        self._local = threading.local()
+        self._dump_path = None
+
+    def _get(self, name, metric_class, labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            metric = self._metrics.get(key)
+            if metric is None:
+                metric = metric_class()
+                self._metrics[key] = metric
+            return metric
+
+    def counter(self, name: str, **labels) -> Counter:
+        return self._get(name, Counter, labels)
+
+    def gauge(self, name: str, **labels) -> Gauge:
+        return self._get(name, Gauge, labels)
+
+    def histogram(self, name: str, **labels) -> Histogram:
+        return self._get(name, Histogram, labels)
+
+    def record(self, name: str, seconds: float, **labels):
+        self.histogram(name, **labels).record(seconds)
+        stages = getattr(self._local, "stages", None)
+        if stages is not None:
+            key = _metric_key(name, labels)
+            stages[key] = stages.get(key, 0.0) + seconds
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - started, **labels)
+
+    def dump_to(self, path: str = None):
+        self._dump_path = path
+
+    @contextmanager
+    def batch(self, **info):
+        """
+        Groups the stage timings recorded by the current thread, when a dump file is set,
+        the timings of each batch are appended to it as a json line
+        """
+        stages = {}
+        self._local.stages = stages
+        started = time.perf_counter()
+        try:
+            yield stages
+        finally:
+            self._local.stages = None
+
+        if self._dump_path and stages:
+            line = {"timestamp": time.time(), "duration": time.perf_counter() - started, **info, "stages": stages}
+            with open(self._dump_path, "a") as f:
+                f.write(json.dumps(line) + "\n")
+
+    def collect(self):
+        """
+        Returns a sorted list of (name, labels, metric) tuples
+        """
+        with self._lock:
+            metrics = sorted(self._metrics.items())
+        return [(name, dict(labels), metric) for (name, labels), metric in metrics]
+
+    def snapshot(self):
+        return {_metric_key(name, labels): metric.snapshot() for name, labels, metric in self.collect()}
+
+    def format_table(self):
+        rows = [["metric", "count", "mean ms", "p50 ms", "p90 ms", "p99 ms", "max ms"]]
+        for name, snapshot in self.snapshot().items():
+            if snapshot["type"] != "histogram":
+                rows.append([name, str(snapshot["value"]), "", "", "", "", ""])
+            else:
+                timings = [snapshot[k] for k in ["mean", "p50", "p90", "p99", "max"]]
+                rows.append([name, str(snapshot["count"]), *[_format_ms(t) for t in timings]])
+
+        widths = [max(len(row[i]) for row in rows) for i in range(len(rows[0]))]
+        return "\n".join("  ".join(v.ljust(w) for v, w in zip(row, widths)).rstrip() for row in rows)
+
+    def format_prometheus(self):
+        """
+        Renders all metrics in the Prometheus text exposition format, histograms are exposed as summaries
+        """
+        lines = []
+        declared = set()
+        for name, labels, metric in self.collect():
+            if isinstance(metric, Histogram):
+                metric_name, metric_type = _prometheus_name(name, "_seconds"), "summary"
+            elif isinstance(metric, Counter):
+                metric_name, metric_type = _prometheus_name(name, "_total"), "counter"
+            else:
+                metric_name, metric_type = _prometheus_name(name), "gauge"
+
+            if metric_name not in declared:
+                declared.add(metric_name)
+                lines.append(f"# TYPE {metric_name} {metric_type}")
+
+            if isinstance(metric, Histogram):
+                for quantile in [0.5, 0.9, 0.99]:
+                    value = metric.percentile(quantile * 100)
+                    label_str = _prometheus_labels({**labels, "quantile": str(quantile)})
+                    lines.append(f"{metric_name}{label_str} {_prometheus_value(value)}")
+                lines.append(f"{metric_name}_sum{_prometheus_labels(labels)} {_prometheus_value(metric.total)}")
+                lines.append(f"{metric_name}_count{_prometheus_labels(labels)} {metric.count}")
+            else:
+                lines.append(f"{metric_name}{_prometheus_labels(labels)} {_prometheus_value(metric.value)}")
+        return "\n".join(lines) + "\n"
+
+
+class _MetricsRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+
+        body = self.server.registry.format_prometheus().encode("utf8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        # Keep the console for sync messages
+        pass
+
+
+class MetricsServer(ControlledThreadedOperation):
+    """
+    Serves the metrics registry on http://host:port/metrics
+    """
+
+    def __init__(self, port: int, host: str = "127.0.0.1", metrics_registry=None):
+        super().__init__()
+        self.httpd = ThreadingHTTPServer((host, port), _MetricsRequestHandler)
+        self.httpd.daemon_threads = True
+        self.httpd.registry = metrics_registry or registry
+
+    @property
+    def url(self):
+        host, port = self.httpd.server_address[:2]
+        return f"http://{host}:{port}/metrics"
+
+    def run(self):
+        self.httpd.serve_forever(poll_interval=0.5)
+
+    def stop(self, *args, **kwargs):
+        super().stop()
+        if self._thread.is_alive():
+            self.httpd.shutdown()
+        self.httpd.server_close()
+
+
+def _metric_key(name, labels):
+    if not labels:
+        return name
+    label_str = ",".join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f"{name}{{{label_str}}}"
+
+
+def _prometheus_name(name, suffix=""):
+    cleaned = "".join(c if c.isalnum() else "_" for c in name)
+    return f"dfsync_{cleaned}{suffix}"
+
+
+def _prometheus_labels(labels):
+    if not labels:
+        return ""
+    escaped = {k: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for k, v in labels.items()}
+    return "{" + ",".join(f'{k}="{v}"' for k, v in sorted(escaped.items())) + "}"
+
+
+def _prometheus_value(value):
+    return "NaN" if value is None else repr(float(value))
+
+
+def _format_ms(seconds):
+    return "" if seconds is None else f"{seconds * 1000.0:.1f}"
+
+
+registry = MetricsRegistry()
@@ -7,14 +7,25 @@ import logging
 import queue
 
 from click_default_group import DefaultGroup
+from concurrent.futures import Future
 from contextlib import contextmanager
 from functools import partial
 from watchdog.observers import Observer
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import FileSystemEventHandler, FileCreatedEvent, FileDeletedEvent, FileModifiedEvent
 
 import dfsync.filters as filters
 import dfsync.lib as lib
-from dfsync.backends import rsync_backend, kube_backend
+import dfsync.metrics as metrics
+from dfsync.backends import (
+    BUILTIN_BACKENDS,
+    ChangeRecord,
+    fanout_backend,
+    load_backends,
+    supports_batches,
+    supports_verify,
+)
+from dfsync.backends.protocol import CREATED, DELETED, MODIFIED, MOVED, is_synced
+from dfsync.backends.rsync import KUBE_ONLY_ARGS, SyncPreempted, transfer_stats
 from dfsync.distribution import (
     get_installed_version,
     get_latest_version,
@@ -23,17 +34,16 @@ from dfsync.distribution import (
     is_installed_in_editable_mode,
     update_package,
 )
+from dfsync.changes import ChangeDetector, DirtyPathSet
 from dfsync.config import read_config
+from dfsync.scanner import scan_tree
+from dfsync.state import StateStore
 from dfsync.char_ui import KeyController
 from dfsync.kube_credentials import contextualize_kube_credentials, update_local_kube_config, normalized_k8s_url
 
 logging.basicConfig(level=logging.WARN)
 
-BACKENDS = {
-    # File sync backends
-    "file-rsync": rsync_backend,
-    "kube-rsync": kube_backend,
-}
+BACKENDS = load_backends(BUILTIN_BACKENDS)
 
 
 class IgnoreEvent(Exception):
@@ -55,6 +65,7 @@ class FileChangedEventHandler(lib.ControlledThreadedOperation, FileSystemEventHa
         watched_dir: str = ".",
         all_watched_dirs: list = None,
         input_controller: KeyController = None,
+        change_detector: ChangeDetector = None,
         **kwargs,
     ):
         super().__init__()
@@ -66,8 +77,20 @@ class FileChangedEventHandler(lib.ControlledThreadedOperation, FileSystemEventHa
         self.watched_dir = watched_dir
         self.abs_watched_dir = os.path.abspath(watched_dir)
         self.input_controller = input_controller
-        self.events = queue.Queue(maxsize=10000)
+        self.change_detector = change_detector if change_detector is not None else ChangeDetector()
+        self.dirty_paths = DirtyPathSet(max_paths=10000)
+        metrics.registry.gauge("queue_depth", watched_dir=watched_dir).set_function(self.dirty_paths.__len__)
+        metrics.registry.gauge("events_collapsed", watched_dir=watched_dir).set_function(
+            lambda: self.dirty_paths.collapsed_count
+        )
+        # Bursts of this many changes fall back to a full sync, batch backends take up to max_batch_size at once
         self.full_sync_threashold = 3
+        if supports_batches(backend):
+            self.full_sync_threashold = max(self.full_sync_threashold, getattr(backend, "max_batch_size", 0))
+        # Fewer pending changes than this interrupt a running full sync, whatever the batch size
+        self.priority_threashold = 3
+        self.max_preemptions = 5
+        self._priority_checks = {}
         self.all_watched_dirs = all_watched_dirs if all_watched_dirs is not None else [watched_dir]
 
     def _log_backend(self, event):
@@ -88,6 +111,8 @@ class FileChangedEventHandler(lib.ControlledThreadedOperation, FileSystemEventHa
                 yield self
         except IgnoreEvent:
             pass
+        except SyncPreempted:
+            raise
         except:
             self.raised_exception = True
             raise
@@ -97,12 +122,161 @@ class FileChangedEventHandler(lib.ControlledThreadedOperation, FileSystemEventHa
         # and in some other contexts, it will be a relative path
 
         src_file_path = self._get_path_relative_to_watched_dir(event.src_path, self.abs_watched_dir)
-        self.backend.sync(
-            src_file_path=src_file_path,
-            event=event,
-            watched_dir=self.abs_watched_dir,
-            **self.backend_options,
+        is_unchanged, signature = self.change_detector.check(event.src_path)
+        if is_unchanged:
+            metrics.registry.counter("syncs_skipped_unchanged").inc()
+            logging.info(f"Skipped {src_file_path}, contents unchanged since the last sync")
+            return
+
+        metrics.registry.counter("syncs", backend=type(self.backend).__name__, type="file").inc()
+        with metrics.registry.timer("sync"):
+            result = self.backend.sync(
+                src_file_path=src_file_path,
+                event=event,
+                watched_dir=self.abs_watched_dir,
+                **self.backend_options,
+            )
+        self._record(result, {event.src_path: signature})
+
+    def _sync_events(self, events):
+        if not supports_batches(self.backend):
+            for event in _split_moves(events):
+                with self.terminal_lock():
+                    self._sync(event)
+            return
+
+        with self.terminal_lock():
+            self._sync_changes(events)
+
+    def _sync_changes(self, events):
+        changes, signatures = [], {}
+        for event in events:
+            try:
+                change, change_signatures = self._get_change_record(event)
+            except IgnoreEvent:
+                continue
+            if change is None:
+                metrics.registry.counter("syncs_skipped_unchanged").inc()
+                logging.info(f"Skipped {event.src_path}, contents unchanged since the last sync")
+                continue
+            changes.append(change)
+            signatures.update(change_signatures)
+        if not changes:
+            return
+
+        metrics.registry.counter("syncs", backend=type(self.backend).__name__, type="batch").inc()
+        with metrics.registry.timer("sync"):
+            result = self.backend.sync_batch(iter(changes), watched_dir=self.abs_watched_dir, **self.backend_options)
+        self._record(result, signatures)
+
+    def _record(self, result, signatures: dict):
+        """
+        Records the signatures of the synced files. Backends that sync in the background (e.g. the fan-out)
+        return a future, the files are then recorded once it resolves, unless they were modified in the meantime
+        """
+        if isinstance(result, Future):
+            for path in signatures:
+                self.change_detector.record(path, None)
+            result.add_done_callback(partial(self._record_acknowledged, signatures))
+            return
+        # Not synced everywhere, the next change of the file is synced even if it reverts to the recorded contents
+        for path, signature in signatures.items():
+            self.change_detector.record(path, signature if is_synced(result) else None)
+
+    def _record_acknowledged(self, signatures: dict, future: Future):
+        synced = is_synced(future.result())
+        for path, signature in signatures.items():
+            self.change_detector.record_if_unmodified(path, signature if synced else None)
+
+    def _get_change_record(self, event):
+        """
+        Returns a (ChangeRecord, {path: signature}) tuple, the change is None when the file contents are unchanged
+        """
+        src_file_path = self._get_path_relative_to_watched_dir(event.src_path, self.abs_watched_dir)
+        dest_path = getattr(event, "dest_path", None) if event.event_type == MOVED else None
+        if dest_path:
+            try:
+                dest_file_path = self._get_path_relative_to_watched_dir(dest_path, self.abs_watched_dir)
+            except IgnoreEvent:
+                # Moved out of the watched dir
+                dest_path = None
+
+        if dest_path:
+            _, signature = self.change_detector.check(dest_path)
+            kind, signatures = MOVED, {event.src_path: None, dest_path: signature}
+        else:
+            is_unchanged, signature = self.change_detector.check(event.src_path)
+            if is_unchanged:
+                return None, {}
+            kind, signatures = CREATED, {event.src_path: signature}
+            if signature is None and not os.path.exists(event.src_path):
+                kind = DELETED
+            elif event.event_type != CREATED:
+                kind = MODIFIED
+
+        change = ChangeRecord(
+            kind=kind,
+            path=src_file_path,
+            dest_path=dest_file_path if kind == MOVED else None,
+            size=signature.size if signature is not None else None,
+            mtime_ns=signature.mtime_ns if signature is not None else None,
         )
+        return change, signatures
+
+    def _sync_project(self):
+        for preemptions in range(self.max_preemptions + 1):
+            # Past a few interruptions, the full sync runs to completion
+            preempt = self._has_priority_events if preemptions < self.max_preemptions else None
+            self._priority_checks = {}
+            try:
+                with self.terminal_lock():
+                    run_full_sync(
+                        self.backend,
+                        self.all_watched_dirs,
+                        change_detector=self.change_detector,
+                        preempt=preempt,
+                        **self.backend_options,
+                    )
+                return
+            except SyncPreempted:
+                pass
+
+            # Small interactive changes go first, the full sync is resumed right after
+            # and it also catches anything else that changed in the meantime
+            batch = self.dirty_paths.drain()
+            if batch.dirs or batch.whole_tree or len(batch.events) >= self.full_sync_threashold:
+                continue
+            self._sync_events(self._filter_events(batch.events))
+
+    def _has_priority_events(self):
+        events = self.dirty_paths.peek()
+        if not events or len(events) >= self.priority_threashold:
+            return False
+        return any(self._is_priority_event(event) for event in events)
+
+    def _is_priority_event(self, event):
+        # Called by the full sync, which already holds the terminal lock
+        key = id(event)
+        if key not in self._priority_checks:
+            try:
+                self._priority_checks[key] = all(f(event=event) is not False for f in self.filters)
+            except Exception:
+                self._priority_checks[key] = False
+        return self._priority_checks[key]
+
+    def reconcile(self, ignore_rules=None):
+        """
+        Marks the files which changed since they were last synced as dirty, i.e. changes made while dfsync was down
+        """
+        with metrics.registry.timer("reconcile"):
+            scanned = scan_tree([self.abs_watched_dir], ignore_rules)
+            changed, deleted = self.change_detector.diff_tree(self.abs_watched_dir, scanned)
+
+        for path in changed:
+            self.dirty_paths.add(FileModifiedEvent(path))
+        for path in deleted:
+            self.dirty_paths.add(FileDeletedEvent(path))
+        return len(changed) + len(deleted)
 
     def _get_path_relative_to_watched_dir(self, path, parent_path):
         try:
@@ -128,66 +302,85 @@ class FileChangedEventHandler(lib.ControlledThreadedOperation, FileSystemEventHa
             raise IgnoreEvent() from e
 
     def _drain_queue(self, timeout=0.5):
-        event = self.events.get(block=True, timeout=timeout)
-        latest_events = {event.src_path: event}
-        try:
-            # Allow a bit of time for the queue to fill
-            if self.events.qsize() == 0:
+        if not self.dirty_paths.wait(timeout=timeout):
+            raise queue.Empty()
+
+        dirty_since = self.dirty_paths.dirty_since
+        if dirty_since is not None:
+            metrics.registry.record("queue_wait", time.monotonic() - dirty_since)
+
+        with metrics.registry.timer("debounce"):
+            # Allow a bit of time for the dirty set to fill
+            if len(self.dirty_paths) <= 1:
                 time.sleep(0.25)
             # Started filling? allow a little bit more time
-            if self.events.qsize() > 0:
+            if len(self.dirty_paths) > 1:
                 time.sleep(0.4)
 
-            # Start draining
-            while self.events.qsize() > 0:
-                event = self.events.get_nowait()
-                # Only keep the latest event for a given file path
-                latest_events[event.src_path] = event
-
-        except queue.Empty:
-            pass
-        finally:
-            return latest_events.values()
+        return self.dirty_paths.drain()
 
     def _filter_events(self, latest_events, stop_threashold=None):
         sync_events = []
         for event in latest_events:
-            filtered = False
-            for file_filter in self.filters:
-                with self.terminal_lock():
-                    if file_filter(event=event) is False:
-                        filtered = True
-                        break
-            if not filtered:
+            event = self._filter_event(event)
+            if event is not None:
                 sync_events.append(event)
             if stop_threashold is not None and len(sync_events) > stop_threashold:
                 return sync_events
 
         return sync_events
 
+    def _filter_event(self, event):
+        """
+        Returns the event, or None when it is filtered out. Both sides of a move are filtered, a move
+        from an ignored file (e.g. an editor's temp file) is a create, a move to an ignored file is a delete
+        """
+        if event.event_type != MOVED:
+            return event if self._is_not_filtered(event) else None
+
+        is_src_synced = self._is_not_filtered(FileDeletedEvent(event.src_path))
+        is_dest_synced = self._is_not_filtered(FileCreatedEvent(event.dest_path))
+        if is_src_synced and is_dest_synced:
+            return event
+        elif is_dest_synced:
+            return FileCreatedEvent(event.dest_path)
+        elif is_src_synced:
+            return FileDeletedEvent(event.src_path)
+        return None
+
+    def _is_not_filtered(self, event):
+        for file_filter in self.filters:
+            filter_name = _filter_name(file_filter)
+            with self.terminal_lock(), metrics.registry.timer(f"filter.{filter_name}"):
+                if file_filter(event=event) is False:
+                    metrics.registry.counter("events_ignored", filter=filter_name).inc()
+                    return False
+        return True
+
     def run(self):
         while self._running:
             try:
-                latest_events = self._drain_queue()
-                sync_events = self._filter_events(latest_events, stop_threashold=self.full_sync_threashold)
-                if len(sync_events) >= self.full_sync_threashold:
-                    with self.terminal_lock():
-                        self.backend.sync_project(self.all_watched_dirs, **self.backend_options)
-                else:
-                    for event in sync_events:
-                        with self.terminal_lock():
-                            self._sync(event)
+                with metrics.registry.batch(watched_dir=self.watched_dir):
+                    self._sync_batch(self._drain_queue())
             except queue.Empty:
                 time.sleep(0.001)
 
+    def _sync_batch(self, batch):
+        if batch.dirs or batch.whole_tree:
+            # Too many changes to track file by file, only a full sync is guaranteed to catch them all
+            self._sync_project()
+            return
+
+        sync_events = self._filter_events(batch.events, stop_threashold=self.full_sync_threashold)
+        if len(sync_events) >= self.full_sync_threashold:
+            self._sync_project()
+        else:
+            self._sync_events(sync_events)
+
     def catch_all_handler(self, event):
-        try:
-            # Add sync event to the sync queue
-            self.events.put(event)
-        except queue.Full:
-            # It's acceptable for events to be rejected from the queue
-            # because a busy queue will trigger a full-sync
-            pass
+        # Mark the event path as dirty, the dirty set is bounded and never drops changes
+        metrics.registry.counter("events").inc()
+        self.dirty_paths.add(event)
 
     def on_moved(self, event):
         self.catch_all_handler(event)
@@ -202,10 +395,120 @@ class FileChangedEventHandler(lib.ControlledThreadedOperation, FileSystemEventHa
         self.catch_all_handler(event)
 
 
+def _split_moves(events):
+    # Backends without batches sync one path at a time, a move is the delete of its source and the create of its dest
+    for event in events:
+        if event.event_type == MOVED:
+            yield FileDeletedEvent(event.src_path)
+            yield FileCreatedEvent(event.dest_path)
+        else:
+            yield event
+
+
+def run_full_sync(backend, src_file_paths, change_detector: ChangeDetector = None, **backend_options):
+    metrics.registry.counter("syncs", backend=type(backend).__name__, type="full").inc()
+    started_ns = time.time_ns()
+    with metrics.registry.timer("full_sync"):
+        result = backend.sync_project(src_file_paths, **backend_options)
+    if change_detector is not None and is_synced(result):
+        change_detector.record_tree(
+            src_file_paths, synced_before_ns=started_ns, ignore_rules=filters.load_ignore_rules(src_file_paths)
+        )
+    elif change_detector is not None:
+        # Some destinations may hold anything, nothing can be skipped until the next complete full sync
+        change_detector.forget()
+    return result
+
+
+def run_verify(backend, src_file_paths, checksum: bool = True, **backend_options):
+    if not supports_verify(backend):
+        click.echo(f"Verify is not supported by {type(backend).__name__}")
+        return None
+    metrics.registry.counter("verifies", backend=type(backend).__name__).inc()
+    return backend.verify_project(src_file_paths, checksum=checksum, **backend_options)
+
+
+class PeriodicVerifier(lib.ControlledThreadedOperation):
+    """
+    Verifies the destination every `interval` seconds, at low priority: only while no changes are pending,
+    the verify is interrupted as soon as new changes come in and retried a bit later.
+    The periodic verify compares file sizes only, which is cheap and catches lost or truncated files.
+    Keyboard input is only blocked while the divergent files are resynced, not during the comparison.
+    """
+
+    def __init__(self, interval: float, handlers: list, action, input_controller: KeyController = None):
+        super().__init__()
+        self.interval = interval
+        self.handlers = handlers
+        self.action = action
+        self.input_controller = input_controller
+
+    def _has_pending_changes(self):
+        return any(len(handler.dirty_paths) > 0 for handler in self.handlers)
+
+    @contextmanager
+    def _input_lock(self):
+        if self.input_controller is None:
+            yield self
+        else:
+            with self.input_controller.getch_lock():
+                yield self
+
+    def run(self):
+        next_run = time.monotonic() + self.interval
+        while self._running:
+            time.sleep(0.5)
+            if time.monotonic() < next_run or self._has_pending_changes():
+                continue
+            try:
+                self.action(checksum=False, preempt=self._has_pending_changes, output_lock=self._input_lock)
+                next_run = time.monotonic() + self.interval
+            except SyncPreempted:
+                next_run = time.monotonic() + 5.0
+            except Exception as e:
+                logging.info("Periodic verify failed", exc_info=e)
+                next_run = time.monotonic() + self.interval
+
+
+def _filter_name(file_filter):
+    owner = getattr(file_filter, "__self__", None)
+    return type(owner).__name__ if owner is not None else file_filter.__name__
+
+
+def create_backend_engine(backend: str, state, backend_options: dict):
+    backend_engine_factory = BACKENDS.get(backend)
+    if backend_engine_factory is None:
+        raise ValueError("Backend not found: {}".format(backend))
+    return backend_engine_factory(state=state, **backend_options)
+
+
+def create_fanout_targets(destinations: list, src_file_paths: list, state, backend_options: dict):
+    """
+    Returns the (destination, backend engine, backend options) of each destination of a fan-out
+    """
+    split_destinations = [split_destination(d) for d in destinations]
+    has_kube_destinations = any(backend == "kube-rsync" for backend, _ in split_destinations)
+
+    targets = []
+    for destination, (backend, destination_dir) in zip(destinations, split_destinations):
+        options = {**backend_options, "destination_dir": destination_dir}
+        if has_kube_destinations and backend != "kube-rsync":
+            # The kubernetes options are meant for the kubernetes destinations only
+            options.update({k: None for k in KUBE_ONLY_ARGS})
+        check_that_source_and_destination_are_unrelated(src_file_paths, destination_dir)
+        click.echo("Trying {} to '{}'".format(backend, destination_dir))
+        targets.append((destination, create_backend_engine(backend, state, options), options))
+    return targets
+
+
 def split_destination(destination):
     kube = "kube://"
+    scheme, _, rest = destination.partition("://")
     if destination.lower().startswith(kube):
         return "kube-rsync", destination[len(kube) :]
+    elif rest and scheme in BACKENDS:
+        # Backends installed by other packages, e.g. my-backend://destination
+        return scheme, rest
     else:
         return "file-rsync", destination
 
@@ -248,13 +551,14 @@ def has_destination_optics(destination):
     # Returns true if the given argument looks like a destination
     # e.g. a kubernetes slug or a ssh "user@host:path" slug
     is_kube = destination.lower().startswith("kube://")
+    is_plugin = destination.partition("://")[0] in BACKENDS
 
     is_ssh = ":/" in destination or ":~" in destination
     if ":" in destination:
         user_host, _ = destination.split(":")[:2]
         is_ssh = "@" in user_host or is_ssh
 
-    return is_kube or is_ssh
+    return is_kube or is_plugin or is_ssh
 
 
 @click.group(cls=DefaultGroup, default="sync", default_if_no_args=False, context_settings=dict(max_content_width=999))
@@ -309,6 +613,37 @@ def self_update():
         update_package("dfsync")
 
 
+@main.command()
+@click.option(
+    "--scenario",
+    "scenarios",
+    multiple=True,
+    type=click.Choice(["single-edit", "burst", "rename", "full-sync"]),
+    help="Benchmark scenario to run (default is all scenarios)",
+)
+@click.option("--iterations", default=20, help="Number of iterations for each scenario (default is 20)", type=int)
+@click.option(
+    "--kube-pods",
+    multiple=True,
+    type=int,
+    help="Benchmark kube-rsync operations against a fake cluster with this many pods (e.g. 1, 10, 100, 500)",
+)
+@click.option("--json", "json_path", default=None, help="Append the results as JSON lines to this file", type=str)
+def bench(scenarios, iterations, kube_pods, json_path):
+    """
+    Benchmark the sync pipeline, locally or against a fake kubernetes cluster
+    """
+    from dfsync.bench import run_benchmarks
+
+    run_benchmarks(
+        scenarios=list(scenarios),
+        iterations=iterations,
+        kube_pods=list(kube_pods),
+        json_path=json_path,
+        echo=click.echo,
+    )
+
+
 @main.command()
 @click.option("--kube-host", default=None, help="Kubernetes api host server address/hostname", type=str)
 @click.option("--credentials", default=sys.stdin, help="compose file to work with", type=click.File("r"))
@@ -326,15 +661,89 @@ def import_kube_host(kube_host=None, credentials=None):
 @main.command()
 @click.argument("source", nargs=-1)
 @click.argument("destination", default="", nargs=1)
+@click.option(
+    "--also-to",
+    "additional_destinations",
+    multiple=True,
+    help="Additional destination to sync the same source(s) to, may be repeated",
+    type=str,
+)
 @click.option("--supervisor", is_flag=True, default=False, help="Try to install supervisor in container")
 @click.option("--kube-host", default=None, help="Kubernetes api host server address/hostname", type=str)
 @click.option("--pod-timeout", default=30, help="Pod reconfiguration timeout (default is 30 seconds)", type=int)
+@click.option("--namespace", default=None, help="Only sync to pods in this kubernetes namespace", type=str)
+@click.option("--label-selector", default=None, help="Only sync to pods matching this label selector", type=str)
+@click.option("--field-selector", default=None, help="Only sync to pods matching this field selector", type=str)
+@click.option(
+    "--kube-qps",
+    default=None,
+    help="Max kubernetes api calls (execs included) per second of this session, 0 to disable (default is 20)",
+    type=click.FloatRange(min=0),
+)
 @click.option("--full-sync/--no-full-sync", default=True, help="On startup, sync all files to destination", type=bool)
 @click.option("--version", is_flag=True, default=False, help="Print the currently installed version")
 @click.option(
     "--sync-git-untracked", is_flag=True, default=False, help="Sync git-untracked files instead of ignoring them"
 )
-def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, version, sync_git_untracked):
+@click.option(
+    "--hash-check/--no-hash-check",
+    default=True,
+    help="Compare file content hashes to skip syncing files that were touched but not changed",
+    type=bool,
+)
+@click.option(
+    "--adaptive-transfer/--no-adaptive-transfer",
+    default=True,
+    help="Measure each destination link and pick rsync compression and whole-file/delta mode accordingly",
+    type=bool,
+)
+@click.option(
+    "--sync-jobs",
+    default=1,
+    help="Number of parallel rsync processes used by full syncs (default is 1)",
+    type=click.IntRange(min=1),
+)
+@click.option(
+    "--persist-state/--no-persist-state",
+    default=True,
+    help="Keep the sync state in .dfsync/ to only sync what changed while dfsync was not running",
+    type=bool,
+)
+@click.option(
+    "--verify-interval",
+    default=0,
+    help="Seconds between background checks that the destination(s) did not drift, e.g. 600 (disabled by default)",
+    type=click.IntRange(min=0),
+)
+@click.option("--stats-file", default=None, help="Append per-batch stage timings as JSON lines to this file", type=str)
+@click.option(
+    "--metrics-port",
+    default=None,
+    help="Serve Prometheus metrics on http://127.0.0.1:<port>/metrics",
+    type=int,
+)
+def sync(
+    source,
+    destination,
+    additional_destinations,
+    supervisor,
+    kube_host,
+    pod_timeout,
+    namespace,
+    label_selector,
+    field_selector,
+    kube_qps,
+    full_sync,
+    version,
+    sync_git_untracked,
+    hash_check,
+    adaptive_transfer,
+    sync_jobs,
+    persist_state,
+    verify_interval,
+    stats_file,
+    metrics_port,
+):
     """
     Watches a folder for changes and propagates all file changes to a destination.
 
@@ -360,6 +769,10 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
        dfsync src kube://image-name-of-awesome-api:/home/user/awesome-api
        dfsync kube://quay.io/project/name-of-container-image:/home/path/within/container/awesome-api
 
+    \b
+    4. Watch a dir and sync changes to several targets at once
+       dfsync src pi@raspberry-1:~/app --also-to pi@raspberry-2:~/app --also-to kube://image-name-of-awesome-api:/app
+
     \b
     dfsync is:
     * git-aware: changes to git internals, files matching .gitignore patterns and untracked files will be ignored
@@ -379,6 +792,9 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
     if sync_git_untracked:
         filters.set_ignore_untracked_files(False)
 
+    if stats_file:
+        metrics.registry.dump_to(stats_file)
+
     if version:
         _version()
         return
@@ -391,6 +807,7 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
     if len(missing) > 0 and len(paths) > 0:
         click.echo(f"Source file/dirs not found: {', '.join(missing)}")
 
+    destinations = list(dict.fromkeys([destination_dir, *additional_destinations, *config.additional_destinations]))
     backend, destination_dir = split_destination(destination_dir)
     try:
         if len(paths) == 0:
@@ -409,16 +826,26 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
             kube_host=normalized_k8s_url(kube_host),
             pod_timeout=pod_timeout,
             container_command=config.container_command,
+            namespace=namespace or config.namespace,
+            label_selector=label_selector or config.label_selector,
+            field_selector=field_selector or config.field_selector,
+            kube_qps=kube_qps,
             full_sync=full_sync,
+            adaptive_transfer=adaptive_transfer,
+            sync_jobs=sync_jobs,
         )
 
-        backend_engine_factory = BACKENDS.get(backend)
-        backend_engine = backend_engine_factory(**backend_options)
-        if backend_engine is None:
-            raise ValueError("Backend not found: {}".format(backend))
+        state = StateStore() if persist_state else None
 
-        check_that_source_and_destination_are_unrelated(paths, destination_dir)
-        click.echo("Trying {} to '{}'".format(backend, destination_dir))
+        if len(destinations) == 1:
+            backend_engine = create_backend_engine(backend, state, backend_options)
+            check_that_source_and_destination_are_unrelated(paths, destination_dir)
+            click.echo("Trying {} to '{}'".format(backend, destination_dir))
+        else:
+            targets = create_fanout_targets(destinations, paths, state, backend_options)
+            backend, destination_dir = "fanout", ", ".join(destinations)
+            backend_options = {**backend_options, "destination_dir": destination_dir}
+            backend_engine = fanout_backend(targets)
 
     except RelatedLocationsError as e:
         click.echo(
@@ -450,14 +877,29 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
         click.echo(str(e))
         return -1
 
+    if metrics_port is not None:
+        try:
+            metrics_server = metrics.MetricsServer(metrics_port)
+            metrics_server.start()
+            click.echo(f"Serving metrics on {metrics_server.url}")
+        except OSError as e:
+            # e.g. the port is already in use, syncing matters more than the metrics
+            click.echo(f"Not serving metrics, port {metrics_port} is not available ({e.strerror or e})")
+
     checker = AsyncVersionChecker()
     controller = KeyController()
+    change_detector = ChangeDetector(use_hash=hash_check, state=state, destination=destination_dir)
 
     handlers = []
     observer = Observer()
     for p in paths:
         event_handler = FileChangedEventHandler(
-            backend_engine, watched_dir=p, all_watched_dirs=paths, input_controller=controller, **backend_options
+            backend_engine,
+            watched_dir=p,
+            all_watched_dirs=paths,
+            input_controller=controller,
+            change_detector=change_detector,
+            **backend_options,
         )
         handlers.append(event_handler)
         event_handler.start()
@@ -466,7 +908,20 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
     controller.on_key(
         "f",
         description="to trigger a full sync",
-        action=partial(backend_engine.sync_project, paths, **backend_options),
+        action=partial(run_full_sync, backend_engine, paths, change_detector=change_detector, **backend_options),
+    )
+    verify = partial(run_verify, backend_engine, paths, **backend_options)
+    controller.on_key(
+        "v",
+        description="to verify the destination(s) by checksum and resync the files that drifted",
+        action=verify,
+    )
+    if verify_interval > 0 and supports_verify(backend_engine):
+        PeriodicVerifier(verify_interval, handlers, verify, input_controller=controller).start()
+    controller.on_key(
+        "s",
+        description="to print sync statistics",
+        action=partial(print_stats, controller),
     )
     controller.on_key(
         "x",
@@ -476,6 +931,11 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
 
     try:
         backend_engine.on_monitor_start(src_file_paths=paths, **backend_options)
+        if backend == "file-rsync" and change_detector.has_manifest:
+            # The destination outlives dfsync, only the files changed while dfsync was down need syncing
+            ignore_rules = filters.load_ignore_rules(paths)
+            changes = sum(event_handler.reconcile(ignore_rules) for event_handler in handlers)
+            click.echo(f"Found {changes} file(s) changed since the last sync")
         click.echo("Watching source dir(s): '{}'; press [Ctrl-C] to exit\n".format("', '".join(paths)))
         observer.start()
 
@@ -508,10 +968,20 @@ def sync(source, destination, supervisor, kube_host, pod_timeout, full_sync, ver
         observer.stop()
         lib.thread_manager.stop()
         backend_engine.on_monitor_exit(**backend_options)
+        if change_detector.hits > 0:
+            total = change_detector.hits + change_detector.misses
+            click.echo(f"Skipped {change_detector.hits} of {total} file syncs, contents were unchanged")
         if observer.ident is not None:
             # only join the observer if it was previously started
             observer.join()
 
 
+def print_stats(controller: KeyController):
+    with controller.getch_lock():
+        click.echo(metrics.registry.format_table())
+        if transfer_stats.session.syncs > 0:
+            click.echo(transfer_stats.format_table())
+
+
 if __name__ == "__main__":
     sys.exit(main() or 0)
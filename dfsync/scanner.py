@@ -0,0 +1,72 @@
+import fnmatch
+import os
+import os.path
+import re
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+ScanEntry = namedtuple("ScanEntry", ("size", "mtime_ns"))
+
+# Never part of what is synced
+SKIPPED_DIRS = {".git", ".dfsync"}
+
+
+class IgnoreRules:
+    """
+    Ignored absolute paths (files or whole dirs) and file name patterns, compiled once so that
+    the scanner can prune ignored subtrees without descending into them
+    """
+
+    def __init__(self, paths: list = (), patterns: list = ()):
+        self.paths = {os.path.abspath(p) for p in paths}
+        self._name_regex = re.compile("|".join(fnmatch.translate(p) for p in patterns)) if patterns else None
+
+    def is_ignored(self, path: str, name: str = None):
+        if path in self.paths:
+            return True
+        name = name if name is not None else os.path.basename(path)
+        return self._name_regex is not None and self._name_regex.match(name) is not None
+
+
+NO_IGNORE_RULES = IgnoreRules()
+
+
+def _scan_dir(dir_path: str, ignore_rules: IgnoreRules):
+    files, sub_dirs = {}, []
+    try:
+        with os.scandir(dir_path) as entries:
+            for entry in entries:
+                if ignore_rules.is_ignored(entry.path, entry.name):
+                    continue
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        if entry.name not in SKIPPED_DIRS:
+                            sub_dirs.append(entry.path)
+                    elif entry.is_file():
+                        stat = entry.stat()
+                        files[entry.path] = ScanEntry(size=stat.st_size, mtime_ns=stat.st_mtime_ns)
+                except OSError:
+                    continue
+    except (FileNotFoundError, NotADirectoryError, PermissionError):
+        pass
+    return files, sub_dirs
+
+
+def scan_tree(root_paths: list, ignore_rules: IgnoreRules = None, jobs: int = 8) -> dict:
+    """
+    Returns a dict of absolute path: ScanEntry for every file under the given dirs.
+
+    Dirs are listed with os.scandir by a pool of threads, the stat calls release the GIL, which keeps
+    large trees and slow (e.g. network or container) file systems busy. Ignored dirs are not descended into.
+    """
+    ignore_rules = ignore_rules or NO_IGNORE_RULES
+    files = {}
+    with ThreadPoolExecutor(max_workers=jobs, thread_name_prefix="dfsync-scan") as executor:
+        pending = {executor.submit(_scan_dir, os.path.abspath(p), ignore_rules) for p in root_paths}
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                dir_files, sub_dirs = future.result()
+                files.update(dir_files)
+                pending.update(executor.submit(_scan_dir, d, ignore_rules) for d in sub_dirs)
+    return files
@@ -0,0 +1,93 @@
+import os
+import os.path
+import sqlite3
+import threading
+
+from dfsync.changes import FileSignature
+
+STATE_DIR = ".dfsync"
+
+SCHEMA = [
+    """
+    CREATE TABLE IF NOT EXISTS manifest (
+        destination TEXT NOT NULL,
+        path TEXT NOT NULL,
+        size INTEGER NOT NULL,
+        mtime_ns INTEGER NOT NULL,
+        digest TEXT,
+        PRIMARY KEY (destination, path)
+    )
+    """,
+    """
+    CREATE TABLE IF NOT EXISTS image_distro (
+        image_id TEXT PRIMARY KEY,
+        distro TEXT NOT NULL
+    )
+    """,
+    # Written by earlier versions, never read back
+    "DROP TABLE IF EXISTS git_ignored",
+]
+
+
+class StateStore:
+    """
+    Sync state that survives dfsync restarts, kept in a sqlite database under .dfsync/
+
+    * the manifest of the files last synced to each destination
+    * the distro detected for each container image
+    """
+
+    def __init__(self, path: str = None):
+        path = path or os.path.join(STATE_DIR, "state.db")
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self._db.execute(statement)
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+    def _query(self, sql, *args):
+        with self._lock:
+            return self._db.execute(sql, args).fetchall()
+
+    def _execute_many(self, sql, rows):
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                self._db.executemany(sql, rows)
+                self._db.execute("COMMIT")
+            except:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def load_manifest(self, destination: str) -> dict:
+        rows = self._query("SELECT path, size, mtime_ns, digest FROM manifest WHERE destination = ?", destination)
+        return {path: FileSignature(size, mtime_ns, digest) for path, size, mtime_ns, digest in rows}
+
+    def record_files(self, destination: str, signatures: dict):
+        """
+        Updates the manifest of a destination, paths with a None signature are removed from it
+        """
+        removed = [(destination, path) for path, signature in signatures.items() if signature is None]
+        updated = [(destination, path, *signature) for path, signature in signatures.items() if signature is not None]
+        if removed:
+            self._execute_many("DELETE FROM manifest WHERE destination = ? AND path = ?", removed)
+        if updated:
+            self._execute_many("INSERT OR REPLACE INTO manifest VALUES (?, ?, ?, ?, ?)", updated)
+
+    def clear_manifest(self, destination: str):
+        self._query("DELETE FROM manifest WHERE destination = ?", destination)
+
+    def get_image_distro(self, image_id: str):
+        rows = self._query("SELECT distro FROM image_distro WHERE image_id = ?", image_id)
+        return rows[0][0] if rows else None
+
+    def set_image_distro(self, image_id: str, distro: str):
+        self._query("INSERT OR REPLACE INTO image_distro VALUES (?, ?)", image_id, distro)
@@ -0,0 +1,85 @@
+import os
+
+from watchdog.events import FileModifiedEvent, FileMovedEvent
+
+from dfsync.changes import ChangeDetector, DirtyPathSet
+
+
+def test_dirty_path_set_keeps_latest_event_per_path():
+    dirty = DirtyPathSet()
+    dirty.add(FileModifiedEvent("/src/a.py"))
+    dirty.add(FileModifiedEvent("/src/b.py"))
+    latest = FileModifiedEvent("/src/a.py")
+    dirty.add(latest)
+    assert len(dirty) == 2
+
+    batch = dirty.drain()
+    assert len(batch.events) == 2
+    assert latest in batch.events
+    assert not batch.dirs
+    assert not batch.whole_tree
+    assert len(dirty) == 0
+
+
+def test_dirty_path_set_overflow_collapses_into_dirs():
+    dirty = DirtyPathSet(max_paths=2, max_dirs=10)
+    dirty.add(FileModifiedEvent("/src/a/1.py"))
+    dirty.add(FileModifiedEvent("/src/b/2.py"))
+    dirty.add(FileMovedEvent("/src/c/3.py", "/src/d/3.py"))
+    # Absorbed by an already dirty dir
+    dirty.add(FileModifiedEvent("/src/a/x/4.py"))
+
+    batch = dirty.drain()
+    assert batch.events == []
+    assert batch.dirs == {"/src/a", "/src/b", "/src/c", "/src/d"}
+    assert not batch.whole_tree
+
+
+def test_dirty_path_set_dirs_overflow_marks_whole_tree():
+    dirty = DirtyPathSet(max_paths=1, max_dirs=1)
+    dirty.add(FileModifiedEvent("/src/a/1.py"))
+    dirty.add(FileModifiedEvent("/src/b/2.py"))
+
+    batch = dirty.drain()
+    assert batch.events == []
+    assert not batch.dirs
+    assert batch.whole_tree
+
+
+def test_dirty_path_set_wait():
+    dirty = DirtyPathSet()
+    assert dirty.wait(timeout=0.01) is False
+    dirty.add(FileModifiedEvent("/src/a.py"))
+    assert dirty.wait(timeout=0.01) is True
+
+
+def test_change_detector_skips_touched_files(tmp_path):
+    path = tmp_path / "a.py"
+    path.write_text("print('a')")
+    detector = ChangeDetector()
+
+    is_unchanged, signature = detector.check(str(path))
+    assert is_unchanged is False
+    detector.record(str(path), signature)
+
+    assert detector.check(str(path))[0] is True
+
+    os.utime(path, ns=(signature.mtime_ns + 10**9, signature.mtime_ns + 10**9))
+    assert detector.check(str(path))[0] is True
+
+    path.write_text("print('b')")
+    assert detector.check(str(path))[0] is False
+    assert detector.hits == 2
+    assert detector.misses == 2
+
+
+def test_change_detector_deleted_files(tmp_path):
+    path = tmp_path / "a.py"
+    path.write_text("print('a')")
+    detector = ChangeDetector(use_hash=False)
+    detector.record(str(path), detector.check(str(path))[1])
+
+    path.unlink()
+    is_unchanged, signature = detector.check(str(path))
+    assert is_unchanged is False
+    assert signature is None
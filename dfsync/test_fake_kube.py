@@ -0,0 +1,220 @@
+import threading
+import time
+
+import pytest
+from kubernetes import client
+from kubernetes.client.exceptions import ApiException
+
+from dfsync.backends.kube import Alpine
+from dfsync.backends.protocol import MODIFIED, ChangeRecord
+from dfsync.fake_kube import FakeCluster, FakeKubeReDeployer
+
+
+def test_fake_cluster_pod_discovery():
+    cluster = FakeCluster(pods=4, pods_per_deployment=2, unrelated_pods=3, api_latency=0, exec_latency=0)
+    deployer = FakeKubeReDeployer(cluster)
+
+    matching = list(deployer.generate_matching_containers(cluster.image))
+    assert len(matching) == 4
+    assert cluster.api_calls["list_pod_for_all_namespaces"] == 1
+    assert cluster.bytes_listed > 0
+
+    deployer.inspect_deployment_images(cluster.image)
+    assert deployer._image_distro is Alpine
+    # All the replicas run the same image, a single pod is probed, and only once
+    assert cluster.api_calls["connect_get_namespaced_pod_exec"] == 1
+    deployer.inspect_deployment_images(cluster.image)
+    assert cluster.api_calls["connect_get_namespaced_pod_exec"] == 1
+
+    pod, spec, status = matching[0]
+    assert deployer.dry_run_exec(pod, spec, status) is True
+
+
+def test_toggle_supervisor_edits_each_deployment_once():
+    cluster = FakeCluster(pods=6, pods_per_deployment=2, api_latency=0, exec_latency=0, rollout_latency=0.05)
+    deployer = FakeKubeReDeployer(cluster, pod_timeout=5)
+    deployer.inspect_deployment_images(cluster.image)
+    old_pods = {pod.metadata.name for pod, _, _ in deployer.generate_matching_containers(cluster.image)}
+
+    deployer.toggle_supervisor(cluster.image, "install")
+    assert cluster.api_calls["list_namespaced_deployment"] == 2  # one list, one rollout watch
+    assert cluster.api_calls["patch_namespaced_deployment"] == 3
+    assert old_pods <= deployer._pod_blacklist
+    assert all(deployer._is_supervised(*c) for c in deployer.generate_matching_containers(cluster.image))
+
+    # Nothing left to install
+    deployer.toggle_supervisor(cluster.image, "install")
+    assert cluster.api_calls["patch_namespaced_deployment"] == 3
+
+    deployer.toggle_supervisor(cluster.image, "uninstall")
+    containers = [d.spec.template.spec.containers[0] for d in cluster._deployments.values()]
+    assert all(c.command == [] and c.image_pull_policy == "Always" for c in containers)
+
+
+def test_deployment_patch_retries_conflicts_without_waiting():
+    cluster = FakeCluster(pods=1, api_latency=0, exec_latency=0, rollout_latency=0.05)
+    deployer = FakeKubeReDeployer(cluster, pod_timeout=5)
+    pod, spec, status = next(deployer.generate_matching_containers(cluster.image))
+    listed = {d.metadata.name: d for d, _ in deployer.list_deployments(cluster.namespace, "")}
+
+    # Someone else edits the deployment after it was listed
+    cluster._deployments["app-0"].metadata.resource_version = "changed"
+    started = time.monotonic()
+    deployed = deployer._patch_deployment(cluster.namespace, "app-0", {spec.name}, {"command": ["sleep"]}, listed)
+    assert time.monotonic() - started < 1.0
+    assert deployed.spec.template.spec.containers[0].command == ["sleep"]
+    assert cluster.api_calls["read_namespaced_deployment"] == 1
+    assert cluster.api_calls["patch_namespaced_deployment"] == 2
+
+
+def test_deployment_patch_fails_fast_on_client_errors():
+    cluster = FakeCluster(pods=1, api_latency=0, exec_latency=0)
+    deployer = FakeKubeReDeployer(cluster, pod_timeout=5)
+
+    started = time.monotonic()
+    with pytest.raises(ApiException) as e:
+        deployer._patch_deployment(cluster.namespace, "missing", {"app"}, {"command": ["sleep"]}, {})
+    assert e.value.status == 404
+    assert time.monotonic() - started < 1.0
+    assert cluster.api_calls["read_namespaced_deployment"] == 1
+
+
+def test_supervisor_replaces_http_probes():
+    cluster = FakeCluster(pods=1, api_latency=0, exec_latency=0, rollout_latency=0.05)
+    http_probe = client.V1Probe(http_get=client.V1HTTPGetAction(path="/health", port=8080), period_seconds=10)
+    cluster._deployments["app-0"].spec.template.spec.containers[0].readiness_probe = http_probe
+    deployer = FakeKubeReDeployer(cluster, pod_timeout=5)
+    deployer.inspect_deployment_images(cluster.image)
+
+    deployer.toggle_supervisor(cluster.image, "install")
+    probe = cluster._deployments["app-0"].spec.template.spec.containers[0].readiness_probe
+    assert probe._exec is not None and probe.http_get is None
+
+    deployer.toggle_supervisor(cluster.image, "uninstall")
+    probe = cluster._deployments["app-0"].spec.template.spec.containers[0].readiness_probe
+    assert probe._exec is None and probe.http_get.path == "/health"
+
+
+def test_pod_discovery_pushes_down_selectors():
+    cluster = FakeCluster(pods=6, pods_per_deployment=2, unrelated_pods=3, api_latency=0, exec_latency=0)
+    deployer = FakeKubeReDeployer(cluster, namespace=cluster.namespace, label_selector="app=app-1")
+
+    matching = list(deployer.generate_matching_containers(cluster.image))
+    assert {pod.metadata.labels["app"] for pod, _, _ in matching} == {"app-1"}
+    assert len(matching) == 2
+    assert cluster.api_calls["list_namespaced_pod"] == 1
+    assert cluster.api_calls["list_pod_for_all_namespaces"] == 0
+
+    assert list(FakeKubeReDeployer(cluster, namespace="other").generate_matching_containers(cluster.image)) == []
+
+
+def test_crashing_deployments_are_recovered_in_parallel():
+    cluster = FakeCluster(
+        pods=4, pods_per_deployment=2, crashing_deployments=2, api_latency=0, exec_latency=0, rollout_latency=0.3
+    )
+    deployer = FakeKubeReDeployer(cluster, pod_timeout=5)
+
+    started = time.monotonic()
+    assert deployer.stabilize_deployments(cluster.image) == [True, True]
+    assert time.monotonic() - started < 1.5
+    assert cluster.api_calls["list_pod_for_all_namespaces"] == 1
+    assert cluster.api_calls["list_namespaced_pod"] == 2
+    assert all(
+        deployer._is_dfsync_command(d.spec.template.spec.containers[0].command) for d in cluster._deployments.values()
+    )
+
+
+def test_empty_pods_get_a_bulk_copy(tmp_path):
+    src_dir = tmp_path / "src"
+    (src_dir / "pkg").mkdir(parents=True)
+    (src_dir / "pkg" / "app.py").write_text("VALUE = 1\n")
+    (src_dir / "README.md").write_text("hello\n")
+    cluster = FakeCluster(pods=2, api_latency=0, exec_latency=0, root_dir=str(tmp_path / "pods"))
+    deployer = FakeKubeReDeployer(cluster)
+    deployer.inspect_deployment_images(cluster.image)
+
+    image_base = cluster.image.split(":")[0]
+    deployer.sync_project([str(src_dir)], destination_dir=f"{image_base}:app")
+    for pod, _, _ in deployer.generate_matching_containers(cluster.image):
+        app_dir = tmp_path / "pods" / pod.metadata.name / "app"
+        assert (app_dir / "pkg" / "app.py").read_text() == "VALUE = 1\n"
+        assert (app_dir / "README.md").read_text() == "hello\n"
+        # No longer empty, the next full syncs go through rsync
+        assert not deployer.is_empty_destination(pod, None, pod.status.container_statuses[0], "app")
+
+
+def test_restarted_containers_are_resynced(tmp_path):
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    (src_dir / "app.py").write_text("VALUE = 1\n")
+    cluster = FakeCluster(pods=2, api_latency=0, exec_latency=0, watch_latency=0, root_dir=str(tmp_path / "pods"))
+    deployer = FakeKubeReDeployer(cluster)
+    deployer.inspect_deployment_images(cluster.image)
+    image_base = cluster.image.split(":")[0]
+    deployer.sync_project([str(src_dir)], destination_dir=f"{image_base}:app")
+
+    deployer.start_pod_watch(image_base, [str(src_dir)], "app")
+    try:
+        pod_name = next(iter(cluster._pods))
+        restarted = tmp_path / "pods" / pod_name / "app" / "app.py"
+        while deployer._pod_watchers[0]._response is None:
+            time.sleep(0.01)
+        cluster.restart_container(pod_name)
+        assert not restarted.exists()
+
+        started = time.monotonic()
+        while not restarted.exists() and time.monotonic() - started < 5.0:
+            time.sleep(0.05)
+        assert restarted.read_text() == "VALUE = 1\n"
+    finally:
+        pod_watchers = deployer._pod_watchers
+        deployer.stop_pod_watch()
+
+    # A single watch, scoped to the namespace of the matching pods, interrupted right away on stop
+    assert [w.namespace for w in pod_watchers] == [cluster.namespace]
+    assert cluster.api_calls["list_namespaced_pod"] == 1
+    pod_watchers[0]._thread.join(timeout=2.0)
+    assert not pod_watchers[0]._thread.is_alive()
+
+
+def test_concurrent_pod_lists_are_coalesced():
+    cluster = FakeCluster(pods=4, pods_per_deployment=2, api_latency=0.2, exec_latency=0)
+    deployer = FakeKubeReDeployer(cluster)
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(deployer.list_pods(cluster.image))) for _ in range(5)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert cluster.api_calls["list_pod_for_all_namespaces"] == 1
+    # Each caller deserialized its own pods from the shared response
+    assert len({id(pod_list) for pod_list in results}) == 5
+    assert all(len(pod_list.items) == 4 for pod_list in results)
+
+
+def test_batches_skipping_pods_are_not_synced():
+    cluster = FakeCluster(pods=1, crashing_deployments=1, api_latency=0, exec_latency=0)
+    deployer = FakeKubeReDeployer(cluster)
+    image_base = cluster.image.split(":")[0]
+
+    change = ChangeRecord(MODIFIED, "./app.py", None, 10, 0)
+    assert deployer.sync_batch([change], destination_dir=f"{image_base}:app") is False
+
+
+def test_restarted_containers_are_verified_by_checksum(tmp_path, monkeypatch):
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    (src_dir / "app.py").write_text("VALUE = 2\n")
+    cluster = FakeCluster(pods=1, api_latency=0, exec_latency=0, root_dir=str(tmp_path / "pods"))
+    deployer = FakeKubeReDeployer(cluster)
+    deployer.inspect_deployment_images(cluster.image)
+    pod, spec, status = next(deployer.generate_matching_containers(cluster.image))
+
+    # The image has its own version of the file, of the same size
+    cluster.restart_container(pod.metadata.name, image_files={"app/app.py": "VALUE = 1\n"})
+    verified = []
+    monkeypatch.setattr(deployer.rsync_backend_instance, "verify_project", lambda *a, **kw: verified.append(kw))
+    deployer.resync_container(pod, spec, status, [str(src_dir)], "app")
+    assert len(verified) == 1 and verified[0]["checksum"] is True
@@ -0,0 +1,106 @@
+import os
+import time
+
+from watchdog.events import FileModifiedEvent
+
+from dfsync.backends import ChangeRecord
+from dfsync.backends.fanout import FanoutBackend
+from dfsync.monitor import FileChangedEventHandler
+
+
+class RecordingBackend:
+    max_batch_size = 64
+
+    def __init__(self, failures=0):
+        self.failures = failures
+        self.batches = []
+        self.full_syncs = []
+
+    def sync_batch(self, changes, watched_dir=None, destination_dir=None, **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError(f"{destination_dir} is offline")
+        self.batches.append([c.path for c in changes])
+
+    def sync_project(self, src_file_paths, destination_dir=None, **kwargs):
+        if self.failures > 0:
+            self.failures -= 1
+            raise OSError(f"{destination_dir} is offline")
+        self.full_syncs.append(src_file_paths)
+
+    def on_monitor_start(self, **kwargs):
+        pass
+
+    def on_monitor_exit(self, **kwargs):
+        pass
+
+
+def wait_until(condition, timeout=5.0):
+    started = time.monotonic()
+    while not condition() and time.monotonic() - started < timeout:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_each_destination_retries_on_its_own():
+    healthy, flaky = RecordingBackend(), RecordingBackend(failures=1)
+    fanout = FanoutBackend(
+        [("pi-1", healthy, {"destination_dir": "pi-1"}), ("pi-2", flaky, {"destination_dir": "pi-2"})]
+    )
+    for worker in fanout.workers:
+        worker.max_retry_delay = 0.1
+    fanout.on_monitor_start(src_file_paths=["src"])
+    try:
+        # Acknowledged once every destination synced it, after a retry
+        synced = fanout.sync_batch(iter([ChangeRecord("modified", "./a.txt", None, 1, 1)]), watched_dir="src")
+        assert synced.result(timeout=5.0) is True
+        assert healthy.batches == flaky.batches == [["./a.txt"]]
+        assert wait_until(lambda: fanout.workers[1].failures == 0)
+
+        # A failed full sync is retried in the background
+        assert fanout.sync_project(["src"]) is True
+        flaky.failures = 1
+        assert fanout.sync_project(["src"]) is False
+        assert healthy.full_syncs == [["src"], ["src"]]
+        assert wait_until(lambda: len(flaky.full_syncs) == 2)
+    finally:
+        fanout.on_monitor_exit()
+
+
+def test_queue_collapses_into_a_full_sync():
+    backend = RecordingBackend()
+    fanout = FanoutBackend([("nfs", backend, {})])
+    worker = fanout.workers[0]
+    worker.src_file_paths = ["src"]
+    worker.max_pending = 2
+
+    acks = [fanout.sync_batch([ChangeRecord("modified", n, None, 1, 1)], watched_dir="src") for n in ["a", "b", "c"]]
+    assert worker.pending_count == 1
+    # Covered by the full sync, not acknowledged one by one
+    assert [ack.result(timeout=0) for ack in acks] == [False, False, False]
+    worker.start()
+    try:
+        assert wait_until(lambda: backend.full_syncs)
+        assert backend.batches == []
+    finally:
+        worker.stop()
+
+
+def test_unchanged_files_are_not_queued_again(tmp_path):
+    (tmp_path / "a.txt").write_text("hello")
+    first, second = RecordingBackend(), RecordingBackend()
+    fanout = FanoutBackend([("pi-1", first, {}), ("pi-2", second, {})])
+    handler = FileChangedEventHandler(fanout, watched_dir=str(tmp_path))
+    handler.filters = []
+    fanout.on_monitor_start(src_file_paths=[str(tmp_path)])
+    try:
+        handler._sync_changes([FileModifiedEvent(str(tmp_path / "a.txt"))])
+        assert wait_until(lambda: handler.change_detector.has_manifest)
+
+        # Re-saved with the same contents
+        os.utime(tmp_path / "a.txt", ns=(time.time_ns(), time.time_ns() + 10**9))
+        handler._sync_changes([FileModifiedEvent(str(tmp_path / "a.txt"))])
+        assert fanout.workers[0].pending_count == fanout.workers[1].pending_count == 0
+        assert first.batches == second.batches == [["./a.txt"]]
+    finally:
+        fanout.on_monitor_exit()
@@ -3,7 +3,13 @@ import pytest
 import tempfile
 import yaml
 
-from dfsync.kube_credentials import update_local_kube_config, normalized_k8s_url
+from dfsync.kube_credentials import (
+    KubeContextConfig,
+    list_kube_contexts,
+    normalized_k8s_url,
+    read_kube_config,
+    update_local_kube_config,
+)
 
 
 @pytest.fixture
@@ -114,7 +120,35 @@ def test_normalized_k8s_url():
     assert normalized_k8s_url("http://example.com") == "http://example.com"
     assert normalized_k8s_url("https://192.168.0.123:443") == "https://192.168.0.123:443"
     assert normalized_k8s_url("192.168.0.123:6443") == "https://192.168.0.123:6443"
+    assert normalized_k8s_url("https://192.168.0.123:6443/") == "https://192.168.0.123:6443"
     with pytest.raises(ValueError):
         normalized_k8s_url("")
 
     assert normalized_k8s_url(None) is None
+
+
+def test_contexts_are_matched_without_loading_them(tmp_path):
+    kube_config = {
+        "clusters": [{"name": f"c{i}", "cluster": {"server": f"https://c{i}.example:6443"}} for i in range(3)],
+        "contexts": [{"name": f"ctx{i}", "context": {"cluster": f"c{i}", "user": "u"}} for i in range(3)],
+        "users": [{"name": "u", "user": {"token": "secret"}}],
+        "current-context": "ctx0",
+    }
+    config_file = tmp_path / "config"
+    config_file.write_text(yaml.dump(kube_config))
+
+    contexts, active_context_name = list_kube_contexts(str(config_file))
+    assert active_context_name == "ctx0"
+    assert contexts[2] == {"name": "ctx2", "server": "https://c2.example:6443"}
+    assert read_kube_config(str(config_file)) == read_kube_config(str(config_file))
+
+    k8sctx = KubeContextConfig("ctx2", server=contexts[2]["server"], config_file=str(config_file))
+    assert k8sctx.host == "https://c2.example:6443"
+    assert k8sctx._api_client is None
+    assert KubeContextConfig("ctx2", server="https://c2.example:6443/").host == "https://c2.example:6443"
+
+    # Edits to the kube config are picked up
+    kube_config["current-context"] = "ctx1"
+    config_file.write_text(yaml.dump(kube_config))
+    os.utime(config_file, ns=(0, 1))
+    assert list_kube_contexts(str(config_file))[1] == "ctx1"
@@ -0,0 +1,45 @@
+import threading
+import time
+
+from dfsync.backends.kube_throttle import SingleFlight, TokenBucket
+
+
+def test_token_bucket_limits_the_sustained_rate():
+    bucket = TokenBucket(rate=100, burst=5)
+    started = time.monotonic()
+    for _ in range(15):
+        bucket.acquire()
+
+    # The burst goes through at once, the other 10 calls wait for their tokens
+    assert time.monotonic() - started >= 0.09
+    assert bucket.throttled_seconds > 0
+
+    unlimited = TokenBucket(rate=0)
+    assert all(unlimited.acquire() == 0 for _ in range(1000))
+
+
+def test_single_flight_shares_the_in_flight_call():
+    single_flight = SingleFlight()
+    release = threading.Event()
+    calls = []
+
+    def slow_call():
+        calls.append(1)
+        release.wait(5)
+        return "result"
+
+    results = []
+    threads = [threading.Thread(target=lambda: results.append(single_flight.do("key", slow_call))) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    while single_flight.coalesced < 3:
+        time.sleep(0.01)
+    release.set()
+    for thread in threads:
+        thread.join()
+
+    assert len(calls) == 1
+    assert results == ["result"] * 4
+
+    # Once done, the next call is made again
+    assert single_flight.do("key", lambda: "again") == "again"
@@ -0,0 +1,62 @@
+import json
+import urllib.request
+
+from dfsync.metrics import Histogram, MetricsRegistry, MetricsServer
+
+
+def test_histogram_percentiles():
+    histogram = Histogram()
+    for ms in range(1, 101):
+        histogram.record(ms / 1000.0)
+
+    assert histogram.count == 100
+    assert abs(histogram.percentile(50) - 0.050) < 0.050 * 0.02
+    assert abs(histogram.percentile(99) - 0.099) < 0.099 * 0.02
+    assert histogram.max == 0.1
+    assert Histogram().percentile(50) is None
+
+
+def test_registry_batches_are_dumped_as_json_lines(tmp_path):
+    stats_file = tmp_path / "stats.jsonl"
+    registry = MetricsRegistry()
+    registry.dump_to(str(stats_file))
+
+    with registry.batch(watched_dir="src"):
+        with registry.timer("transfer"):
+            pass
+        registry.record("filter.PythonBlackFilter", 0.5)
+        registry.record("filter.PythonBlackFilter", 0.25)
+    with registry.batch():
+        # Nothing recorded, nothing dumped
+        registry.counter("events").inc()
+
+    lines = [json.loads(line) for line in stats_file.read_text().splitlines()]
+    assert len(lines) == 1
+    assert lines[0]["watched_dir"] == "src"
+    assert lines[0]["stages"]["filter.PythonBlackFilter"] == 0.75
+    assert "transfer" in lines[0]["stages"]
+
+    snapshot = registry.snapshot()
+    assert snapshot["events"]["value"] == 1
+    assert snapshot["filter.PythonBlackFilter"]["count"] == 2
+    assert "filter.PythonBlackFilter" in registry.format_table()
+
+
+def test_prometheus_endpoint():
+    registry = MetricsRegistry()
+    registry.counter("syncs", backend="FileRsync", type="file").inc(2)
+    registry.gauge("queue_depth", watched_dir="src").set_function(lambda: 3)
+    registry.record("kube_api", 0.01, method="list_pod_for_all_namespaces")
+
+    server = MetricsServer(0, metrics_registry=registry)
+    server.start()
+    try:
+        with urllib.request.urlopen(server.url) as response:
+            body = response.read().decode("utf8")
+    finally:
+        server.stop()
+
+    assert "# TYPE dfsync_syncs_total counter" in body
+    assert 'dfsync_syncs_total{backend="FileRsync",type="file"} 2.0' in body
+    assert 'dfsync_queue_depth{watched_dir="src"} 3.0' in body
+    assert 'dfsync_kube_api_seconds_count{method="list_pod_for_all_namespaces"} 1' in body
@@ -0,0 +1,149 @@
+import time
+
+from watchdog.events import FileCreatedEvent, FileDeletedEvent, FileModifiedEvent, FileMovedEvent
+
+from dfsync.backends.rsync import SyncPreempted
+from dfsync.monitor import FileChangedEventHandler, run_full_sync
+
+
+class PreemptibleBackend:
+    def __init__(self):
+        self.calls = []
+
+    def sync_project(self, src_file_paths, preempt=None, **kwargs):
+        self.calls.append("full-sync")
+        started = time.monotonic()
+        while preempt is not None and time.monotonic() - started < 5.0:
+            if preempt():
+                raise SyncPreempted()
+            time.sleep(0.01)
+
+    def sync(self, src_file_path, **kwargs):
+        self.calls.append(src_file_path)
+
+
+def test_small_changes_preempt_a_full_sync(tmp_path):
+    path = tmp_path / "notes.txt"
+    path.write_text("edited while the full sync is running")
+
+    backend = PreemptibleBackend()
+    handler = FileChangedEventHandler(backend, watched_dir=str(tmp_path))
+    handler.max_preemptions = 1
+    handler.dirty_paths.add(FileModifiedEvent(str(path)))
+
+    handler._sync_project()
+    assert backend.calls == ["full-sync", "./notes.txt", "full-sync"]
+    assert len(handler.dirty_paths) == 0
+    assert handler.raised_exception is False
+
+
+class BatchBackend:
+    max_batch_size = 10
+
+    def __init__(self):
+        self.batches = []
+
+    def sync_batch(self, changes, watched_dir=None, **kwargs):
+        self.batches.append(list(changes))
+
+
+def test_changes_are_synced_in_a_single_batch(tmp_path):
+    for name in ["a.txt", "b.txt", "c.txt", "d.txt", "new.txt"]:
+        (tmp_path / name).write_text(name)
+
+    backend = BatchBackend()
+    handler = FileChangedEventHandler(backend, watched_dir=str(tmp_path))
+    handler.filters = []
+    assert handler.full_sync_threashold == 10
+
+    # Only a few changes interrupt a full sync, not a whole batch
+    handler.dirty_paths.add(FileModifiedEvent(str(tmp_path / "a.txt")))
+    assert handler._has_priority_events()
+    for name in ["b.txt", "c.txt"]:
+        handler.dirty_paths.add(FileModifiedEvent(str(tmp_path / name)))
+    assert not handler._has_priority_events()
+    handler.dirty_paths.drain()
+
+    handler.change_detector.record(str(tmp_path / "d.txt"), handler.change_detector.check(str(tmp_path / "d.txt"))[1])
+    (tmp_path / "c.txt").unlink()
+    (tmp_path / "new.txt").rename(tmp_path / "moved.txt")
+    events = [
+        FileCreatedEvent(str(tmp_path / "a.txt")),
+        FileModifiedEvent(str(tmp_path / "b.txt")),
+        FileDeletedEvent(str(tmp_path / "c.txt")),
+        FileModifiedEvent(str(tmp_path / "d.txt")),
+        FileMovedEvent(str(tmp_path / "new.txt"), str(tmp_path / "moved.txt")),
+    ]
+    for event in events:
+        handler.dirty_paths.add(event)
+
+    handler._sync_batch(handler.dirty_paths.drain())
+    assert len(backend.batches) == 1
+    assert [(c.kind, c.path, c.dest_path, c.size) for c in backend.batches[0]] == [
+        ("created", "./a.txt", None, 5),
+        ("modified", "./b.txt", None, 5),
+        ("deleted", "./c.txt", None, None),
+        ("moved", "./new.txt", "./moved.txt", 7),
+    ]
+
+
+def test_renames_go_through_the_default_filters(tmp_path):
+    for name in ["renamed.txt", "saved.txt", "backup.txt~"]:
+        (tmp_path / name).write_text(name)
+
+    backend = BatchBackend()
+    handler = FileChangedEventHandler(backend, watched_dir=str(tmp_path))
+    events = [
+        FileMovedEvent(str(tmp_path / "old.txt"), str(tmp_path / "renamed.txt")),
+        # Editors save to a temp file, then move it over the edited file
+        FileMovedEvent(str(tmp_path / ".#saved.txt"), str(tmp_path / "saved.txt")),
+        FileMovedEvent(str(tmp_path / "backup.txt"), str(tmp_path / "backup.txt~")),
+        FileMovedEvent(str(tmp_path / ".#tmp"), str(tmp_path / "#tmp#")),
+    ]
+    for event in events:
+        handler.dirty_paths.add(event)
+
+    handler._sync_batch(handler.dirty_paths.drain())
+    assert [(c.kind, c.path, c.dest_path) for c in backend.batches[0]] == [
+        ("moved", "./old.txt", "./renamed.txt"),
+        ("created", "./saved.txt", None),
+        ("deleted", "./backup.txt", None),
+    ]
+
+    # Backends without batches get the delete of the source and the create of the destination
+    backend = PreemptibleBackend()
+    handler = FileChangedEventHandler(backend, watched_dir=str(tmp_path))
+    handler.dirty_paths.add(FileMovedEvent(str(tmp_path / "renamed.txt"), str(tmp_path / "again.txt")))
+    (tmp_path / "renamed.txt").rename(tmp_path / "again.txt")
+    handler._sync_batch(handler.dirty_paths.drain())
+    assert backend.calls == ["./renamed.txt", "./again.txt"]
+
+
+def test_reverted_files_are_synced_after_a_full_sync(tmp_path):
+    path = tmp_path / "app.txt"
+    path.write_text("x")
+
+    backend = BatchBackend()
+    backend.sync_project = lambda src_file_paths, **kwargs: None
+    handler = FileChangedEventHandler(backend, watched_dir=str(tmp_path))
+    handler._sync_changes([FileModifiedEvent(str(path))])
+
+    # Carried by a full sync, without a state store
+    path.write_text("y, synced by the full sync")
+    run_full_sync(backend, [str(tmp_path)], change_detector=handler.change_detector)
+
+    path.write_text("x")
+    handler._sync_changes([FileModifiedEvent(str(path))])
+    assert len(backend.batches) == 2
+
+
+def test_changes_left_out_by_the_backend_are_not_recorded(tmp_path):
+    path = tmp_path / "app.txt"
+    path.write_text("x")
+
+    backend = BatchBackend()
+    backend.sync_batch = lambda changes, **kwargs: backend.batches.append(list(changes)) or False
+    handler = FileChangedEventHandler(backend, watched_dir=str(tmp_path))
+    handler._sync_changes([FileModifiedEvent(str(path))])
+    handler._sync_changes([FileModifiedEvent(str(path))])
+    assert len(backend.batches) == 2
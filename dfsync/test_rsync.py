@@ -0,0 +1,158 @@
+import os
+import threading
+
+from dfsync.backends.rsync import EMPTY_RSYNC_STATS, FileRsync, RsyncStreamReader, TransferStats, plan_shards
+from dfsync.backends.rsync_tuning import DELTA, LOCAL, TRANSFER_MODES, WHOLE_FILE_COMPRESSED, TransferTuner
+
+RSYNC_STATS_OUTPUT = """sending incremental file list
+app.py
+
+Number of files: 3 (reg: 2, dir: 1)
+Number of created files: 0
+Number of deleted files: 0
+Number of regular files transferred: 2
+Total file size: 12,345 bytes
+Total transferred file size: 2,048 bytes
+Literal data: 512 bytes
+Matched data: 1,536 bytes
+File list size: 0
+Total bytes sent: 1,024
+Total bytes received: 64
+
+sent 1,024 bytes  received 64 bytes  2,176.00 bytes/sec
+total size is 12,345  speedup is 11.35
+"""
+
+
+def _read_stats(output, elapsed):
+    read_fd, write_fd = os.pipe()
+    with os.fdopen(write_fd, "wb") as f:
+        f.write(output.encode("utf8"))
+
+    reader = RsyncStreamReader(os.fdopen(read_fd, "rb"))
+    reader.start()
+    reader.stop()
+    return reader.get_stats(elapsed=elapsed)
+
+
+def test_stream_reader_parses_rsync_stats():
+    stats = _read_stats(RSYNC_STATS_OUTPUT, elapsed=0.5)
+
+    assert stats.files_transferred == 2
+    assert stats.total_size == 12345
+    assert stats.literal_bytes == 512
+    assert stats.matched_bytes == 1536
+    assert stats.sent_bytes == 1024
+    assert stats.received_bytes == 64
+    assert stats.matched_ratio == 0.75
+    assert stats.seconds_per_file == 0.25
+    assert round(stats.speedup, 2) == 11.35
+
+
+def test_stream_reader_without_stats_output():
+    stats = _read_stats("sent 100 bytes  received 35 bytes  270.00 bytes/sec\n", elapsed=1.0)
+    assert stats.sent_bytes == 100
+    assert stats.received_bytes == 35
+    assert stats.files_transferred == 0
+
+    assert _read_stats("", elapsed=1.0) is None
+
+
+def test_transfer_stats_aggregation():
+    transfer_stats = TransferStats()
+    stats = _read_stats(RSYNC_STATS_OUTPUT, elapsed=0.5)
+    transfer_stats.record("pi:/app/", stats)
+    transfer_stats.record("pi:/app/", stats)
+    transfer_stats.record("/tmp/app/", stats)
+
+    assert transfer_stats.get("pi:/app/").syncs == 2
+    assert transfer_stats.get("pi:/app/").sent_bytes == 2048
+    assert transfer_stats.get("pi:/app/").throughput == 2048
+    assert transfer_stats.session.syncs == 3
+    assert transfer_stats.get("unknown").syncs == 0
+
+
+def test_transfer_tuner_explores_then_selects_the_fastest_mode():
+    tuner = TransferTuner(min_sample_bytes=1000, samples_per_mode=1)
+    assert tuner.get_mode("/tmp/app/", is_local=True) is LOCAL
+
+    # Small transfers are not conclusive
+    tuner.record("pi:/app/", DELTA, EMPTY_RSYNC_STATS._replace(transferred_size=10, elapsed=0.01))
+    assert tuner.get_mode("pi:/app/") is DELTA
+    assert tuner.get_min_run_time("pi:/app/") == 0.01
+
+    elapsed = {mode.name: 1.0 for mode in TRANSFER_MODES}
+    elapsed[WHOLE_FILE_COMPRESSED.name] = 0.25
+    for _ in TRANSFER_MODES:
+        mode = tuner.get_mode("pi:/app/")
+        tuner.record("pi:/app/", mode, EMPTY_RSYNC_STATS._replace(transferred_size=10000, elapsed=elapsed[mode.name]))
+
+    assert tuner.get_mode("pi:/app/") is WHOLE_FILE_COMPRESSED
+    assert tuner.get_mode("pi:/app/") is WHOLE_FILE_COMPRESSED
+
+    tuner.revisit_seconds = 0
+    assert tuner.get_mode("pi:/app/") is DELTA
+
+
+def test_plan_shards_balances_by_size(tmp_path):
+    src = tmp_path / "src"
+    (src / "data" / "big").mkdir(parents=True)
+    (src / ".git").mkdir()
+    (src / ".git" / "index").write_bytes(b"x" * 10000)
+    for i in range(4):
+        (src / "data" / "big" / f"{i}.bin").write_bytes(b"x" * 1000)
+    (src / "data" / "small.bin").write_bytes(b"x" * 500)
+    (src / "app.py").write_bytes(b"x" * 100)
+    (src / "empty").mkdir()
+
+    shards = plan_shards([str(src)], jobs=2)
+    assert len(shards) == 2
+
+    paths = sorted(p.split("/./")[1] for shard in shards for p in shard)
+    assert paths == [
+        "app.py",
+        "data/big/0.bin",
+        "data/big/1.bin",
+        "data/big/2.bin",
+        "data/big/3.bin",
+        "data/small.bin",
+        "empty",
+    ]
+
+    sizes = [sum(os.path.getsize(p) for p in shard if os.path.isfile(p)) for shard in shards]
+    assert abs(sizes[0] - sizes[1]) <= 500
+
+
+RSYNC_ITEMIZED_OUTPUT = """sending incremental file list
+*deleting   stale.txt
+cd+++++++++ pkg/
+>f+++++++++ pkg/lost.py
+>f.s....... app.py
+cL+++++++++ link -> app.py
+"""
+
+
+def test_verify_resyncs_only_the_divergent_files(tmp_path, monkeypatch):
+    fake_bin = tmp_path / "bin"
+    fake_bin.mkdir()
+    fake_rsync = fake_bin / "rsync"
+    fake_rsync.write_text(f"#!/bin/sh\ncat <<'EOF'\n{RSYNC_ITEMIZED_OUTPUT}EOF\n")
+    fake_rsync.chmod(0o755)
+    monkeypatch.setenv("PATH", f"{fake_bin}:{os.environ['PATH']}")
+
+    src_dir = tmp_path / "src"
+    (src_dir / "pkg").mkdir(parents=True)
+    (src_dir / "pkg" / "lost.py").write_text("lost")
+    (src_dir / "app.py").write_text("truncated")
+
+    backend = FileRsync(adaptive_transfer=False)
+    synced, locked = [], threading.Lock()
+    monkeypatch.setattr(backend, "sync_batch", lambda changes, watched_dir, **kw: synced.extend(changes))
+    monkeypatch.setattr(backend, "_sync", lambda paths, event_type, **kw: synced.append((event_type, locked.locked())))
+
+    # Only the resync happens under the output lock
+    destination_dir = str(tmp_path / "dst")
+    assert backend.verify_project([str(src_dir)], destination_dir=destination_dir, output_lock=lambda: locked) == 3
+    assert not locked.locked()
+    assert [c.path for c in synced[:2]] == ["./pkg/lost.py", "./app.py"]
+    assert synced[2] == ("full-sync-delete", True)
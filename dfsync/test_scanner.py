@@ -0,0 +1,18 @@
+import os
+
+from dfsync.scanner import IgnoreRules, scan_tree
+
+
+def test_scan_tree_prunes_ignored_subtrees(tmp_path):
+    for rel_path in ["app.py", "pkg/mod.py", "pkg/deep/er/data.json", "build/out.o", ".git/index", "pkg/#mod.py#"]:
+        path = tmp_path / rel_path
+        path.parent.mkdir(parents=True, exist_ok=True)
+        path.write_text(rel_path)
+
+    rules = IgnoreRules(paths=[str(tmp_path / "build")], patterns=["#*#", "*~"])
+    scanned = scan_tree([str(tmp_path)], rules, jobs=4)
+
+    assert sorted(os.path.relpath(p, tmp_path) for p in scanned) == ["app.py", "pkg/deep/er/data.json", "pkg/mod.py"]
+    entry = scanned[str(tmp_path / "pkg" / "mod.py")]
+    assert entry.size == len("pkg/mod.py")
+    assert entry.mtime_ns == os.stat(tmp_path / "pkg" / "mod.py").st_mtime_ns
@@ -0,0 +1,40 @@
+import os
+import time
+
+from dfsync.changes import ChangeDetector
+from dfsync.monitor import FileChangedEventHandler
+from dfsync.state import StateStore
+
+
+def test_manifest_survives_restarts(tmp_path):
+    src = tmp_path / "src"
+    src.mkdir()
+    (src / "app.py").write_text("print('hello')")
+    (src / "old.py").write_text("print('old')")
+
+    state = StateStore(str(tmp_path / "state" / "state.db"))
+    detector = ChangeDetector(state=state, destination="pi:/app/")
+    detector.record_tree([str(src)], synced_before_ns=time.time_ns() + 1)
+    state.close()
+
+    # Changes made while dfsync was not running
+    (src / "app.py").write_text("print('hello, world')")
+    (src / "new.py").write_text("print('new')")
+    os.remove(src / "old.py")
+
+    state = StateStore(str(tmp_path / "state" / "state.db"))
+    detector = ChangeDetector(state=state, destination="pi:/app/")
+    assert detector.has_manifest
+    assert not ChangeDetector(state=state, destination="/tmp/app/").has_manifest
+
+    handler = FileChangedEventHandler(None, watched_dir=str(src), change_detector=detector)
+    handler.reconcile()
+    dirty = sorted((event.event_type, os.path.basename(event.src_path)) for event in handler.dirty_paths.peek())
+    assert dirty == [("deleted", "old.py"), ("modified", "app.py"), ("modified", "new.py")]
+
+
+def test_image_distro_cache(tmp_path):
+    state = StateStore(str(tmp_path / "state.db"))
+    assert state.get_image_distro("sha256:abc") is None
+    state.set_image_distro("sha256:abc", "Alpine")
+    assert state.get_image_distro("sha256:abc") == "Alpine"
@@ -0,0 +1,30 @@
+import os
+import tarfile
+
+from dfsync.backends.tar_stream import stream_tree
+
+
+def test_bulk_copy_survives_noisy_remotes_and_shrinking_files(tmp_path, monkeypatch):
+    src_dir = tmp_path / "src"
+    src_dir.mkdir()
+    (src_dir / "data.bin").write_bytes(os.urandom(1024 * 1024))
+    (src_dir / "app.py").write_text("VALUE = 1\n" * 100)
+
+    # Truncated right after its tar header was prepared
+    gettarinfo = tarfile.TarFile.gettarinfo
+
+    def shrinking_gettarinfo(tar, name=None, arcname=None, fileobj=None):
+        info = gettarinfo(tar, name, arcname, fileobj)
+        if arcname == "app.py":
+            (src_dir / "app.py").write_text("VALUE = 2\n")
+        return info
+
+    monkeypatch.setattr(tarfile.TarFile, "gettarinfo", shrinking_gettarinfo)
+
+    # More warnings than a pipe buffer holds, written before the remote side reads its input
+    rsh = """sh -c 'head -c 262144 /dev/zero >&2; exec "$@"' noisy-remote"""
+    stats = stream_tree([str(src_dir)], str(tmp_path / "dst"), rsh=rsh)
+
+    assert stats.files_transferred == 2
+    assert (tmp_path / "dst" / "app.py").read_text() == "VALUE = 2\n"
+    assert (tmp_path / "dst" / "data.bin").read_bytes() == (src_dir / "data.bin").read_bytes()